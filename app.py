@@ -1,12 +1,17 @@
-from flask import Flask, render_template, request, Response, stream_with_context, jsonify, send_from_directory
-import json
+from flask import Flask, render_template, request, Response, stream_with_context, jsonify, send_from_directory, send_file, g
+from werkzeug.utils import safe_join
 import os
-import io
+import threading
+import time
 from dotenv import load_dotenv
-from spotify_service import SpotifyService
-from downloader import Downloader
-from mutagen.id3 import ID3, APIC
-from mutagen.mp3 import MP3
+from library_index import LibraryIndex
+from library_watcher import LibraryFeed, LibraryWatcher
+from cover_cache import CoverCache
+from audio_stream import send_audio
+from zip_stream import ZipStream, folder_files, send_zip
+from progress_bus import ProgressBus, JobProgress
+from metrics import REGISTRY, Gauge, HTTP_SECONDS
+from worker import DOWNLOAD_PATH, LIBRARY_DB, announce_library, create_job_store, create_quota, create_runner
 
 import logging
 
@@ -16,248 +21,364 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s %(levelname)s %(name)s : %(message)s')
 
-# Validate credentials early
-if not os.getenv("SPOTIPY_CLIENT_ID") or not os.getenv("SPOTIPY_CLIENT_SECRET"):
+# Per-stage/request timing lines (logger "timing"), TIMING_LOG=0 turns them off
+if os.getenv('TIMING_LOG', '1') == '0':
+    logging.getLogger('timing').setLevel(logging.WARNING)
+
+# Download jobs run in this process unless EMBEDDED_WORKER=0, when separate
+# worker.py processes take them from the shared queue (see worker.py)
+EMBEDDED_WORKER = os.getenv('EMBEDDED_WORKER', '1') != '0'
+
+# Validate credentials early (only the downloads need them)
+if EMBEDDED_WORKER and (not os.getenv("SPOTIPY_CLIENT_ID") or not os.getenv("SPOTIPY_CLIENT_SECRET")):
     logging.error("Missing Spotify credentials in environment variables")
     raise RuntimeError("Faltan credenciales de Spotify en variables de entorno (SPOTIPY_CLIENT_ID/SECRET)")
 
 app = Flask(__name__)
 
+COVER_CACHE_DIR = os.path.abspath(os.getenv('COVER_CACHE_DIR', 'data/covers'))
+# Minimum seconds between two filesystem scans triggered by /library/stats
+LIBRARY_REFRESH_INTERVAL = float(os.getenv('LIBRARY_REFRESH_INTERVAL', '5'))
+# Live library updates: auto (inotify, else polling), inotify, poll or off (scan on /stats as before)
+LIBRARY_WATCH = os.getenv('LIBRARY_WATCH', 'auto')
+LIBRARY_POLL_INTERVAL = float(os.getenv('LIBRARY_POLL_INTERVAL', '10'))
+# Whether the server can keep long responses (progress streams, library events) open without
+# blocking everything else. Set by asgi.py, gunicorn.conf.py (threaded workers) and the dev server;
+# otherwise the page polls instead of streaming
+STREAMING_RESPONSES = os.getenv('STREAMING_RESPONSES', '0') == '1'
+# Library event streams open at once in this process. Under gunicorn each one holds a worker thread,
+# so past this many the browser is turned away (503) and polls /library/stats; asgi.py has no limit
+LIBRARY_STREAMS = int(os.getenv('LIBRARY_STREAMS', '4'))
+# A library event stream ends after this long; the browser reconnects and resumes from Last-Event-ID
+LIBRARY_STREAM_SECONDS = float(os.getenv('LIBRARY_STREAM_SECONDS', '300'))
+# Progress streams re-read the job from the database at least this often, even without notifications
+PROGRESS_POLL_INTERVAL = float(os.getenv('PROGRESS_POLL_INTERVAL', '2'))
+
 # Ensure downloads directory exists
-os.makedirs("downloads", exist_ok=True)
+os.makedirs(DOWNLOAD_PATH, exist_ok=True)
+
+cover_cache = CoverCache(COVER_CACHE_DIR)
+library_index = LibraryIndex(DOWNLOAD_PATH, LIBRARY_DB, cover_cache=cover_cache)
+# Every index write is published to the clients following /library/events
+library_feed = LibraryFeed(library_index)
+library_index.on_change = library_feed.publish
+# Taken by every open /library/events stream served by Flask
+library_streams = threading.BoundedSemaphore(LIBRARY_STREAMS)
+library_watcher = LibraryWatcher(library_index, mode=LIBRARY_WATCH, poll_interval=LIBRARY_POLL_INTERVAL)
+if LIBRARY_WATCH != 'off':
+    library_watcher.start()
+# Storage budget (STORAGE_BUDGET), enforced by whichever process downloads; None without a budget
+storage_quota = create_quota(library_index)
+if storage_quota:
+    REGISTRY.register(Gauge('storage_used_bytes', 'Size of the library counted against the storage budget',
+                            callback=lambda: storage_quota.usage()['used_bytes']))
+
+# Download jobs are persisted, so unfinished ones resume after a restart.
+# Every change is published on the bus, which wakes the progress streams.
+progress_bus = ProgressBus()
+job_store = create_job_store(on_change=progress_bus.publish)
+# Workers on other machines check they share this library database before enforcing the budget
+announce_library(job_store, library_index)
+REGISTRY.register(Gauge('jobs', 'Download jobs per state (pending = queue depth)', labels=('status',),
+                        callback=job_store.counts))
+REGISTRY.register(Gauge('job_tracks_pending', 'Tracks waiting in queued or running jobs',
+                        callback=job_store.pending_tracks))
+job_runner = None
+if EMBEDDED_WORKER:
+    try:
+        job_runner = create_runner(job_store, library_index=library_index, quota=storage_quota)
+        job_runner.start()
+    except Exception as e:
+        logging.error(f"Error initializing services: {e}")
+        job_runner = None
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_timing(response):
+    # Streaming responses are timed up to their first byte
+    if 'request_start' in g:
+        HTTP_SECONDS.record(time.perf_counter() - g.request_start, context=request.path,
+                            endpoint=request.endpoint or 'unknown')
+    return response
 
-# Initialize services
-try:
-    spotify = SpotifyService()
-    downloader = Downloader()
-except Exception as e:
-    logging.error(f"Error initializing services: {e}")
-    spotify = None
-    downloader = None
+@app.route('/metrics')
+def metrics():
+    """Prometheus text format: stage/API/request latency histograms, queue depth, active downloads, bytes"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', streaming=STREAMING_RESPONSES)
 
 @app.route('/favicon.ico')
 def favicon():
     return '', 204
 
+def record_access(filename, method, request_headers, play=True):
+    """Count a play (or a download, play=False) of a track for the storage quota's eviction order.
+
+    Players fetch a file in several Range requests as they seek; only the
+    first one, from byte 0, counts. Offline copies made by the service worker
+    are an access but not a play.
+    """
+    if method != 'GET':
+        return
+    start, _, end = request_headers.get('Range', 'bytes=0-').replace(' ', '').partition('=')[2].partition('-')
+    # Safari probes with bytes=0-1 before the real request
+    if start != '0' or end == '1':
+        return
+    try:
+        library_index.record_access(filename, play=play and not request_headers.get('X-Offline-Copy'))
+    except Exception as e:
+        logging.warning(f"Could not record access to {filename}: {e}")
+
 @app.route('/play/<path:filename>')
 def play_file(filename):
-    response = send_from_directory('downloads', filename)
-    response.headers['Cache-Control'] = 'public, max-age=31536000'
+    # Byte ranges let the player seek without refetching the file
+    response = send_audio(DOWNLOAD_PATH, filename, max_age=31536000)
+    if response.status_code in (200, 206):
+        record_access(filename, request.method, request.headers)
     return response
 
 @app.route('/download/<path:filename>')
 def download_file(filename):
     """Universal download route - works on Android, iOS, and PC"""
-    file_path = os.path.join('downloads', filename)
-    
-    if not os.path.exists(file_path):
+    file_path = safe_join(DOWNLOAD_PATH, filename)
+
+    if not file_path or not os.path.exists(file_path):
         return jsonify({'error': 'File not found'}), 404
-    
-    return send_from_directory(
-        'downloads',
+
+    response = send_audio(
+        DOWNLOAD_PATH,
         filename,
         as_attachment=True,
-        download_name=os.path.basename(filename),
-        mimetype='audio/mpeg'
+        download_name=os.path.basename(filename)
     )
+    if response.status_code in (200, 206):
+        record_access(filename, request.method, request.headers, play=False)
+    return response
+
+@app.route('/export/<path:folder>')
+def export_folder(folder):
+    """A whole folder (playlist, album or artist) as a ZIP archive built while it is sent"""
+    path = safe_join(DOWNLOAD_PATH, folder)
+    files = folder_files(DOWNLOAD_PATH, folder) if path else None
+    if not files:
+        return jsonify({'error': 'Folder not found'}), 404
+    return send_zip(ZipStream(files), f"{folder.rstrip('/').rsplit('/', 1)[-1]}.zip")
+
+def default_cover():
+    response = send_from_directory('static', 'default_cover.png')
+    response.headers['Cache-Control'] = 'public, max-age=31536000'
+    return response
 
 @app.route('/cover/<path:filename>')
 def cover_art(filename):
+    """Embedded cover art, optionally as a thumbnail (?size=128|300|640), served from the cover cache"""
+    size = cover_cache.snap_size(request.args.get('size', type=int))
     try:
-        path = os.path.join('downloads', filename)
-        # logging.debug(f"Requested cover for: {path}")
-        
-        if not os.path.exists(path):
-            # logging.warning(f"File not found: {path}")
-            response = send_from_directory('static', 'default_cover.png')
-            response.headers['Cache-Control'] = 'public, max-age=31536000'
-            return response
-
-        audio = ID3(path)
-        for tag in audio.values():
-            if isinstance(tag, APIC):
-                response = Response(io.BytesIO(tag.data), mimetype=tag.mime)
+        digest = library_index.get_cover(filename)
+        if digest is None:
+            # Not indexed yet: extract lazily and remember the result
+            path = safe_join(DOWNLOAD_PATH, filename)
+            if not path or not os.path.isfile(path):
+                return default_cover()
+            digest = cover_cache.extract(path)
+            library_index.set_cover(filename, digest)
+
+        if digest:
+            cover_path, mime = cover_cache.get(digest, size)
+            if cover_path:
+                # Covers are content-addressed, so the digest is a strong ETag
+                response = send_file(cover_path, mimetype=mime, conditional=True,
+                                     etag=f"{digest}-{size or 'orig'}")
                 response.headers['Cache-Control'] = 'public, max-age=31536000'
                 return response
     except Exception as e:
-        # logging.error(f"Error extracting cover for {filename}: {e}")
-        pass 
-    
-    response = send_from_directory('static', 'default_cover.png')
-    response.headers['Cache-Control'] = 'public, max-age=31536000'
-    return response
+        logging.warning(f"Error serving cover for {filename}: {e}")
+
+    return default_cover()
 
 @app.route('/stats')
 def stats():
-    download_path = 'downloads'
-    if not os.path.exists(download_path):
+    if not os.path.exists(DOWNLOAD_PATH):
         return jsonify({'count': 0, 'size': '0 MB', 'library': {}})
 
+    # Only new or changed files get their tags read, everything else comes from the index.
+    # With the watcher running the index is already current.
+    if not library_watcher.active:
+        library_index.refresh()
+    all_tracks = library_index.tracks()
+
     library = {}
-    total_count = 0
     total_size_bytes = 0
-
-    # Walk through downloads directory
-    for root, dirs, files in os.walk(download_path):
-        folder = os.path.relpath(root, download_path)
-        if folder == '.':
-            folder = 'Uncategorized'
-        
-        if folder not in library:
-            library[folder] = []
-
-        for f in files:
-            if f.endswith('.mp3'):
-                path = os.path.join(root, f)
-                size = os.path.getsize(path)
-                total_count += 1
-                total_size_bytes += size
-                
-                # Read metadata
-                try:
-                    from mutagen.easyid3 import EasyID3
-                    from mutagen.mp3 import MP3
-                    
-                    audio_file = MP3(path)
-                    length = audio_file.info.length
-                    minutes = int(length // 60)
-                    seconds = int(length % 60)
-                    duration_str = f"{minutes}:{seconds:02d}"
-
-                    audio = EasyID3(path)
-                    title = audio.get('title', [f])[0]
-                    artist = audio.get('artist', ['Unknown Artist'])[0]
-                    album = audio.get('album', ['Unknown Album'])[0]
-                except Exception as e:
-                    logging.warning(f"Error reading metadata for {f}: {e}")
-                    title = f
-                    artist = "Unknown Artist"
-                    album = "Unknown Album"
-                    duration_str = "0:00"
-
-                # Relative path for playback
-                rel_path = os.path.join(folder, f) if folder != 'Uncategorized' else f
-                # Normalize path separators for web
-                rel_path = rel_path.replace('\\', '/')
-
-                library[folder].append({
-                    'filename': f,
-                    'path': rel_path,
-                    'title': title,
-                    'artist': artist,
-                    'album': album,
-                    'duration': duration_str,
-                    'size': size,
-                    'timestamp': os.path.getmtime(path)
-                })
+    for track in all_tracks:
+        folder = track['path'].rsplit('/', 1)[0] if '/' in track['path'] else 'Uncategorized'
+        library.setdefault(folder, []).append(track)
+        total_size_bytes += track['size']
 
     total_size_mb = f"{total_size_bytes / (1024 * 1024):.2f} MB"
 
-    # Flatten library to a single list for the frontend
-    all_tracks = []
-    for folder, tracks in library.items():
-        all_tracks.extend(tracks)
-    
-    # Sort by modification time (newest first) if possible, or just reverse
-    # We need to get modification time. Let's add it to the track object above or just sort by name for now.
-    # Better: let's sort by file modification time.
-    # We need to re-iterate or store mtime in the loop above.
-    
-    # Let's just sort by name for now, or add a timestamp field in the loop above.
-    # Actually, let's update the loop above to include timestamp.
-    
     return jsonify({
-        'count': total_count,
+        'count': len(all_tracks),
         'size': total_size_mb,
         'library': library,
-        'tracks': sorted(all_tracks, key=lambda x: x.get('timestamp', 0), reverse=True)
+        'tracks': all_tracks
     })
 
+@app.route('/library')
+def library_tracks():
+    """Paginated track list: ?sort=mtime|artist|title&order=asc|desc&folder=&artist=&album=&limit=&cursor="""
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 500)
+    filters = {name: request.args.get(name) for name in ('folder', 'artist', 'album')}
+    if not library_watcher.active:
+        library_index.refresh(max_age=LIBRARY_REFRESH_INTERVAL)
+    try:
+        tracks, next_cursor = library_index.page(
+            sort=request.args.get('sort', 'mtime'),
+            order=request.args.get('order'),
+            filters=filters,
+            limit=limit,
+            cursor=request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'tracks': tracks, 'next_cursor': next_cursor})
+
+@app.route('/library/stats')
+def library_stats():
+    """Counts and sizes only, no track list"""
+    if not library_watcher.active:
+        library_index.refresh(max_age=LIBRARY_REFRESH_INTERVAL)
+    summary = library_index.summary()
+    summary['size'] = f"{summary['size_bytes'] / (1024 * 1024):.2f} MB"
+    return jsonify(summary)
+
+@app.route('/library/events')
+def library_events():
+    """Server-Sent Events with every track created, modified or deleted in the library"""
+    if not library_streams.acquire(blocking=False):
+        return jsonify({'error': 'Too many library event streams, poll /library/stats'}), 503, \
+            {'Retry-After': str(int(LIBRARY_STREAM_SECONDS))}
+    last_id = request.headers.get('Last-Event-ID', type=int)
+
+    def generate():
+        last = library_feed.last_id if last_id is None else last_id
+        # Tells the browser where to resume if the connection drops
+        yield f"retry: 3000\nid: {last}\n\n"
+        deadline = time.monotonic() + LIBRARY_STREAM_SECONDS
+        while time.monotonic() < deadline:
+            for message_id, message in library_feed.since(last):
+                last = message_id
+                yield library_feed.event(message_id, message)
+            if not library_feed.wait(last, min(15, max(0, deadline - time.monotonic()))):
+                yield ': keepalive\n\n'
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # The server closes the response however the stream ends, even before it started
+    response.call_on_close(library_streams.release)
+    return response
+
+@app.route('/library/manifest')
+def library_manifest():
+    """Path, size and ETag of every track in a folder or by an artist (all tracks without filters).
+
+    Used by the service worker to plan what fits in its offline audio budget.
+    """
+    filters = {name: request.args.get(name) for name in ('folder', 'artist', 'album')}
+    tracks = library_index.manifest(filters)
+    return jsonify({'tracks': tracks, 'size_bytes': sum(track['size'] for track in tracks)})
+
+@app.route('/library/quota')
+def library_quota():
+    """Storage budget and usage, read from the index without scanning, plus the pinned folders"""
+    if storage_quota:
+        return jsonify(storage_quota.usage())
+    count, size = library_index.totals()
+    return jsonify({'budget_bytes': None, 'used_bytes': size, 'reserved_bytes': 0, 'free_bytes': None,
+                    'tracks': count, 'pinned': library_index.pinned_folders()})
+
+@app.route('/library/pinned/<path:folder>', methods=['PUT', 'DELETE'])
+def pin_folder(folder):
+    """Keep a folder (and its subfolders) out of storage quota evictions, or let them go again"""
+    if request.method == 'PUT':
+        library_index.pin_folder(folder)
+    else:
+        library_index.unpin_folder(folder)
+    return jsonify({'pinned': library_index.pinned_folders()})
+
+@app.route('/search')
+def search():
+    """Typeahead search over title, artist, album and folder (every word is a prefix match)"""
+    query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    if not library_watcher.active:
+        library_index.refresh(max_age=LIBRARY_REFRESH_INTERVAL)
+    return jsonify({'query': query, 'tracks': library_index.search(query, limit=limit)})
+
 @app.route('/download', methods=['POST'])
 def download():
-    if not spotify:
+    if EMBEDDED_WORKER and not job_runner:
         return jsonify({'status': 'error', 'message': 'Server configuration error (Spotify credentials missing)'}), 500
 
-    data = request.json
-    url = data.get('url')
-    
+    # Anything but a JSON object with a string url (no body, a list, a number...) is a bad request
+    data = request.get_json(silent=True)
+    url = data.get('url') if isinstance(data, dict) else None
+    if not isinstance(url, str) or not any(kind in url for kind in ('track', 'playlist', 'album')):
+        return jsonify({'status': 'error', 'message': 'Invalid Spotify URL'}), 400
+    url = url.strip()
+
+    # The job runs in the background, the client follows it through /jobs/<id>.
+    # sync=true only downloads tracks added to a playlist since its last sync,
+    # prune=true also deletes the ones removed from it.
+    job_id = job_store.create(url, sync=bool(data.get('sync')), prune=bool(data.get('prune')))
+    return jsonify({'status': 'queued', 'job_id': job_id}), 202
+
+@app.route('/jobs')
+def list_jobs():
+    return jsonify({'jobs': job_store.recent()})
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    summary = job_store.summary(job_id)
+    if not summary:
+        return jsonify({'error': 'Job not found'}), 404
+    summary['items'] = [{
+        'index': row['idx'],
+        'name': row['name'],
+        'artist': row['artist'],
+        'status': row['status'],
+        'message': row['message'],
+        'filename': row['filename'],
+    } for row in job_store.tracks(job_id)]
+    return jsonify(summary)
+
+@app.route('/jobs/<job_id>/stream')
+def job_stream(job_id):
+    """Follow a job as NDJSON status lines (one per track state change) until it finishes"""
+    if not job_store.get(job_id):
+        return jsonify({'error': 'Job not found'}), 404
+
     def generate():
+        progress = JobProgress(job_store, job_id)
+        changed = threading.Event()
+        progress_bus.subscribe(job_id, changed.set)
         try:
-            if 'track' in url:
-                yield json.dumps({'status': 'processing', 'message': 'Fetching track info...'}) + '\n'
-                track = spotify.get_track_info(url)
-                if track:
-                    folder_name = track['artist']  # Use Artist name for single tracks
-                    yield json.dumps({'status': 'processing', 'message': f"Found: {track['name']} - {track['artist']}"}) + '\n'
-                    
-                    # Create search query for YouTube
-                    search_query = f"{track['name']} {track['artist']}"
-                    
-                    yield json.dumps({'status': 'processing', 'message': f"Searching YouTube for: {search_query}"}) + '\n'
-                    # Pass folder_name to organize by artist
-                    result = downloader.download_track(search_query, track, folder_name=folder_name)
-                    
-                    if result.get('status') == 'success':
-                        yield json.dumps({'status': 'completed', 'message': f"Downloaded: {track['name']}"}) + '\n'
-                    else:
-                        yield json.dumps({'status': 'error', 'message': result.get('message', 'Download failed')}) + '\n'
-                else:
-                    yield json.dumps({'status': 'error', 'message': 'Could not fetch track info'}) + '\n'
-            
-            elif 'playlist' in url:
-                yield json.dumps({'status': 'processing', 'message': 'Fetching playlist info...'}) + '\n'
-                # Get playlist name for folder organization
-                playlist_name = spotify.get_playlist_name(url)
-                tracks = spotify.get_playlist_tracks(url)
-                if tracks:
-                    yield json.dumps({'status': 'processing', 'message': f"Found playlist '{playlist_name}' with {len(tracks)} tracks"}) + '\n'
-                    
-                    for i, track in enumerate(tracks):
-                        search_query = f"{track['name']} {track['artist']}"
-                        yield json.dumps({'status': 'processing', 'message': f"Downloading {i+1}/{len(tracks)}: {track['name']}"}) + '\n'
-                        
-                        # Pass playlist_name as folder_name to organize tracks
-                        result = downloader.download_track(search_query, track, folder_name=playlist_name)
-                        
-                        if result.get('status') == 'success':
-                            yield json.dumps({'status': 'completed', 'message': f"Downloaded: {track['name']}"}) + '\n'
-                        else:
-                            yield json.dumps({'status': 'error', 'message': f"Failed: {track['name']} - {result.get('message', 'Unknown error')}"}) + '\n'
-                else:
-                    yield json.dumps({'status': 'error', 'message': 'Could not fetch playlist info'}) + '\n'
-
-            elif 'album' in url:
-                yield json.dumps({'status': 'processing', 'message': 'Fetching album info...'}) + '\n'
-                album_name = spotify.get_album_name(url)
-                tracks = spotify.get_album_tracks(url)
-                if tracks:
-                    yield json.dumps({'status': 'processing', 'message': f"Found album '{album_name}' with {len(tracks)} tracks"}) + '\n'
-                    
-                    for i, track in enumerate(tracks):
-                        search_query = f"{track['name']} {track['artist']}"
-                        yield json.dumps({'status': 'processing', 'message': f"Downloading {i+1}/{len(tracks)}: {track['name']}"}) + '\n'
-                        
-                        result = downloader.download_track(search_query, track, folder_name=album_name)
-                        
-                        if result.get('status') == 'success':
-                            yield json.dumps({'status': 'completed', 'message': f"Downloaded: {track['name']}"}) + '\n'
-                        else:
-                            yield json.dumps({'status': 'error', 'message': f"Failed: {track['name']} - {result.get('message', 'Unknown error')}"}) + '\n'
-                else:
-                    yield json.dumps({'status': 'error', 'message': 'Could not fetch album info'}) + '\n'
-            
-            else:
-                 yield json.dumps({'status': 'error', 'message': 'Invalid Spotify URL'}) + '\n'
-
-        except Exception as e:
-            logging.error(f"Error in download stream: {e}", exc_info=True)
-            yield json.dumps({'status': 'error', 'message': str(e)}) + '\n'
+            yield progress.first()
+            while True:
+                changed.clear()
+                yield from progress.poll()
+                if progress.finished:
+                    return
+                changed.wait(PROGRESS_POLL_INTERVAL)
+        finally:
+            progress_bus.unsubscribe(job_id, changed.set)
 
     return Response(stream_with_context(generate()), mimetype='application/json')
 
 if __name__ == '__main__':
+    STREAMING_RESPONSES = True
     app.run(debug=True, threaded=True)
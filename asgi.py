@@ -0,0 +1,271 @@
+"""ASGI entry point: long-lived connections on one event loop, everything else through Flask.
+
+Job progress streams, library events, audio (/play, /download) and ZIP
+exports are served natively, so an idle stream or a paused player costs a coroutine
+instead of a worker thread. Every other route runs the Flask app on a small thread pool.
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+"""
+import asyncio
+import os
+import re
+
+from a2wsgi import WSGIMiddleware
+from werkzeug.datastructures import Headers
+from werkzeug.utils import safe_join
+
+import app as flask_module
+from audio_stream import CHUNK_SIZE, prepare_audio
+from zip_stream import ZipStream, folder_files, prepare_zip
+from progress_bus import JobProgress
+
+import logging
+
+# Threads running the Flask routes that are not served natively
+WSGI_WORKERS = int(os.getenv('WSGI_WORKERS', '8'))
+
+JOB_STREAM = re.compile(r'^/jobs/([^/]+)/stream$')
+LIBRARY_EVENTS = '/library/events'
+AUDIO = re.compile(r'^/(play|download)/(.+)$')
+EXPORT = re.compile(r'^/export/(.+)$')
+
+
+async def _send_json(send, status, body):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def _watch_disconnect(receive, on_disconnect=None):
+    """Start a task that sets the returned event once the client has gone away.
+
+    Sending to a closed connection does not raise, so long streams check it
+    to stop early instead of running until the job or file ends.
+    """
+    gone = asyncio.Event()
+
+    async def watch():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        gone.set()
+        if on_disconnect:
+            on_disconnect()
+
+    return gone, asyncio.create_task(watch())
+
+
+async def job_stream(job_id, receive, send):
+    """Async version of app.job_stream: waits on the progress bus instead of holding a thread"""
+    store = flask_module.job_store
+    bus = flask_module.progress_bus
+    if not await asyncio.to_thread(store.get, job_id):
+        await _send_json(send, 404, b'{"error": "Job not found"}')
+        return
+
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+
+    def notify():
+        # Published from the job runner threads
+        loop.call_soon_threadsafe(changed.set)
+
+    progress = JobProgress(store, job_id)
+    gone, watcher = _watch_disconnect(receive, changed.set)
+    bus.subscribe(job_id, notify)
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body', 'body': progress.first().encode(), 'more_body': True})
+        while True:
+            changed.clear()
+            lines = await asyncio.to_thread(progress.poll)
+            if lines:
+                await send({'type': 'http.response.body', 'body': ''.join(lines).encode(),
+                            'more_body': not progress.finished})
+            if progress.finished or gone.is_set():
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), flask_module.PROGRESS_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        bus.unsubscribe(job_id, notify)
+        watcher.cancel()
+
+
+async def library_events(scope, receive, send):
+    """Async version of app.library_events: waits on the library feed instead of holding a thread"""
+    feed = flask_module.library_feed
+    last_id = feed.last_id
+    for name, value in scope['headers']:
+        if name == b'last-event-id' and value.isdigit():
+            last_id = int(value)
+
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+
+    def notify():
+        # Published from the watcher, job runner and request threads
+        loop.call_soon_threadsafe(changed.set)
+
+    gone, watcher = _watch_disconnect(receive, changed.set)
+    feed.subscribe(notify)
+    try:
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        await send({'type': 'http.response.body', 'body': f"retry: 3000\nid: {last_id}\n\n".encode(),
+                    'more_body': True})
+        # Ends after LIBRARY_STREAM_SECONDS like the Flask version; the browser reconnects
+        deadline = loop.time() + flask_module.LIBRARY_STREAM_SECONDS
+        while not gone.is_set() and loop.time() < deadline:
+            changed.clear()
+            messages = feed.since(last_id)
+            for message_id, message in messages:
+                last_id = message_id
+            body = ''.join(feed.event(i, message) for i, message in messages) or ': keepalive\n\n'
+            await send({'type': 'http.response.body', 'body': body.encode(), 'more_body': True})
+            try:
+                await asyncio.wait_for(changed.wait(), min(15, max(0, deadline - loop.time())))
+            except asyncio.TimeoutError:
+                pass
+        if not gone.is_set():
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        feed.unsubscribe(notify)
+        watcher.cancel()
+
+
+def _read(f, length):
+    return f.read(min(CHUNK_SIZE, length))
+
+
+async def audio(kind, filename, scope, receive, send):
+    """Async version of /play and /download: same validation and byte ranges as audio_stream.send_audio"""
+    path = safe_join(flask_module.DOWNLOAD_PATH, filename)
+    if not path or not os.path.isfile(path):
+        await _send_json(send, 404, b'{"error": "File not found"}')
+        return
+
+    request_headers = Headers([(name.decode('latin-1'), value.decode('latin-1'))
+                               for name, value in scope['headers']])
+    if kind == 'play':
+        options = {'max_age': 31536000}
+    else:
+        options = {'as_attachment': True, 'download_name': os.path.basename(filename)}
+    status, headers, body = await asyncio.to_thread(prepare_audio, path, scope['method'], request_headers,
+                                                    **options)
+    if status in (200, 206):
+        await asyncio.to_thread(flask_module.record_access, filename, scope['method'], request_headers,
+                                play=kind == 'play')
+
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in headers.items()]})
+    if not body:
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    gone, watcher = _watch_disconnect(receive)
+    try:
+        await _send_file(path, body, gone, send)
+    finally:
+        watcher.cancel()
+
+
+async def _send_file(path, body, gone, send):
+    with open(path, 'rb') as f:
+        for part in body:
+            if isinstance(part, bytes):
+                await send({'type': 'http.response.body', 'body': part, 'more_body': True})
+                continue
+            start, length = part
+            f.seek(start)
+            while length > 0 and not gone.is_set():
+                # Disk reads go to a thread, send() waits while the client is slow
+                chunk = await asyncio.to_thread(_read, f, length)
+                if not chunk:
+                    break
+                length -= len(chunk)
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def export(folder, scope, receive, send):
+    """Async version of app.export_folder: the ZIP is produced in a thread, one chunk at a time"""
+    download_path = flask_module.DOWNLOAD_PATH
+    files = None
+    if safe_join(download_path, folder):
+        files = await asyncio.to_thread(folder_files, download_path, folder)
+    if not files:
+        await _send_json(send, 404, b'{"error": "Folder not found"}')
+        return
+    archive = await asyncio.to_thread(ZipStream, files)
+
+    request_headers = Headers([(name.decode('latin-1'), value.decode('latin-1'))
+                               for name, value in scope['headers']])
+    status, headers, body = prepare_zip(archive, scope['method'], request_headers,
+                                        f"{folder.rstrip('/').rsplit('/', 1)[-1]}.zip")
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in headers.items()]})
+    gone, watcher = _watch_disconnect(receive)
+    try:
+        for part in body or ():
+            if isinstance(part, bytes):
+                await send({'type': 'http.response.body', 'body': part, 'more_body': True})
+                continue
+            chunks = archive.read(*part)
+            while not gone.is_set():
+                # Header CRCs and file reads happen in the generator: keep them off the event loop
+                chunk = await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        watcher.cancel()
+
+
+wsgi = WSGIMiddleware(flask_module.app, workers=WSGI_WORKERS)
+# Streams are served natively above, each open one costs a coroutine
+flask_module.STREAMING_RESPONSES = True
+
+
+async def lifespan(receive, send):
+    # Nothing to set up: the services start when app.py is imported
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+        path = scope['path']
+        match = JOB_STREAM.match(path)
+        if match:
+            return await job_stream(match.group(1), receive, send)
+        if path == LIBRARY_EVENTS:
+            return await library_events(scope, receive, send)
+        match = AUDIO.match(path)
+        if match:
+            try:
+                return await audio(match.group(1), match.group(2), scope, receive, send)
+            except OSError as e:
+                # Client went away or the file disappeared mid-stream
+                logging.info(f"Audio stream {path} ended: {e}")
+                return
+        match = EXPORT.match(path)
+        if match:
+            try:
+                return await export(match.group(1), scope, receive, send)
+            except OSError as e:
+                logging.info(f"Export {path} ended: {e}")
+                return
+    return await wsgi(scope, receive, send)
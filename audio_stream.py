@@ -0,0 +1,217 @@
+import mimetypes
+import os
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+
+from flask import Response, request, abort
+from werkzeug.utils import safe_join
+
+from library_index import etag
+
+# Not known to every platform's mimetypes table
+mimetypes.add_type('audio/mp4', '.m4a')
+mimetypes.add_type('audio/ogg', '.opus')
+
+CHUNK_SIZE = 64 * 1024
+# Requests asking for more ranges than this get the whole file instead
+MAX_RANGES = 8
+
+
+def file_etag(st):
+    """Strong ETag derived from size and mtime, computed without reading the file.
+
+    Same value as the library index lists for the track.
+    """
+    return etag(st.st_size, st.st_mtime)
+
+
+def _parse_ranges(header, size):
+    """Parse a 'bytes=' Range header into [(start, end_inclusive)].
+
+    Returns None when the header should be ignored (malformed or too many
+    ranges) and [] when no range is satisfiable.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    ranges = []
+    specs = header[6:].split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    for spec in specs:
+        spec = spec.strip()
+        if '-' not in spec:
+            return None
+        first, last = spec.split('-', 1)
+        try:
+            if first == '':
+                # Suffix range: the last N bytes
+                length = int(last)
+                if length <= 0:
+                    continue
+                start, end = max(size - length, 0), size - 1
+            else:
+                start = int(first)
+                end = int(last) if last else start
+                if end < start:
+                    return None
+                end = size - 1 if not last else min(end, size - 1)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, end))
+    return ranges
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _file_body(path, start, length, whole):
+    """Body for a byte span of a file, handed to the server's sendfile when it can do it.
+
+    gunicorn's file_wrapper sends from the current file offset and stops at
+    Content-Length, so ranges are zero-copy there. Other servers read to EOF,
+    so they only get the wrapper for the whole file.
+    """
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    server = request.environ.get('SERVER_SOFTWARE', '')
+    if file_wrapper and (whole or server.startswith('gunicorn')):
+        f = open(path, 'rb')
+        f.seek(start)
+        return file_wrapper(f, CHUNK_SIZE)
+    return _read_range(path, start, length)
+
+
+def _not_modified(headers, etag, mtime):
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match:
+        return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _range_applies(headers, etag, mtime):
+    """If-Range: only honour the Range header when the client's copy is still current"""
+    if_range = headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    try:
+        return int(mtime) <= parsedate_to_datetime(if_range).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def prepare_ranges(size, etag, mtime, mimetype, method, request_headers, headers):
+    """Conditional GET and byte range handling for a body of `size` bytes.
+
+    Adds the validators to headers and returns (status, headers, body) as
+    prepare_audio does, with (start, length) spans relative to the body.
+    Shared by audio files and ZIP exports.
+    """
+    headers.update({
+        'ETag': etag,
+        'Last-Modified': formatdate(mtime, usegmt=True),
+        'Accept-Ranges': 'bytes',
+    })
+    if _not_modified(request_headers, etag, mtime):
+        return 304, headers, None
+
+    ranges = None
+    if method in ('GET', 'HEAD') and _range_applies(request_headers, etag, mtime):
+        ranges = _parse_ranges(request_headers.get('Range'), size)
+
+    if ranges == []:
+        headers['Content-Range'] = f'bytes */{size}'
+        return 416, headers, None
+
+    if not ranges:
+        status = 200
+        headers['Content-Type'] = mimetype
+        headers['Content-Length'] = str(size)
+        body = [(0, size)]
+    elif len(ranges) == 1:
+        status = 206
+        start, end = ranges[0]
+        headers['Content-Type'] = mimetype
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        headers['Content-Length'] = str(end - start + 1)
+        body = [(start, end - start + 1)]
+    else:
+        # Several ranges at once: multipart/byteranges
+        status = 206
+        boundary = uuid.uuid4().hex
+        body = []
+        for start, end in ranges:
+            body.append((f'\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n'
+                         f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode())
+            body.append((start, end - start + 1))
+        body.append(f'\r\n--{boundary}--\r\n'.encode())
+        headers['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+        headers['Content-Length'] = str(sum(len(part) if isinstance(part, bytes) else part[1] for part in body))
+
+    return status, headers, None if method == 'HEAD' else body
+
+
+def attachment(name):
+    """Content-Disposition value for a download, safe for non-ASCII names"""
+    return f"attachment; filename*=UTF-8''{quote(name, safe='')}"
+
+
+def prepare_audio(path, method, request_headers, as_attachment=False, download_name=None, mimetype=None,
+                  max_age=None):
+    """Work out the response to a request for an audio file, independent of the server.
+
+    Returns (status, headers, body) where body is a list of bytes (multipart
+    boundaries) and (start, length) file spans, or None when no body is sent.
+    Used by send_audio (Flask/WSGI) and by the ASGI app.
+    """
+    st = os.stat(path)
+    mimetype = mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    headers = {}
+    if max_age is not None:
+        headers['Cache-Control'] = f'public, max-age={max_age}'
+    if as_attachment:
+        headers['Content-Disposition'] = attachment(download_name or os.path.basename(path))
+    return prepare_ranges(st.st_size, file_etag(st), st.st_mtime, mimetype, method, request_headers, headers)
+
+
+def send_audio(directory, filename, as_attachment=False, download_name=None, mimetype=None, max_age=None):
+    """Serve a file with ETag/Last-Modified validation and single or multiple byte ranges"""
+    path = safe_join(directory, filename)
+    if not path or not os.path.isfile(path):
+        abort(404)
+
+    status, headers, body = prepare_audio(path, request.method, request.headers, as_attachment=as_attachment,
+                                          download_name=download_name, mimetype=mimetype, max_age=max_age)
+    if body is None:
+        body = []
+    elif len(body) == 1:
+        start, length = body[0]
+        body = _file_body(path, start, length, whole=status == 200)
+    else:
+        parts = body
+
+        def multipart():
+            for part in parts:
+                if isinstance(part, bytes):
+                    yield part
+                else:
+                    yield from _read_range(path, *part)
+        body = multipart()
+    return Response(body, status=status, headers=headers, direct_passthrough=True)
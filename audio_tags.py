@@ -0,0 +1,85 @@
+import base64
+
+import logging
+
+# Containers the library understands: MP3 (ID3), M4A (MP4 atoms), Opus/Ogg (Vorbis comments)
+AUDIO_EXTENSIONS = ('.mp3', '.m4a', '.opus', '.ogg')
+
+# Tag names per tag format
+ID3_FRAMES = {'title': 'TIT2', 'artist': 'TPE1', 'album': 'TALB'}
+MP4_ATOMS = {'title': '\xa9nam', 'artist': '\xa9ART', 'album': '\xa9alb'}
+VORBIS_KEYS = {'title': 'title', 'artist': 'artist', 'album': 'album'}
+
+
+def _first(value):
+    if isinstance(value, list):
+        value = value[0] if value else None
+    if value is None:
+        return None
+    if hasattr(value, 'text'):
+        return _first(value.text)
+    return str(value)
+
+
+def _cover(audio):
+    """Return (data, mime) of the embedded front cover, or None"""
+    from mutagen.id3 import APIC
+    from mutagen.mp4 import MP4Cover
+
+    tags = audio.tags
+    if tags is None:
+        return None
+
+    # ID3 (MP3)
+    if hasattr(tags, 'getall'):
+        for frame in tags.getall('APIC'):
+            if isinstance(frame, APIC):
+                return frame.data, frame.mime
+        return None
+
+    # MP4 (M4A)
+    if 'covr' in tags:
+        for cover in tags['covr']:
+            mime = 'image/png' if cover.imageformat == MP4Cover.FORMAT_PNG else 'image/jpeg'
+            return bytes(cover), mime
+        return None
+
+    # Vorbis comments (Opus/Ogg): base64 FLAC picture blocks
+    pictures = tags.get('metadata_block_picture') if hasattr(tags, 'get') else None
+    if pictures:
+        from mutagen.flac import Picture
+        try:
+            picture = Picture(base64.b64decode(pictures[0]))
+            return picture.data, picture.mime or 'image/jpeg'
+        except Exception as e:
+            logging.debug(f"Invalid embedded picture: {e}")
+    return None
+
+
+def read_tags(path, with_cover=False):
+    """Read title/artist/album/duration (and optionally the cover) of any supported file in one open.
+
+    Returns a dict with keys title, artist, album, duration and cover
+    ((data, mime) or None). Missing tags are None. Raises on unreadable files.
+    """
+    import mutagen
+    from mutagen.mp4 import MP4
+
+    audio = mutagen.File(path)
+    if audio is None:
+        raise ValueError(f"Unsupported audio file: {path}")
+
+    tags = audio.tags
+    if tags is not None and hasattr(tags, 'getall'):
+        names = ID3_FRAMES
+    elif isinstance(audio, MP4):
+        names = MP4_ATOMS
+    else:
+        names = VORBIS_KEYS
+
+    result = {'duration': getattr(audio.info, 'length', 0) or 0, 'cover': None}
+    for field, name in names.items():
+        result[field] = _first(tags.get(name)) if tags is not None and hasattr(tags, 'get') else None
+    if with_cover:
+        result['cover'] = _cover(audio)
+    return result
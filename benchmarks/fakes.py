@@ -0,0 +1,152 @@
+"""Offline stand-ins for spotipy.Spotify and yt_dlp.YoutubeDL.
+
+They implement only what SpotifyService and Downloader call, answer after a
+configurable delay and never touch the network. Downloads are synthetic
+MP3 files written with the same ID3 tags a real download gets.
+"""
+import os
+import threading
+import time
+
+from synthetic_library import write_mp3
+
+# Spotify IDs are 22 base62 characters
+ID_WIDTH = 22
+
+
+def fake_id(prefix, number):
+    return f'{prefix}{number}'.rjust(ID_WIDTH, '0')
+
+
+class FakeSpotify:
+    """Serves generated playlists and albums.
+
+    A collection ID is `<tracks>x<tag>` zero-padded to 22 characters, so
+    `collection_id(200, 'a')` is a playlist or album of 200 tracks. Use a new
+    tag to get tracks that were never downloaded before.
+    """
+
+    def __init__(self, latency=0.0, page_size=100):
+        self.latency = latency
+        self.page_size = page_size
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _wait(self):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def _key(spotify_id):
+        return spotify_id.lstrip('0')
+
+    @staticmethod
+    def _track(key, index):
+        track_id = fake_id('t', f'{key}x{index}')
+        return {
+            'id': track_id,
+            'name': f'Track {index} of {key}',
+            'artists': [{'name': f'Artist {index % 50}'}],
+            'album': {'name': f'Album {index % 20}', 'images': []},
+            'external_urls': {'spotify': f'https://open.spotify.com/track/{track_id}'},
+            'external_ids': {'isrc': f'BENCH{key}x{index}'},
+        }
+
+    def _page(self, key, offset, limit, kind):
+        total = int(key.split('x')[0])
+        tracks = [self._track(key, i) for i in range(offset, min(offset + limit, total))]
+        items = tracks if kind == 'album' else [{'track': track} for track in tracks]
+        next_url = f'{kind}:{key}:{offset + limit}:{limit}' if offset + limit < total else None
+        return {'items': items, 'next': next_url, 'total': total}
+
+    def playlist(self, playlist_id, fields=None, **kwargs):
+        self._wait()
+        key = self._key(playlist_id)
+        return {
+            'name': f'Playlist {key}',
+            'snapshot_id': 'snapshot-1',
+            'tracks': self._page(key, 0, self.page_size, 'playlist'),
+        }
+
+    def playlist_items(self, playlist_id, fields=None, limit=100, offset=0, **kwargs):
+        self._wait()
+        return self._page(self._key(playlist_id), offset, limit, 'playlist')
+
+    def album(self, album_id, **kwargs):
+        self._wait()
+        key = self._key(album_id)
+        return {'name': f'Album {key}', 'images': [], 'tracks': self._page(key, 0, 50, 'album')}
+
+    def next(self, result):
+        self._wait()
+        kind, key, offset, limit = result['next'].split(':')
+        return self._page(key, int(offset), int(limit), kind)
+
+    def _lookup(self, track_id):
+        key, index = track_id.lstrip('0').lstrip('t').rsplit('x', 1)
+        return self._track(key, int(index))
+
+    def track(self, track_id, **kwargs):
+        self._wait()
+        return self._lookup(track_id)
+
+    def tracks(self, track_ids, **kwargs):
+        self._wait()
+        return {'tracks': [self._lookup(track_id) for track_id in track_ids]}
+
+
+def collection_id(tracks, tag):
+    return fake_id('', f'{tracks}x{tag}')
+
+
+class FakeYoutubeDL:
+    """Drop-in for yt_dlp.YoutubeDL as used by Downloader: search, download and post-process"""
+
+    # Class-level so every instance the Downloader creates uses the same settings
+    search_latency = 0.0
+    download_latency = 0.0
+    transcode_latency = 0.0
+    audio_bytes = 256 * 1024
+
+    def __init__(self, params=None):
+        self.params = dict(params or {})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def _info(self, video_id, title):
+        return {'id': video_id, 'title': title, 'ext': 'mp3'}
+
+    def prepare_filename(self, info):
+        home = self.params.get('paths', {}).get('home', '.')
+        template = self.params.get('outtmpl', '%(title)s.%(ext)s')
+        if isinstance(template, dict):
+            template = template.get('default', '%(title)s.%(ext)s')
+        return os.path.join(home, template % info)
+
+    def extract_info(self, url, download=True, **kwargs):
+        if url.startswith('ytsearch1:'):
+            time.sleep(self.search_latency)
+            query = url[len('ytsearch1:'):]
+            return {'entries': [{'id': f'yt-{abs(hash(query)):x}', 'title': query}]}
+
+        time.sleep(self.download_latency)
+        video_id = url.rsplit('=', 1)[-1]
+        info = self._info(video_id, f'Video {video_id}')
+        if download:
+            path = self.prepare_filename(info)
+            write_mp3(path, title=info['title'], artist='YouTube', album='Downloads', size=self.audio_bytes)
+            info['requested_downloads'] = [dict(info, filepath=path)]
+        return info
+
+    def post_process(self, filename, info, files_to_move=None):
+        time.sleep(self.transcode_latency)
+        return dict(info, filepath=filename)
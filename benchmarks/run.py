@@ -0,0 +1,226 @@
+"""Offline benchmark suite: playlist job throughput, /stats latency, /cover throughput.
+
+Spotify and YouTube are replaced by the fakes in benchmarks/fakes.py, the
+library by synthetic MP3 files, and everything runs in a scratch directory
+through the Flask test client. Results are compared with a stored baseline
+and the run fails when a metric got worse by more than the tolerance.
+
+    python benchmarks/run.py                      # compare with benchmarks/baseline.json
+    python benchmarks/run.py --update-baseline    # store this run as the new baseline
+    python benchmarks/run.py --sizes 1000 --playlist-tracks 50   # quick run
+
+Baselines are machine specific: refresh them when moving to other hardware.
+A baseline file keeps one entry per workload (library sizes, playlist size,
+fake latencies...); a run is only compared with the entry stored with the
+same arguments, and --update-baseline replaces that entry only.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import yt_dlp  # noqa: E402
+
+from fakes import FakeSpotify, FakeYoutubeDL, collection_id  # noqa: E402
+from synthetic_library import generate  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+# Arguments that change what is measured; the rest only say where results go
+OUTPUT_ARGS = ('baseline', 'update_baseline', 'tolerance', 'workdir', 'keep')
+
+
+def workload(args):
+    """The arguments a baseline entry must match to be comparable with this run"""
+    return {name: value for name, value in sorted(vars(args).items()) if name not in OUTPUT_ARGS}
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)['runs']
+
+
+def load_app(workdir, args):
+    """Import app.py inside workdir with the fakes in place of Spotify and yt-dlp"""
+    os.chdir(workdir)
+    os.environ.setdefault('SPOTIPY_CLIENT_ID', 'benchmark')
+    os.environ.setdefault('SPOTIPY_CLIENT_SECRET', 'benchmark')
+    os.environ['TIMING_LOG'] = '0'
+    # /stats is measured scanning the library itself, not reading an index kept by the watcher
+    os.environ['LIBRARY_WATCH'] = 'off'
+    # The fakes never throttle: measure the pipeline, not the configured request rates
+    os.environ.setdefault('SPOTIFY_RATE_LIMIT', '1000')
+    os.environ.setdefault('YOUTUBE_RATE_LIMIT', '1000')
+    os.environ['COVER_CACHE_DIR'] = os.path.join(workdir, 'data', 'covers')
+
+    FakeYoutubeDL.search_latency = args.search_latency
+    FakeYoutubeDL.download_latency = args.download_latency
+    FakeYoutubeDL.transcode_latency = args.transcode_latency
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+
+    import app
+    logging.getLogger().setLevel(logging.WARNING)
+    app.job_runner.spotify.sp = FakeSpotify(latency=args.spotify_latency)
+    # Pick up queued jobs right away so claim polling does not dominate short runs
+    app.job_runner.poll_interval = 0.05
+    return app
+
+
+def bench_playlist_jobs(app, client, tracks, jobs):
+    """Tracks per second through POST /download until every job is done"""
+    start = time.perf_counter()
+    for job in range(jobs):
+        url = f'https://open.spotify.com/playlist/{collection_id(tracks, f"{os.getpid()}{job}")}'
+        response = client.post('/download', json={'url': url})
+        job_id = response.get_json()['job_id']
+        while True:
+            status = client.get(f'/jobs/{job_id}').get_json()
+            if status['status'] in ('done', 'failed'):
+                break
+            time.sleep(0.02)
+        if status['tracks']['done'] != tracks:
+            raise RuntimeError(f"Playlist job finished with {status['tracks']}: {status['message']}")
+    return tracks * jobs / (time.perf_counter() - start)
+
+
+def timed_get(client, url):
+    start = time.perf_counter()
+    response = client.get(url)
+    elapsed = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError(f'{url} returned {response.status_code}')
+    return elapsed
+
+
+def bench_stats(client, download_path, size, repeat):
+    """(cold, warm) /stats seconds for a library of `size` tracks: first scan, then median of repeats"""
+    generate(download_path, size)
+    cold = timed_get(client, '/stats')
+    warm = statistics.median(timed_get(client, '/stats') for _ in range(repeat))
+    return cold, warm
+
+
+def bench_covers(client, paths, requests):
+    """(cold, warm) /cover requests per second: first request per file extracts the cover"""
+    sample = random.Random(1).sample(paths, min(requests, len(paths)))
+    results = []
+    for _ in range(2):
+        start = time.perf_counter()
+        for path in sample:
+            timed_get(client, f'/cover/{path}?size=128')
+        results.append(len(sample) / (time.perf_counter() - start))
+    return tuple(results)
+
+
+def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix='sopotify-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    app = load_app(workdir, args)
+    client = app.app.test_client()
+    results = {}
+
+    for size in args.sizes:
+        cold, warm = bench_stats(client, app.DOWNLOAD_PATH, size, args.repeat)
+        results[f'stats_{size}_cold_seconds'] = cold
+        results[f'stats_{size}_warm_seconds'] = warm
+        print(f'/stats with {size} tracks: first scan {cold:.3f}s, then {warm:.3f}s')
+
+    paths = [track['path'] for track in app.library_index.tracks()]
+    cold, warm = bench_covers(client, paths, args.cover_requests)
+    results['cover_cold_per_second'] = cold
+    results['cover_warm_per_second'] = warm
+    print(f'/cover: {cold:.0f} req/s uncached, {warm:.0f} req/s cached')
+
+    throughput = bench_playlist_jobs(app, client, args.playlist_tracks, args.jobs)
+    results['playlist_tracks_per_second'] = throughput
+    print(f'Playlist jobs: {throughput:.1f} tracks/s')
+
+    app.job_runner.stop()
+    if not args.workdir and not args.keep:
+        os.chdir(BENCH_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return the metrics that regressed: *_seconds must not grow, *_per_second must not drop"""
+    regressions = []
+    for name, value in sorted(results.items()):
+        expected = baseline.get(name)
+        if expected is None:
+            print(f'  {name}: {value:.4g} (no baseline)')
+            continue
+        if name.endswith('_per_second'):
+            worse = value < expected * (1 - tolerance)
+        else:
+            worse = value > expected * (1 + tolerance)
+        change = (value - expected) / expected * 100 if expected else 0
+        print(f"  {name}: {value:.4g} vs {expected:.4g} ({change:+.0f}%){' REGRESSION' if worse else ''}")
+        if worse:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')],
+                        default=[1000, 10000, 50000], help='library sizes for /stats (comma separated)')
+    parser.add_argument('--repeat', type=int, default=5, help='warm /stats requests per size')
+    parser.add_argument('--cover-requests', type=int, default=500)
+    parser.add_argument('--playlist-tracks', type=int, default=200)
+    parser.add_argument('--jobs', type=int, default=2, help='playlist jobs to run one after another')
+    parser.add_argument('--spotify-latency', type=float, default=0.02, help='seconds per fake Spotify call')
+    parser.add_argument('--search-latency', type=float, default=0.02, help='seconds per fake YouTube search')
+    parser.add_argument('--download-latency', type=float, default=0.05, help='seconds per fake download')
+    parser.add_argument('--transcode-latency', type=float, default=0.02, help='seconds per fake conversion')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--update-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed relative change before failing')
+    parser.add_argument('--workdir', help='reuse this directory (keeps the generated library between runs)')
+    parser.add_argument('--keep', action='store_true', help='do not delete the scratch directory')
+    args = parser.parse_args()
+
+    results = run(args)
+    baselines = load_baselines(args.baseline)
+    entry = next((entry for entry in baselines if entry['args'] == workload(args)), None)
+
+    if args.update_baseline:
+        if entry:
+            baselines.remove(entry)
+        baselines.append({'args': workload(args), 'results': results})
+        with open(args.baseline, 'w') as f:
+            json.dump({'runs': baselines}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f'Baseline written to {args.baseline}')
+        return 0
+
+    if not baselines:
+        print('No baseline yet, run with --update-baseline to store one')
+        return 0
+    if entry is None:
+        # Numbers from another workload would pass or fail for the wrong reasons
+        print(f'No baseline in {args.baseline} was run with these arguments, not comparing. Stored:')
+        for other in baselines:
+            print(f"  {' '.join(f'{name}={value}' for name, value in other['args'].items())}")
+        print('Run with --update-baseline to store one for these arguments')
+        return 2
+    print(f'Compared with {args.baseline} (tolerance {args.tolerance:.0%}):')
+    regressions = compare(results, entry['results'], args.tolerance)
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
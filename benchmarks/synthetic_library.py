@@ -0,0 +1,58 @@
+"""Generate a library of small but valid MP3 files with ID3 tags and cover art.
+
+    python benchmarks/synthetic_library.py <downloads dir> <tracks>
+"""
+import os
+import struct
+import sys
+import zlib
+
+from mutagen.id3 import ID3, TIT2, TPE1, TALB, APIC
+
+# One MPEG-1 Layer III frame (128 kbps, 44.1 kHz) of silence: header + 413 bytes
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+
+TRACKS_PER_FOLDER = 200
+TRACKS_PER_ALBUM = 12
+
+
+def png(width, height, rgb):
+    """A solid colour PNG, built without Pillow"""
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    row = b'\x00' + bytes(rgb) * width
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(row * height))
+            + chunk(b'IEND', b''))
+
+
+def write_mp3(path, title, artist, album, size=4 * 1024, cover=None):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(MP3_FRAME * max(1, size // len(MP3_FRAME)))
+    tags = ID3()
+    tags.add(TIT2(encoding=3, text=title))
+    tags.add(TPE1(encoding=3, text=artist))
+    tags.add(TALB(encoding=3, text=album))
+    if cover:
+        tags.add(APIC(encoding=3, mime='image/png', type=3, desc='Cover', data=cover))
+    tags.save(path)
+
+
+def generate(download_path, count, start=0, size=4 * 1024, cover_size=640):
+    """Write tracks start..count-1 (existing ones are kept), grouped in folders and albums"""
+    covers = {}
+    for i in range(start, count):
+        album = i // TRACKS_PER_ALBUM
+        path = os.path.join(download_path, f'Folder {i // TRACKS_PER_FOLDER:03d}', f'Track {i:06d}.mp3')
+        if os.path.exists(path):
+            continue
+        if album not in covers:
+            covers = {album: png(cover_size, cover_size, (album % 256, (album * 7) % 256, (album * 13) % 256))}
+        write_mp3(path, title=f'Track {i}', artist=f'Artist {album % 400}', album=f'Album {album}',
+                  size=size, cover=covers[album])
+
+
+if __name__ == '__main__':
+    generate(sys.argv[1], int(sys.argv[2]))
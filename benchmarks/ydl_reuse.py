@@ -0,0 +1,78 @@
+"""Per-track overhead of a fresh YoutubeDL per track vs. one reused instance.
+
+Uses a stub extractor that answers without any network access, so only
+the cost of setting up yt-dlp (extractors, postprocessors, HTTP session)
+is measured. Run from the repository root:
+
+    python benchmarks/ydl_reuse.py [tracks]
+"""
+import sys
+import time
+
+import yt_dlp
+from yt_dlp.extractor.common import InfoExtractor
+
+
+class StubIE(InfoExtractor):
+    _VALID_URL = r'stub:(?P<id>.+)'
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        return {
+            'id': video_id,
+            'title': f'Track {video_id}',
+            'url': f'http://127.0.0.1/{video_id}.m4a',
+            'ext': 'm4a',
+            'acodec': 'mp4a.40.2',
+            'vcodec': 'none',
+        }
+
+
+OPTS = {
+    'format': 'bestaudio/best',
+    'quiet': True,
+    'no_warnings': True,
+    'noprogress': True,
+    'postprocessors': [
+        {'key': 'FFmpegExtractAudio', 'preferredcodec': 'mp3', 'preferredquality': '192'},
+        {'key': 'FFmpegMetadata', 'add_metadata': True},
+        {'key': 'EmbedThumbnail'},
+    ],
+}
+
+
+def extract(ydl, track):
+    return ydl.extract_info(f'stub:{track}', download=False, ie_key='Stub')
+
+
+def fresh(tracks):
+    """Before: a new YoutubeDL for every track"""
+    for track in range(tracks):
+        with yt_dlp.YoutubeDL(OPTS) as ydl:
+            ydl.add_info_extractor(StubIE())
+            extract(ydl, track)
+
+
+def reused(tracks):
+    """After: one long-lived YoutubeDL per worker"""
+    with yt_dlp.YoutubeDL(OPTS) as ydl:
+        ydl.add_info_extractor(StubIE())
+        for track in range(tracks):
+            extract(ydl, track)
+
+
+def measure(fn, tracks):
+    start = time.perf_counter()
+    fn(tracks)
+    return (time.perf_counter() - start) / tracks * 1000
+
+
+if __name__ == '__main__':
+    tracks = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    reused(1)  # Import extractors once so both runs start warm
+    before = measure(fresh, tracks)
+    after = measure(reused, tracks)
+    print(f'{tracks} tracks')
+    print(f'fresh YoutubeDL per track: {before:8.2f} ms/track')
+    print(f'reused YoutubeDL:          {after:8.2f} ms/track')
+    print(f'speedup:                   {before / after:8.1f}x')
@@ -0,0 +1,103 @@
+import hashlib
+import io
+import os
+
+import logging
+
+from audio_tags import read_tags
+
+try:
+    from PIL import Image
+except ImportError:  # Thumbnails are optional, without Pillow only the original image is served
+    Image = None
+
+# Thumbnail widths that can be requested, anything else is snapped to the next one up
+THUMBNAIL_SIZES = (128, 300, 640)
+
+MIME_EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/jpg': '.jpg',
+    'image/png': '.png',
+}
+
+
+class CoverCache:
+    """Content-addressed on-disk store of embedded cover art and its thumbnails.
+
+    Covers are stored once per distinct image (keyed by SHA-1 of the bytes),
+    so every track of an album shares the same files.
+    """
+
+    def __init__(self, cache_dir='data/covers'):
+        # Absolute: Flask's send_file resolves relative paths against the app package, not the cwd
+        self.cache_dir = os.path.abspath(cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, digest, suffix):
+        return os.path.join(self.cache_dir, digest[:2], digest + suffix)
+
+    def store(self, data, mime='image/jpeg'):
+        """Save image bytes and return their digest"""
+        digest = hashlib.sha1(data).hexdigest()
+        path = self._path(digest, MIME_EXTENSIONS.get(mime, '.jpg'))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return digest
+
+    def extract(self, audio_path):
+        """Store the embedded cover of an audio file. Returns its digest or '' when there is none"""
+        try:
+            cover = read_tags(audio_path, with_cover=True)['cover']
+        except Exception as e:
+            logging.debug(f"Could not read tags of {audio_path}: {e}")
+            return ''
+        return self.store(*cover) if cover else ''
+
+    def original(self, digest):
+        """Return (path, mime) of the stored original, or (None, None)"""
+        for mime, ext in MIME_EXTENSIONS.items():
+            path = self._path(digest, ext)
+            if os.path.exists(path):
+                return path, mime
+        return None, None
+
+    @staticmethod
+    def snap_size(size):
+        """Map a requested width to one of THUMBNAIL_SIZES (None means original)"""
+        if not size:
+            return None
+        for allowed in THUMBNAIL_SIZES:
+            if size <= allowed:
+                return allowed
+        return None
+
+    def get(self, digest, size=None):
+        """Return (path, mime) for a cover at the given thumbnail size, creating it on first use"""
+        original, mime = self.original(digest)
+        if not original or size is None or Image is None:
+            return original, mime
+
+        path = self._path(digest, f"_{size}.jpg")
+        if os.path.exists(path):
+            return path, 'image/jpeg'
+
+        try:
+            with Image.open(original) as image:
+                if image.width <= size:
+                    return original, mime
+                image = image.convert('RGB')
+                image.thumbnail((size, size))
+                buffer = io.BytesIO()
+                image.save(buffer, 'JPEG', quality=85, optimize=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(buffer.getvalue())
+            os.replace(tmp_path, path)
+            return path, 'image/jpeg'
+        except Exception as e:
+            logging.warning(f"Could not create {size}px thumbnail for cover {digest}: {e}")
+            return original, mime
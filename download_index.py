@@ -0,0 +1,58 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+def track_keys(metadata):
+    """Identity keys of a Spotify track: its URL and, when known, its ISRC"""
+    keys = []
+    if metadata.get('url'):
+        keys.append(f"url:{metadata['url']}")
+    if metadata.get('isrc'):
+        keys.append(f"isrc:{metadata['isrc'].upper()}")
+    return keys
+
+
+class DownloadIndex:
+    """Maps Spotify track identities to files already downloaded under downloads/"""
+
+    def __init__(self, db_path='data/downloads.db'):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS downloads (
+                key TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                created REAL NOT NULL
+            )
+        ''')
+        self.conn.commit()
+
+    def lookup(self, keys):
+        """Return the first stored relative path for any of the keys, or None"""
+        if not keys:
+            return None
+        with self._lock:
+            row = self.conn.execute(
+                f"SELECT path FROM downloads WHERE key IN ({','.join('?' * len(keys))}) LIMIT 1",
+                keys).fetchone()
+        return row[0] if row else None
+
+    def add(self, keys, path):
+        now = time.time()
+        with self._lock:
+            self.conn.executemany('INSERT OR REPLACE INTO downloads (key, path, created) VALUES (?, ?, ?)',
+                                  [(key, path, now) for key in keys])
+            self.conn.commit()
+
+    def forget(self, path):
+        with self._lock:
+            self.conn.execute('DELETE FROM downloads WHERE path = ?', (path,))
+            self.conn.commit()
@@ -0,0 +1,47 @@
+from concurrent.futures import ThreadPoolExecutor
+import queue
+
+import logging
+
+
+def download_tracks(downloader, tracks, folder_name=None, workers=4):
+    """Download tracks on a bounded thread pool.
+
+    Yields ('started', index, track, None) when a worker picks a track up and
+    ('finished', index, track, result) when it is done, in completion order.
+    tracks may be a lazy iterable: at most workers * 2 of them are read ahead
+    of the downloads that finished. Closing the generator cancels the tracks
+    that have not started yet.
+    """
+    events = queue.Queue()
+
+    def work(index, track):
+        events.put(('started', index, track, None))
+        search_query = f"{track['name']} {track['artist']}"
+        try:
+            result = downloader.download_track(search_query, track, folder_name=folder_name)
+        except Exception as e:
+            logging.error(f"Unexpected error downloading {search_query}: {e}", exc_info=True)
+            result = {'status': 'error', 'message': str(e), 'query': search_query}
+        events.put(('finished', index, track, result))
+
+    workers = max(1, workers)
+    window = workers * 2
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download')
+    try:
+        pending = enumerate(tracks)
+        in_flight = 0
+        while True:
+            for index, track in pending:
+                pool.submit(work, index, track)
+                in_flight += 1
+                if in_flight >= window:
+                    break
+            if not in_flight:
+                return
+            event = events.get()
+            if event[0] == 'finished':
+                in_flight -= 1
+            yield event
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
@@ -1,36 +1,143 @@
 import yt_dlp
 import os
+import shutil
+import threading
 
 import logging
 
+from download_index import DownloadIndex, track_keys
+from metrics import STAGE_SECONDS, ACTIVE_DOWNLOADS, DOWNLOADED_BYTES
+from rate_limit import RateLimiter
+from resolve_cache import ResolveCache
+
+YOUTUBE_WATCH_URL = 'https://www.youtube.com/watch?v={}'
+
+# Output formats: the stream to prefer and the codec handed to FFmpegExtractAudio.
+# m4a and opus match what YouTube serves, so ffmpeg only remuxes (acodec copy) instead of re-encoding.
+AUDIO_FORMATS = {
+    'mp3': ('bestaudio/best', 'mp3'),
+    'm4a': ('bestaudio[ext=m4a]/bestaudio/best', 'm4a'),
+    'opus': ('bestaudio[acodec=opus]/bestaudio/best', 'opus'),
+}
+
+
+def throttle_delay(error):
+    """Retry-After (0 when unknown) if YouTube rate limited the request, None for any other error.
+
+    yt-dlp wraps the HTTP error: DownloadError.exc_info -> ExtractorError.cause -> HTTPError.
+    """
+    cause, seen = error, set()
+    while cause is not None and id(cause) not in seen:
+        seen.add(id(cause))
+        if getattr(cause, 'status', None) == 429:
+            headers = getattr(getattr(cause, 'response', None), 'headers', None) or {}
+            try:
+                return float(headers.get('Retry-After') or 0)
+            except ValueError:
+                return 0
+        exc_info = getattr(cause, 'exc_info', None)
+        cause = getattr(cause, 'cause', None) or (exc_info[1] if exc_info else None) or cause.__cause__
+    message = str(error)
+    if 'HTTP Error 429' in message or 'Too Many Requests' in message:
+        return 0
+    return None
+
+
 class Downloader:
-    def __init__(self, download_path='downloads'):
+    def __init__(self, download_path='downloads', index_path='data/downloads.db', library_index=None,
+                 resolve_path='data/resolve.db', audio_format='mp3', rate_limit=5, quota=None,
+                 index=None, resolve_cache=None):
+        if audio_format not in AUDIO_FORMATS:
+            raise ValueError(f"Unsupported audio format '{audio_format}', use one of {', '.join(AUDIO_FORMATS)}")
+        self.audio_format = audio_format
         self.download_path = download_path
         if not os.path.exists(download_path):
             os.makedirs(download_path)
+        # index and resolve_cache replace the SQLite files, e.g. with the Redis stores shared by every worker
+        self.index = index or DownloadIndex(index_path)
+        self.resolve_cache = resolve_cache or ResolveCache(resolve_path)
+        # Optional LibraryIndex kept up to date as files are written
+        self.library_index = library_index
+        # Optional StorageQuota: every download first makes room for itself within the budget
+        self.quota = quota
+        # YouTube searches and downloads per second across all workers, lowered automatically on 429s
+        self.limiter = RateLimiter('youtube', rate_limit)
+        # One long-lived YoutubeDL per thread and stage, see _ydl()
+        self._local = threading.local()
 
-    def download_track(self, query, metadata, folder_name=None):
-        """Download track with optional subfolder organization"""
-        # Determine download path
-        if folder_name:
-            # Sanitize folder name
-            import re
-            sanitized_folder = re.sub(r'[<>:"/\\|?*]', '', folder_name)
-            target_path = os.path.join(self.download_path, sanitized_folder)
-            # Create folder if it doesn't exist
-            if not os.path.exists(target_path):
-                os.makedirs(target_path)
-        else:
-            target_path = self.download_path
-            
-        search_query = f"ytsearch1:{query}"
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'postprocessors': [
+    def _relpath(self, path):
+        return os.path.relpath(path, self.download_path).replace('\\', '/')
+
+    def _register(self, path):
+        """Add a finished file to the library index so it is searchable right away"""
+        if not self.library_index:
+            return
+        try:
+            self.library_index.index_file(self._relpath(path))
+        except Exception as e:
+            logging.warning(f"Could not index {path}: {e}")
+
+    def _release_room(self, task, path=None):
+        if self.quota:
+            self.quota.release(id(task), self._relpath(path) if path else None)
+
+    def _reuse_existing(self, keys, target_path):
+        """Place an already downloaded copy of the track in target_path. Returns its path or None"""
+        rel_path = self.index.lookup(keys)
+        if not rel_path:
+            return None
+
+        source = os.path.join(self.download_path, rel_path)
+        if not os.path.exists(source):
+            # File was deleted since it was indexed
+            self.index.forget(rel_path)
+            return None
+
+        destination = os.path.join(target_path, os.path.basename(source))
+        if not os.path.exists(destination):
+            try:
+                os.link(source, destination)
+            except OSError:
+                # Hardlinks not supported (e.g. different filesystem), fall back to a copy
+                shutil.copy2(source, destination)
+        # The link keeps the original's mtime: without an access the storage quota would take
+        # the track just requested again for the coldest one
+        index = self.library_index or (self.quota.index if self.quota else None)
+        if index:
+            index.record_access(self._relpath(destination), play=False)
+        return destination
+
+    def _base_opts(self):
+        return {
+            'format': AUDIO_FORMATS[self.audio_format][0],
+            'quiet': True,
+            'no_warnings': True,
+            'noprogress': True,
+            'socket_timeout': 30,  # Add timeout to prevent hanging
+            'retries': 3,  # Limit retries
+            'fragment_retries': 3,
+            'skip_unavailable_fragments': True,
+            'extract_flat': False,
+            'no_playlist': True,  # Ensure we only get single video
+            'ignoreerrors': False,
+        }
+
+    def _stage_opts(self, stage):
+        opts = self._base_opts()
+        if stage == 'resolve':
+            opts['extract_flat'] = 'in_playlist'
+        elif stage == 'fetch':
+            # The target folder is set per track through params['paths'], see fetch()
+            opts.update({
+                'writethumbnail': True,
+                'outtmpl': '%(title)s.%(ext)s',
+            })
+        elif stage == 'transcode':
+            opts['postprocessors'] = [
                 {
                     'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',  # Reduced from 320 for faster downloads
+                    'preferredcodec': AUDIO_FORMATS[self.audio_format][1],
+                    'preferredquality': '192',  # Reduced from 320 for faster downloads (only used when re-encoding)
                 },
                 {
                     'key': 'FFmpegMetadata',
@@ -39,40 +146,164 @@ class Downloader:
                 {
                     'key': 'EmbedThumbnail',
                 },
-            ],
-            'writethumbnail': True,
-            'outtmpl': os.path.join(target_path, '%(title)s.%(ext)s'),
-            'quiet': True,
-            'no_warnings': True,
-            'socket_timeout': 30,  # Add timeout to prevent hanging
-            'retries': 3,  # Limit retries
-            'fragment_retries': 3,
-            'skip_unavailable_fragments': True,
-            'extract_flat': False,
-            'no_playlist': True,  # Ensure we only get single video
-            'ignoreerrors': False,
+            ]
+        return opts
+
+    def _ydl(self, stage):
+        """Return this thread's YoutubeDL for a stage, creating it on first use.
+
+        YoutubeDL is not thread-safe, but building one per track re-creates its
+        extractors, postprocessors and HTTP session every time. Keeping one per
+        worker thread reuses all of that (and open connections) across tracks.
+        """
+        instances = getattr(self._local, 'instances', None)
+        if instances is None:
+            instances = self._local.instances = {}
+        ydl = instances.get(stage)
+        if ydl is None:
+            ydl = instances[stage] = yt_dlp.YoutubeDL(self._stage_opts(stage))
+        return ydl
+
+    def _reset_ydl(self, stage):
+        """Drop this thread's instance after an error, the next track starts from a clean one"""
+        ydl = getattr(self._local, 'instances', {}).pop(stage, None)
+        if ydl is not None:
+            try:
+                ydl.close()
+            except Exception as e:
+                logging.debug(f"Error closing YoutubeDL: {e}")
+
+    def plan(self, query, metadata, folder_name=None):
+        """Prepare a download: target folder and dedup keys.
+
+        Returns the task dict passed through resolve/fetch/transcode. When the
+        track was already downloaded, task['result'] is set and nothing else
+        needs to run.
+        """
+        # Determine download path
+        if folder_name:
+            # Sanitize folder name
+            import re
+            sanitized_folder = re.sub(r'[<>:"/\\|?*]', '', folder_name)
+            target_path = os.path.join(self.download_path, sanitized_folder)
+            # Create folder if it doesn't exist (several workers may race here)
+            os.makedirs(target_path, exist_ok=True)
+        else:
+            target_path = self.download_path
+
+        task = {
+            'query': query,
+            'metadata': metadata or {},
+            'target_path': target_path,
+            'keys': track_keys(metadata or {}),
         }
 
+        # Skip all network work when this Spotify track was downloaded before
+        existing = self._reuse_existing(task['keys'], target_path)
+        if existing:
+            logging.info(f"Already downloaded, reusing: {existing}")
+            self._register(existing)
+            task['result'] = {
+                'status': 'success',
+                'filename': os.path.basename(existing),
+                'title': task['metadata'].get('name', 'Unknown'),
+                'original_query': query,
+                'reused': True
+            }
+        return task
+
+    def resolve(self, task):
+        """Network stage 1: find the YouTube video ID for the query, without downloading.
+
+        Uses a flat (extract-only) search and remembers the result, so a query
+        is only ever searched once.
+        """
+        cached = self.resolve_cache.get(task['query'])
+        if cached:
+            task['video_id'], task['video_title'] = cached
+            task['cached'] = True
+            return task
+
+        logging.info(f"Searching YouTube for: {task['query']}")
         try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                logging.info(f"Starting download for: {query}")
-                info = ydl.extract_info(search_query, download=True)
-                if 'entries' in info:
-                    video_info = info['entries'][0]
-                else:
-                    video_info = info
-                
-                filename = ydl.prepare_filename(video_info)
-                final_filename = os.path.splitext(filename)[0] + '.mp3'
-                
-                logging.info(f"Download completed: {final_filename}")
-                
-                return {
-                    'status': 'success',
-                    'filename': os.path.basename(final_filename),
-                    'title': video_info.get('title', 'Unknown'),
-                    'original_query': query
-                }
+            with STAGE_SECONDS.time(context=task['query'], stage='resolve'):
+                ydl = self._ydl('resolve')
+                info = self.limiter.call(lambda: ydl.extract_info(f"ytsearch1:{task['query']}", download=False),
+                                         throttle_delay)
+        except Exception:
+            self._reset_ydl('resolve')
+            raise
+        entries = info.get('entries') if 'entries' in info else [info]
+        if not entries:
+            raise ValueError(f"No YouTube results for: {task['query']}")
+
+        task['video_id'] = entries[0]['id']
+        task['video_title'] = entries[0].get('title')
+        self.resolve_cache.set(task['query'], task['video_id'], task['video_title'])
+        return task
+
+    def fetch(self, task):
+        """Network stage 2: download the audio stream (and thumbnail) as-is"""
+        if self.quota:
+            # Raises StorageFull when even evicting cannot make room; released once transcoded
+            self.quota.reserve(id(task))
+        ydl = self._ydl('fetch')
+        # Per-folder output: the instance is reused, only its home path changes per track
+        ydl.params['paths'] = {'home': task['target_path']}
+        try:
+            logging.info(f"Starting download for: {task['query']}")
+            with ACTIVE_DOWNLOADS.track(), STAGE_SECONDS.time(context=task['query'], stage='fetch'):
+                info = self.limiter.call(
+                    lambda: ydl.extract_info(YOUTUBE_WATCH_URL.format(task['video_id']), download=True),
+                    throttle_delay)
+            downloaded = (info.get('requested_downloads') or [info])[0]
+            task['downloaded'] = downloaded
+            task['filepath'] = downloaded.get('filepath') or ydl.prepare_filename(info)
+            if os.path.exists(task['filepath']):
+                DOWNLOADED_BYTES.inc(os.path.getsize(task['filepath']))
+        except Exception:
+            self._reset_ydl('fetch')
+            self._release_room(task)
+            if task.get('cached'):
+                # The cached video may have been removed: search again next time
+                self.resolve_cache.forget(task['query'])
+            raise
+        return task
+
+    def transcode(self, task):
+        """CPU stage: convert to the output format (or just remux), write tags and embed the thumbnail"""
+        downloaded = task['downloaded']
+        try:
+            with STAGE_SECONDS.time(context=task['query'], stage='transcode'):
+                info = self._ydl('transcode').post_process(task['filepath'], downloaded,
+                                                           downloaded.get('__files_to_move'))
+        except Exception:
+            self._reset_ydl('transcode')
+            self._release_room(task)
+            raise
+        final_filename = info.get('filepath') or f"{os.path.splitext(task['filepath'])[0]}.{self.audio_format}"
+
+        logging.info(f"Download completed: {final_filename}")
+        if task['keys'] and os.path.exists(final_filename):
+            self.index.add(task['keys'], self._relpath(final_filename))
+        self._register(final_filename)
+        # Counted as reserved until the library index lists it (right away, or through the library watcher)
+        self._release_room(task, final_filename)
+
+        return {
+            'status': 'success',
+            'filename': os.path.basename(final_filename),
+            'title': downloaded.get('title') or task.get('video_title') or 'Unknown',
+            'original_query': task['query']
+        }
+
+    def download_track(self, query, metadata, folder_name=None):
+        """Download track with optional subfolder organization"""
+        try:
+            task = self.plan(query, metadata, folder_name)
+            if 'result' in task:
+                return task['result']
+            return self.transcode(self.fetch(self.resolve(task)))
         except Exception as e:
             logging.error(f"Error downloading {query}: {e}")
             return {
@@ -80,4 +311,3 @@ class Downloader:
                 'message': str(e),
                 'query': query
             }
-
@@ -0,0 +1,18 @@
+# gunicorn reads this file from the working directory, so `gunicorn app:app` uses it as is.
+#
+# Progress streams (/jobs/<id>/stream) and library events (/library/events)
+# keep their response open. With the default sync worker each one would hold
+# the whole process, so workers run threads; the page only opens those
+# streams when the worker class can serve other requests meanwhile.
+import os
+import sys
+
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '32'))
+
+
+def post_worker_init(worker):
+    # Tell the app which worker class it got: plain sync (threads=1) serves one request at a time
+    app = sys.modules.get('app')
+    if app is not None:
+        app.STREAMING_RESPONSES = type(worker).__name__ != 'SyncWorker'
@@ -0,0 +1,457 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import logging
+
+from download_pool import download_tracks
+from metrics import TRACKS_FINISHED
+
+# Per-track states
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Job states (a job is also PENDING while queued, RUNNING once claimed)
+FINISHED_STATES = (DONE, FAILED)
+
+# A running job whose owner has not sent a heartbeat for this long is considered abandoned
+LEASE_SECONDS = 60
+
+
+def job_summary(job, counts):
+    """What /jobs reports for a job row, given its number of tracks per state"""
+    return {
+        'id': job['id'],
+        'url': job['url'],
+        'kind': job['kind'],
+        'name': job['name'],
+        'status': job['status'],
+        'message': job['message'],
+        'sync': bool(job['sync']),
+        # Streamed playlists announce their size before every track is listed
+        'total': job['total'] if job['total'] is not None else sum(counts.values()),
+        'tracks': {state: counts.get(state, 0) for state in (PENDING, RUNNING, DONE, FAILED)},
+    }
+
+
+class JobStore:
+    """SQLite-backed store for download jobs and their per-track state.
+
+    Any number of processes on this machine can share the database: jobs
+    are claimed with a lease kept alive by heartbeats (see claim()).
+    """
+
+    def __init__(self, db_path='data/jobs.db', on_change=None):
+        self.db_path = db_path
+        # Called with the job id after every change of a job or its tracks (e.g. ProgressBus.publish)
+        self.on_change = on_change
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                kind TEXT,
+                name TEXT,
+                folder TEXT,
+                status TEXT NOT NULL,
+                message TEXT,
+                sync INTEGER NOT NULL DEFAULT 0,
+                prune INTEGER NOT NULL DEFAULT 0,
+                snapshot_id TEXT,
+                total INTEGER,
+                listed INTEGER NOT NULL DEFAULT 1,
+                owner TEXT,
+                heartbeat REAL,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS job_tracks (
+                job_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                name TEXT,
+                artist TEXT,
+                album TEXT,
+                image TEXT,
+                url TEXT,
+                isrc TEXT,
+                status TEXT NOT NULL,
+                message TEXT,
+                filename TEXT,
+                updated REAL NOT NULL,
+                PRIMARY KEY (job_id, idx)
+            );
+            CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created);
+        ''')
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(jobs)')}
+        if 'listed' not in columns:
+            # total: track count announced by Spotify; listed: 0 while a streamed playlist is still being paged
+            self.conn.execute('ALTER TABLE jobs ADD COLUMN total INTEGER')
+            self.conn.execute('ALTER TABLE jobs ADD COLUMN listed INTEGER NOT NULL DEFAULT 1')
+        self.conn.commit()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cur = self.conn.execute(sql, params)
+            self.conn.commit()
+            return cur
+
+    def _changed(self, job_id):
+        if self.on_change:
+            try:
+                self.on_change(job_id)
+            except Exception as e:
+                logging.warning(f"Job change listener failed: {e}")
+
+    def create(self, url, sync=False, prune=False):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._execute(
+            'INSERT INTO jobs (id, url, status, sync, prune, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (job_id, url, PENDING, int(sync), int(prune), now, now))
+        return job_id
+
+    def claim(self, owner):
+        """Atomically take the oldest queued (or abandoned) job. Returns the job row or None"""
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT id FROM jobs WHERE status = ? OR (status = ? AND heartbeat < ?) '
+                'ORDER BY created LIMIT 1',
+                (PENDING, RUNNING, now - LEASE_SECONDS)).fetchone()
+            if not row:
+                return None
+            cur = self.conn.execute(
+                'UPDATE jobs SET status = ?, owner = ?, heartbeat = ?, updated = ? '
+                'WHERE id = ? AND (status = ? OR (status = ? AND heartbeat < ?))',
+                (RUNNING, owner, now, now, row['id'], PENDING, RUNNING, now - LEASE_SECONDS))
+            self.conn.commit()
+            if cur.rowcount != 1:
+                return None
+            # Tracks left running by a dead owner start over
+            self.conn.execute('UPDATE job_tracks SET status = ?, updated = ? WHERE job_id = ? AND status = ?',
+                              (PENDING, now, row['id'], RUNNING))
+            self.conn.commit()
+            return self.conn.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone()
+
+    def heartbeat(self, owner):
+        self._execute('UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status = ?',
+                      (time.time(), owner, RUNNING))
+
+    def release(self, job_id, owner):
+        """Put a job back in the queue right away when its owner stops, instead of waiting for the lease"""
+        now = time.time()
+        cur = self._execute('UPDATE jobs SET status = ?, owner = NULL, heartbeat = NULL, updated = ? '
+                            'WHERE id = ? AND owner = ? AND status = ?',
+                            (PENDING, now, job_id, owner, RUNNING))
+        if cur.rowcount:
+            self._changed(job_id)
+
+    def set_collection(self, job_id, kind, name, folder, tracks, snapshot_id=None, total=None, listed=True):
+        now = time.time()
+        with self._lock:
+            self.conn.execute('UPDATE jobs SET kind = ?, name = ?, folder = ?, snapshot_id = ?, total = ?, '
+                              'listed = ?, updated = ? WHERE id = ?',
+                              (kind, name, folder, snapshot_id, total if total is not None else len(tracks),
+                               int(listed), now, job_id))
+            self._insert_tracks(job_id, 0, tracks, now)
+            self.conn.commit()
+        self._changed(job_id)
+
+    def _insert_tracks(self, job_id, start, tracks, now):
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO job_tracks '
+            '(job_id, idx, name, artist, album, image, url, isrc, status, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(job_id, start + i, t['name'], t['artist'], t.get('album'), t.get('image'), t.get('url'), t.get('isrc'),
+              PENDING, now)
+             for i, t in enumerate(tracks)])
+
+    def add_tracks(self, job_id, start, tracks):
+        """Append a page of a streamed collection (idx from start on) and return its rows still pending"""
+        now = time.time()
+        with self._lock:
+            self._insert_tracks(job_id, start, tracks, now)
+            self.conn.commit()
+            return self.conn.execute(
+                'SELECT * FROM job_tracks WHERE job_id = ? AND idx >= ? AND idx < ? AND status = ? ORDER BY idx',
+                (job_id, start, start + len(tracks), PENDING)).fetchall()
+
+    def set_listed(self, job_id):
+        """Every track of a streamed collection is in job_tracks now"""
+        with self._lock:
+            self.conn.execute('UPDATE jobs SET listed = 1, updated = ?, '
+                              'total = (SELECT COUNT(*) FROM job_tracks WHERE job_id = ?) WHERE id = ?',
+                              (time.time(), job_id, job_id))
+            self.conn.commit()
+        self._changed(job_id)
+
+    def finish(self, job_id, status, message=None):
+        self._execute('UPDATE jobs SET status = ?, message = ?, updated = ? WHERE id = ?',
+                      (status, message, time.time(), job_id))
+        self._changed(job_id)
+
+    def update_track(self, job_id, idx, status, message=None, filename=None):
+        self._execute(
+            'UPDATE job_tracks SET status = ?, message = ?, filename = COALESCE(?, filename), updated = ? '
+            'WHERE job_id = ? AND idx = ?',
+            (status, message, filename, time.time(), job_id, idx))
+        self._changed(job_id)
+
+    def get(self, job_id):
+        with self._lock:
+            return self.conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+
+    def tracks(self, job_id, statuses=None):
+        sql = 'SELECT * FROM job_tracks WHERE job_id = ?'
+        params = [job_id]
+        if statuses:
+            sql += f" AND status IN ({','.join('?' * len(statuses))})"
+            params.extend(statuses)
+        with self._lock:
+            return self.conn.execute(sql + ' ORDER BY idx', params).fetchall()
+
+    def changed_tracks(self, job_id, since):
+        with self._lock:
+            return self.conn.execute(
+                'SELECT * FROM job_tracks WHERE job_id = ? AND updated > ? ORDER BY updated',
+                (job_id, since)).fetchall()
+
+    def summary(self, job_id):
+        """Job row as a dict plus per-state track counts, or None"""
+        job = self.get(job_id)
+        if not job:
+            return None
+        with self._lock:
+            counts = dict(self.conn.execute(
+                'SELECT status, COUNT(*) FROM job_tracks WHERE job_id = ? GROUP BY status',
+                (job_id,)).fetchall())
+        return job_summary(job, counts)
+
+    def counts(self):
+        """Number of jobs per state, e.g. the queue depth is counts()[PENDING]"""
+        with self._lock:
+            counts = dict(self.conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+        return {state: counts.get(state, 0) for state in (PENDING, RUNNING, DONE, FAILED)}
+
+    def pending_tracks(self):
+        """Tracks still waiting in queued or running jobs"""
+        with self._lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM job_tracks t JOIN jobs j ON j.id = t.job_id '
+                'WHERE j.status IN (?, ?) AND t.status = ?',
+                (PENDING, RUNNING, PENDING)).fetchone()[0]
+
+    def recent(self, limit=20):
+        with self._lock:
+            ids = [row['id'] for row in self.conn.execute(
+                'SELECT id FROM jobs ORDER BY created DESC LIMIT ?', (limit,))]
+        return [self.summary(job_id) for job_id in ids]
+
+
+class JobRunner:
+    """Background thread that claims jobs from a JobStore and downloads their tracks.
+
+    Only tracks that are not done yet are (re)downloaded, so a job picked up
+    again after a restart continues where it stopped.
+    """
+
+    def __init__(self, store, spotify, downloader, workers=4, poll_interval=2, sync_store=None, pipeline=None):
+        self.store = store
+        self.spotify = spotify
+        self.downloader = downloader
+        self.sync_store = sync_store
+        # Optional DownloadPipeline, otherwise tracks run whole on a pool of `workers` threads
+        self.pipeline = pipeline
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name='job-runner', daemon=True)
+        self._thread.start()
+        threading.Thread(target=self._heartbeat, name='job-heartbeat', daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+    def _heartbeat(self):
+        while not self._stop.wait(LEASE_SECONDS / 4):
+            try:
+                self.store.heartbeat(self.owner)
+            except Exception as e:
+                logging.warning(f"Job heartbeat failed: {e}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                job = self.store.claim(self.owner)
+            except Exception as e:
+                logging.error(f"Error claiming job: {e}")
+                job = None
+            if not job:
+                self._stop.wait(self.poll_interval)
+                continue
+            try:
+                self.run_job(job)
+            except Exception as e:
+                logging.error(f"Error running job {job['id']}: {e}", exc_info=True)
+                self.store.finish(job['id'], FAILED, str(e))
+            if self._stop.is_set():
+                # Stopped halfway: another worker continues the job without waiting for the lease
+                self.store.release(job['id'], self.owner)
+
+    def _resolve(self, url):
+        """Return (kind, name, folder, tracks) for a track or album URL, or None (playlists are streamed)"""
+        if 'track' in url:
+            track = self.spotify.get_track_info(url)
+            if not track:
+                return None
+            # Use Artist name for single tracks
+            return 'track', track['name'], track['artist'], [track]
+        elif 'album' in url:
+            name = self.spotify.get_album_name(url)
+            tracks = self.spotify.get_album_tracks(url)
+            return ('album', name, name, tracks) if tracks else None
+        return None
+
+    def _resolve_sync(self, job):
+        """Resolve a playlist sync job to only the tracks added since the last sync.
+
+        Returns (kind, name, folder, tracks, snapshot_id), or None when the
+        playlist could not be fetched. tracks is empty when nothing changed.
+        """
+        url = job['url']
+        playlist_id = self.spotify.playlist_id(url)
+        state = self.sync_store.get(playlist_id)
+        snapshot_id = self.spotify.get_playlist_snapshot(url)
+
+        if state and state['snapshot_id'] == snapshot_id:
+            return 'playlist', state['name'], state['folder'], [], snapshot_id
+
+        playlist = self.spotify.get_playlist(url, snapshot_id=snapshot_id)
+        name = playlist['name']
+        self.sync_store.ensure(playlist_id, name, name)
+
+        known = self.sync_store.tracks(playlist_id)
+        current = {track['url'] for track in playlist['tracks']}
+        added = [track for track in playlist['tracks'] if track['url'] not in known]
+        removed = [track_url for track_url in known if track_url not in current]
+
+        if removed and job['prune']:
+            for track_url in removed:
+                filename = known[track_url]
+                path = os.path.join(self.downloader.download_path, name, filename) if filename else None
+                if path and os.path.exists(path):
+                    os.remove(path)
+                    logging.info(f"Pruned track removed from playlist: {path}")
+        if removed:
+            self.sync_store.remove_tracks(playlist_id, removed)
+
+        logging.info(f"Sync '{name}': {len(added)} added, {len(removed)} removed")
+        return 'playlist', name, name, added, snapshot_id
+
+    def _stream_playlist(self, job):
+        """Start listing a playlist page by page. Returns a generator of pending track dicts, or None.
+
+        Each page is stored in job_tracks before its tracks are handed out, so
+        downloads start after the first page while the rest is still being
+        fetched. A job interrupted while listing lists again from the start;
+        tracks already done are skipped.
+        """
+        job_id = job['id']
+        try:
+            info, pages = self.spotify.stream_playlist(job['url'])
+        except Exception as e:
+            logging.error(f"Error fetching playlist: {e}")
+            return None
+        self.store.set_collection(job_id, 'playlist', info['name'], info['name'], [], info['snapshot_id'],
+                                  total=info['total'], listed=False)
+
+        def pending():
+            start = 0
+            for page in pages:
+                for row in self.store.add_tracks(job_id, start, page):
+                    yield dict(row)
+                start += len(page)
+            self.store.set_listed(job_id)
+        return pending()
+
+    def run_job(self, job):
+        job_id = job['id']
+        syncing = bool(job['sync']) and self.sync_store is not None and 'playlist' in job['url']
+        tracks = None
+        if not syncing and 'playlist' in job['url'] and (job['kind'] is None or not job['listed']):
+            tracks = self._stream_playlist(job)
+            if tracks is None:
+                self.store.finish(job_id, FAILED, 'Could not fetch info for this Spotify URL')
+                return
+            job = self.store.get(job_id)
+            logging.info(f"Job {job_id}: streaming up to {job['total']} track(s) of '{job['name']}'")
+        elif job['kind'] is None:
+            if syncing:
+                resolved = self._resolve_sync(job)
+            else:
+                resolved = self._resolve(job['url'])
+                resolved = resolved + (None,) if resolved else None
+            if not resolved:
+                self.store.finish(job_id, FAILED, 'Could not fetch info for this Spotify URL')
+                return
+            kind, name, folder, tracks, snapshot_id = resolved
+            self.store.set_collection(job_id, kind, name, folder, tracks, snapshot_id)
+            job = self.store.get(job_id)
+            tracks = None
+
+        if tracks is None:
+            pending = self.store.tracks(job_id, statuses=(PENDING,))
+            logging.info(f"Job {job_id}: {len(pending)} track(s) left in '{job['name']}'")
+            tracks = [dict(row) for row in pending]
+        playlist_id = self.spotify.playlist_id(job['url']) if syncing else None
+
+        if self.pipeline:
+            events = self.pipeline.run(tracks, job['folder'])
+        else:
+            events = download_tracks(self.downloader, tracks, job['folder'], workers=self.workers)
+
+        for event, i, track, result in events:
+            if event == 'started':
+                self.store.update_track(job_id, track['idx'], RUNNING)
+            elif result.get('status') == 'success':
+                TRACKS_FINISHED.inc(status='reused' if result.get('reused') else DONE)
+                self.store.update_track(job_id, track['idx'], DONE, filename=result.get('filename'))
+                if syncing:
+                    self.sync_store.add_track(playlist_id, track['url'], result.get('filename'))
+            else:
+                TRACKS_FINISHED.inc(status=FAILED)
+                self.store.update_track(job_id, track['idx'], FAILED, result.get('message', 'Unknown error'))
+            if self._stop.is_set():
+                return
+
+        failed = len(self.store.tracks(job_id, statuses=(FAILED,)))
+        total = len(self.store.tracks(job_id))
+        if syncing and failed == 0:
+            # Failed tracks keep the old snapshot so the next sync retries them
+            self.sync_store.set_snapshot(playlist_id, job['snapshot_id'])
+        if syncing and total == 0:
+            self.store.finish(job_id, DONE, 'Playlist up to date, no new tracks to download')
+            return
+        self.store.finish(job_id, DONE if failed < total else FAILED,
+                          f"{total - failed}/{total} tracks downloaded")
@@ -0,0 +1,522 @@
+import base64
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import logging
+
+from audio_tags import AUDIO_EXTENSIONS, read_tags
+
+# Sortable columns of the library API and their default direction
+SORT_COLUMNS = {
+    'mtime': ('mtime', 'desc'),
+    'artist': ('artist COLLATE NOCASE', 'asc'),
+    'title': ('title COLLATE NOCASE', 'asc'),
+}
+FILTER_COLUMNS = ('folder', 'artist', 'album')
+SEARCH_COLUMNS = ('title', 'artist', 'album', 'folder')
+# Columns of a row passed to _write, in order
+ROW_COLUMNS = ('path', 'folder', 'filename', 'title', 'artist', 'album', 'duration', 'size', 'mtime', 'cover',
+               'inode')
+
+
+def etag(size, mtime):
+    """Strong ETag of an audio file from its size and mtime (as stored in the index).
+
+    /play sends the same value, so clients can tell from a track listing
+    whether their cached copy is current without asking for the file.
+    """
+    return f'"{size:x}-{round(mtime * 1e6):x}"'
+
+
+def inode(st):
+    """Identity of the file behind a path: hard links (dedup copies) of one download share it"""
+    return f'{st.st_dev}:{st.st_ino}'
+
+
+def format_duration(length):
+    """Format a length in seconds as m:ss"""
+    minutes = int(length // 60)
+    seconds = int(length % 60)
+    return f"{minutes}:{seconds:02d}"
+
+
+class LibraryIndex:
+    """Persistent index of the downloads folder.
+
+    Rows are keyed by relative path and remember the mtime and size seen when
+    the tags were last read, so a refresh only opens files that are new or
+    changed and drops rows for files that disappeared.
+
+    on_change, when given, is called after every write with a list of
+    (event, path, track) tuples: event is 'created', 'modified' or 'deleted'
+    and track is None for deletions.
+    """
+
+    def __init__(self, download_path='downloads', db_path='data/library.db', cover_cache=None, on_change=None):
+        self.download_path = download_path
+        self.db_path = db_path
+        self.cover_cache = cover_cache
+        self.on_change = on_change
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+
+        self._lock = threading.Lock()
+        # Worker processes with a storage budget write to this database too, see storage_quota.py
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS tracks (
+                path TEXT PRIMARY KEY,
+                folder TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                title TEXT,
+                artist TEXT,
+                album TEXT,
+                duration REAL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                cover TEXT,
+                inode TEXT
+            )
+        ''')
+        columns = {row[1] for row in self.conn.execute('PRAGMA table_info(tracks)')}
+        if 'cover' not in columns:
+            # cover: digest in the CoverCache, '' when the file has none, NULL when not extracted yet
+            self.conn.execute('ALTER TABLE tracks ADD COLUMN cover TEXT')
+        if 'inode' not in columns:
+            # inode: 'dev:ino', filled in by the next refresh for rows indexed before the column existed
+            self.conn.execute('ALTER TABLE tracks ADD COLUMN inode TEXT')
+        self.conn.executescript('''
+            CREATE INDEX IF NOT EXISTS idx_tracks_mtime ON tracks (mtime);
+            CREATE INDEX IF NOT EXISTS idx_tracks_artist ON tracks (artist COLLATE NOCASE, path);
+            CREATE INDEX IF NOT EXISTS idx_tracks_title ON tracks (title COLLATE NOCASE, path);
+            CREATE INDEX IF NOT EXISTS idx_tracks_folder ON tracks (folder);
+            -- Plays and last access (from /play and /download) that order evictions, see storage_quota.py
+            CREATE TABLE IF NOT EXISTS track_usage (
+                path TEXT PRIMARY KEY,
+                plays INTEGER NOT NULL DEFAULT 0,
+                last_access REAL
+            );
+            -- Folders the storage quota never evicts from
+            CREATE TABLE IF NOT EXISTS pinned_folders (
+                folder TEXT PRIMARY KEY,
+                created REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        ''')
+        # Tells processes that open this database apart from ones with another copy of it
+        self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('library_id', ?)", (uuid.uuid4().hex,))
+        self.conn.commit()
+        self.library_id = self.conn.execute("SELECT value FROM meta WHERE key = 'library_id'").fetchone()[0]
+        self._last_refresh = 0
+        self.fts = self._create_fts()
+
+    def _create_fts(self):
+        """Create the FTS5 search table. Returns False when SQLite was built without FTS5"""
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tracks_fts'").fetchone()
+        if exists:
+            return True
+        try:
+            self.conn.execute(
+                "CREATE VIRTUAL TABLE tracks_fts USING fts5("
+                "title, artist, album, folder, "
+                "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')")
+        except sqlite3.OperationalError as e:
+            logging.warning(f"FTS5 not available, search falls back to LIKE: {e}")
+            return False
+        # Rows share their rowid with tracks. Backfill tracks indexed before the search table existed
+        self.conn.execute('INSERT INTO tracks_fts (rowid, title, artist, album, folder) '
+                          'SELECT rowid, title, artist, album, folder FROM tracks')
+        self.conn.commit()
+        return True
+
+    def _scan(self, folder=None):
+        """Walk the downloads folder (or one folder of it): {rel_path: (folder, filename, size, mtime, inode)}"""
+        found = {}
+        top = os.path.join(self.download_path, folder) if folder else self.download_path
+        for root, dirs, files in os.walk(top):
+            folder = os.path.relpath(root, self.download_path)
+            if folder == '.':
+                folder = 'Uncategorized'
+            for f in files:
+                if not f.endswith(AUDIO_EXTENSIONS):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, f))
+                except OSError:
+                    continue
+                rel_path = os.path.join(folder, f) if folder != 'Uncategorized' else f
+                rel_path = rel_path.replace('\\', '/')
+                found[rel_path] = (folder.replace('\\', '/'), f, st.st_size, st.st_mtime, inode(st))
+        return found
+
+    def _read_tags(self, path, filename):
+        """Open the file once and return (title, artist, album, duration, cover)"""
+        try:
+            tags = read_tags(path, with_cover=bool(self.cover_cache))
+            cover = None
+            if self.cover_cache:
+                cover = self.cover_cache.store(*tags['cover']) if tags['cover'] else ''
+            return (
+                tags['title'] or filename,
+                tags['artist'] or 'Unknown Artist',
+                tags['album'] or 'Unknown Album',
+                tags['duration'],
+                cover,
+            )
+        except Exception as e:
+            logging.warning(f"Error reading metadata for {filename}: {e}")
+            return filename, 'Unknown Artist', 'Unknown Album', 0, None
+
+    def refresh(self, max_age=0, folder=None):
+        """Sync the index with the filesystem. Returns (added_or_changed, removed).
+
+        With max_age, the scan is skipped when the last one is more recent than that many seconds.
+        With folder, only that folder (and its subfolders) is scanned and synced.
+        """
+        if max_age and time.monotonic() - self._last_refresh < max_age:
+            return 0, 0
+        if not folder:
+            self._last_refresh = time.monotonic()
+        found = self._scan(folder)
+        with self._lock:
+            if folder:
+                prefix = folder.rstrip('/') + '/'
+                rows = self.conn.execute('SELECT path, size, mtime, inode FROM tracks WHERE substr(path, 1, ?) = ?',
+                                         (len(prefix), prefix))
+            else:
+                rows = self.conn.execute('SELECT path, size, mtime, inode FROM tracks')
+            known = {row['path']: (row['size'], row['mtime'], row['inode']) for row in rows}
+
+        removed = [p for p in known if p not in found]
+        changed, relinked = self._compare(found, known)
+        rows = self._read_rows(changed, found)
+        self._set_inodes(relinked)
+
+        if rows or removed:
+            self._write(rows, removed)
+            logging.info(f"Library index refreshed: {len(rows)} updated, {len(removed)} removed")
+        return len(rows), len(removed)
+
+    @staticmethod
+    def _compare(found, known):
+        """Paths whose size or mtime changed (tags to read) and (inode, path) of the ones only relinked"""
+        changed, relinked = [], []
+        for rel_path, (_, _, size, mtime, file_inode) in found.items():
+            row = known.get(rel_path)
+            if not row or tuple(row[:2]) != (size, mtime):
+                changed.append(rel_path)
+            elif row[2] != file_inode:
+                # Same content under another inode (or one not recorded yet): no need to read the tags again
+                relinked.append((file_inode, rel_path))
+        return changed, relinked
+
+    def _read_rows(self, paths, found):
+        """Read the tags of paths and build the rows to store"""
+        rows = []
+        for rel_path in paths:
+            folder, filename, size, mtime, file_inode = found[rel_path]
+            title, artist, album, duration, cover = self._read_tags(
+                os.path.join(self.download_path, rel_path), filename)
+            rows.append((rel_path, folder, filename, title, artist, album, duration, size, mtime, cover, file_inode))
+        return rows
+
+    def _set_inodes(self, pairs):
+        if not pairs:
+            return
+        with self._lock:
+            self.conn.executemany('UPDATE tracks SET inode = ? WHERE path = ?', pairs)
+            self.conn.commit()
+
+    def _write(self, rows, removed=()):
+        """Store track rows and drop removed paths, keeping the search table in step"""
+        stale = [(p,) for p in removed] + [(row[0],) for row in rows]
+        changes = []
+        with self._lock:
+            if self.on_change:
+                changes = [('deleted', p, None) for p in removed if self._exists(p)]
+                changes += [('modified' if self._exists(row[0]) else 'created', row[0],
+                             self._to_track(dict(zip(ROW_COLUMNS, row)))) for row in rows]
+            if self.fts:
+                self.conn.executemany(
+                    'DELETE FROM tracks_fts WHERE rowid = (SELECT rowid FROM tracks WHERE path = ?)', stale)
+            self.conn.executemany('DELETE FROM tracks WHERE path = ?', [(p,) for p in removed])
+            self.conn.executemany('DELETE FROM track_usage WHERE path = ?', [(p,) for p in removed])
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO tracks '
+                '(path, folder, filename, title, artist, album, duration, size, mtime, cover, inode) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            if self.fts:
+                self.conn.executemany(
+                    'INSERT INTO tracks_fts (rowid, title, artist, album, folder) '
+                    'SELECT rowid, title, artist, album, folder FROM tracks WHERE path = ?',
+                    [(row[0],) for row in rows])
+            self.conn.commit()
+        if changes:
+            self.on_change(changes)
+
+    def _exists(self, rel_path):
+        return self.conn.execute('SELECT 1 FROM tracks WHERE path = ?', (rel_path,)).fetchone() is not None
+
+    def index_file(self, rel_path):
+        """Index (or re-index) a single file right away, e.g. when a download finishes"""
+        rel_path = rel_path.replace('\\', '/')
+        path = os.path.join(self.download_path, rel_path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            self._write([], [rel_path])
+            return
+        folder, filename = rel_path.rsplit('/', 1) if '/' in rel_path else ('Uncategorized', rel_path)
+        title, artist, album, duration, cover = self._read_tags(path, filename)
+        self._write([(rel_path, folder, filename, title, artist, album, duration, st.st_size, st.st_mtime, cover,
+                      inode(st))])
+
+    def index_paths(self, rel_paths):
+        """Sync only these files: index the new or changed ones, drop the ones that are gone.
+
+        Files whose size and mtime match the index are not opened, so a path
+        reported twice (by the downloader and by the watcher) is read once.
+        """
+        found = {}
+        removed = []
+        for rel_path in {p.replace('\\', '/') for p in rel_paths}:
+            try:
+                st = os.stat(os.path.join(self.download_path, rel_path))
+            except OSError:
+                removed.append(rel_path)
+                continue
+            folder, filename = rel_path.rsplit('/', 1) if '/' in rel_path else ('Uncategorized', rel_path)
+            found[rel_path] = (folder, filename, st.st_size, st.st_mtime, inode(st))
+
+        with self._lock:
+            known = {}
+            for rel_path in found:
+                row = self.conn.execute('SELECT size, mtime, inode FROM tracks WHERE path = ?', (rel_path,)).fetchone()
+                known[rel_path] = tuple(row) if row else None
+        changed, relinked = self._compare(found, known)
+        rows = self._read_rows(changed, found)
+        self._set_inodes(relinked)
+        if rows or removed:
+            self._write(rows, removed)
+        return len(rows), len(removed)
+
+    @staticmethod
+    def _to_track(row):
+        return {
+            'filename': row['filename'],
+            'path': row['path'],
+            'title': row['title'],
+            'artist': row['artist'],
+            'album': row['album'],
+            'duration': format_duration(row['duration'] or 0),
+            'size': row['size'],
+            'timestamp': row['mtime'],
+            'etag': etag(row['size'], row['mtime']),
+        }
+
+    def get_cover(self, rel_path):
+        """Cover digest recorded for a track: str ('' = no cover), or None when unknown"""
+        with self._lock:
+            row = self.conn.execute('SELECT cover FROM tracks WHERE path = ?', (rel_path,)).fetchone()
+        return row['cover'] if row else None
+
+    def set_cover(self, rel_path, digest):
+        with self._lock:
+            self.conn.execute('UPDATE tracks SET cover = ? WHERE path = ?', (digest, rel_path))
+            self.conn.commit()
+
+    def totals(self):
+        """Return (count, total_size_bytes) without touching the filesystem"""
+        with self._lock:
+            row = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tracks').fetchone()
+        return row[0], row[1]
+
+    def disk_usage(self):
+        """(count, bytes on disk): hard links of one file count once, unlike totals()"""
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM '
+                '(SELECT MAX(size) AS size FROM tracks GROUP BY COALESCE(inode, path))').fetchone()
+        return row[0], row[1]
+
+    def sizes(self, rel_paths):
+        """{path: size} for the paths that are still indexed"""
+        with self._lock:
+            return {row['path']: row['size'] for row in self.conn.execute(
+                f"SELECT path, size FROM tracks WHERE path IN ({','.join('?' * len(rel_paths))})", rel_paths)}
+
+    def record_access(self, rel_path, play=True):
+        """Remember that a track was played (or just fetched, play=False)"""
+        with self._lock:
+            self.conn.execute(
+                'INSERT INTO track_usage (path, plays, last_access) VALUES (?, ?, ?) '
+                'ON CONFLICT (path) DO UPDATE SET plays = plays + excluded.plays, last_access = excluded.last_access',
+                (rel_path, int(play), time.time()))
+            self.conn.commit()
+
+    def pin_folder(self, folder):
+        with self._lock:
+            self.conn.execute('INSERT OR IGNORE INTO pinned_folders (folder, created) VALUES (?, ?)',
+                              (folder.strip('/'), time.time()))
+            self.conn.commit()
+
+    def unpin_folder(self, folder):
+        with self._lock:
+            self.conn.execute('DELETE FROM pinned_folders WHERE folder = ?', (folder.strip('/'),))
+            self.conn.commit()
+
+    def pinned_folders(self):
+        with self._lock:
+            return [row['folder'] for row in self.conn.execute('SELECT folder FROM pinned_folders ORDER BY folder')]
+
+    def eviction_candidates(self):
+        """([paths], size) per file outside pinned folders (and their subfolders), least recently used first.
+
+        Hard links of one file come together: deleting only some of them
+        frees nothing, and a file with a link in a pinned folder is not a
+        candidate. A file is as recent as its most recently used link; tracks
+        never played count from the time they were downloaded, and ties go to
+        the one played fewer times.
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT group_concat(t.path, char(0)) AS paths, MAX(t.size) AS size "
+                'FROM tracks t LEFT JOIN track_usage u ON u.path = t.path '
+                'GROUP BY COALESCE(t.inode, t.path) '
+                'HAVING NOT MAX(EXISTS (SELECT 1 FROM pinned_folders p WHERE t.folder = p.folder '
+                "OR substr(t.folder, 1, length(p.folder) + 1) = p.folder || '/')) "
+                'ORDER BY MAX(COALESCE(u.last_access, t.mtime)), SUM(COALESCE(u.plays, 0)), MIN(t.path)').fetchall()
+        return [(sorted(row['paths'].split('\0')), row['size']) for row in rows]
+
+    def tracks(self):
+        """All indexed tracks, newest first"""
+        with self._lock:
+            rows = self.conn.execute('SELECT * FROM tracks ORDER BY mtime DESC').fetchall()
+        return [self._to_track(row) for row in rows]
+
+    @staticmethod
+    def _encode_cursor(value, path):
+        return base64.urlsafe_b64encode(json.dumps([value, path]).encode()).decode()
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        try:
+            value, path = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return value, path
+        except Exception:
+            raise ValueError('Invalid cursor')
+
+    def page(self, sort='mtime', order=None, filters=None, limit=100, cursor=None):
+        """One page of tracks using keyset pagination.
+
+        Returns (tracks, next_cursor); next_cursor is None on the last page.
+        Raises ValueError on an unknown sort/order or a malformed cursor.
+        """
+        if sort not in SORT_COLUMNS:
+            raise ValueError(f"Unknown sort '{sort}'")
+        column, default_order = SORT_COLUMNS[sort]
+        order = (order or default_order).lower()
+        if order not in ('asc', 'desc'):
+            raise ValueError(f"Unknown order '{order}'")
+
+        where = []
+        params = []
+        for name, value in (filters or {}).items():
+            if name in FILTER_COLUMNS and value:
+                where.append(f"{name} = ?")
+                params.append(value)
+
+        if cursor:
+            value, path = self._decode_cursor(cursor)
+            op = '<' if order == 'desc' else '>'
+            where.append(f"({column} {op} ? OR ({column} = ? AND path > ?))")
+            params.extend([value, value, path])
+
+        sql = 'SELECT * FROM tracks'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += f" ORDER BY {column} {order.upper()}, path ASC LIMIT ?"
+        params.append(limit + 1)
+
+        with self._lock:
+            rows = self.conn.execute(sql, params).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            next_cursor = self._encode_cursor(last[sort], last['path'])
+        return [self._to_track(row) for row in rows], next_cursor
+
+    def manifest(self, filters=None):
+        """(path, size, etag) of every track matching filters, for clients planning offline storage"""
+        where = []
+        params = []
+        for name, value in (filters or {}).items():
+            if name in FILTER_COLUMNS and value:
+                where.append(f"{name} = ?")
+                params.append(value)
+        sql = 'SELECT path, size, mtime FROM tracks'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        with self._lock:
+            rows = self.conn.execute(sql + ' ORDER BY path', params).fetchall()
+        return [{'path': row['path'], 'size': row['size'], 'etag': etag(row['size'], row['mtime'])} for row in rows]
+
+    def summary(self):
+        """Aggregate counts and sizes: totals plus per-folder and per-artist counts"""
+        with self._lock:
+            count, size = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM tracks').fetchone()
+            folders = self.conn.execute(
+                'SELECT folder, COUNT(*) AS count, SUM(size) AS size FROM tracks '
+                'GROUP BY folder ORDER BY folder COLLATE NOCASE').fetchall()
+            artists = self.conn.execute(
+                'SELECT artist, COUNT(*) AS count FROM tracks '
+                'GROUP BY artist ORDER BY artist COLLATE NOCASE').fetchall()
+        return {
+            'count': count,
+            'size_bytes': size,
+            'folders': [dict(row) for row in folders],
+            'artists': [dict(row) for row in artists],
+        }
+
+    @staticmethod
+    def _fts_query(query):
+        """Turn user input into an FTS5 query where every word is a prefix match"""
+        words = [w.replace('"', '') for w in query.split()]
+        return ' '.join(f'"{w}"*' for w in words if w)
+
+    def search(self, query, limit=50):
+        """Tracks whose title, artist, album or folder match every word of query (prefix match)"""
+        if not query.strip():
+            return []
+        with self._lock:
+            if self.fts:
+                match = self._fts_query(query)
+                if not match:
+                    return []
+                rows = self.conn.execute(
+                    'SELECT tracks.* FROM tracks_fts JOIN tracks ON tracks.rowid = tracks_fts.rowid '
+                    'WHERE tracks_fts MATCH ? ORDER BY bm25(tracks_fts) LIMIT ?',
+                    (match, limit)).fetchall()
+            else:
+                where = []
+                params = []
+                for word in query.split():
+                    where.append('(' + ' OR '.join(f"{c} LIKE ?" for c in SEARCH_COLUMNS) + ')')
+                    params.extend([f"%{word}%"] * len(SEARCH_COLUMNS))
+                rows = self.conn.execute(
+                    f"SELECT * FROM tracks WHERE {' AND '.join(where)} ORDER BY mtime DESC LIMIT ?",
+                    params + [limit]).fetchall()
+        return [self._to_track(row) for row in rows]
@@ -0,0 +1,275 @@
+"""Keep the library index in step with the downloads folder as files change.
+
+On Linux the folder is watched with inotify (through ctypes, no extra
+dependency); elsewhere, or when inotify is unavailable, it is rescanned on an
+interval. Either way the index reports what changed to a LibraryFeed, which
+clients follow over Server-Sent Events.
+"""
+import collections
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import select
+import struct
+import threading
+import time
+
+import logging
+
+from audio_tags import AUDIO_EXTENSIONS
+
+# inotify(7) event bits
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# Files are picked up once written and closed or renamed into place, not on every write
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class LibraryFeed:
+    """Recent library changes, numbered so clients can catch up after reconnecting.
+
+    LibraryIndex calls publish() with the changes of each write; every batch
+    becomes one message with the new totals. A batch larger than max_changes
+    (a first scan, a folder copied in) is sent as a reset: clients reload the
+    library instead of applying thousands of rows one by one.
+    """
+
+    def __init__(self, index, history=500, max_changes=200):
+        self.index = index
+        self.max_changes = max_changes
+        self._messages = collections.deque(maxlen=history)
+        self._last_id = 0
+        self._cond = threading.Condition()
+        self._subscribers = set()
+
+    def publish(self, changes):
+        count, size = self.index.totals()
+        message = {'count': count, 'size_bytes': size}
+        if len(changes) > self.max_changes:
+            message['reset'] = True
+        else:
+            message['changes'] = [{'event': event, 'path': path, 'track': track} for event, path, track in changes]
+        with self._cond:
+            self._last_id += 1
+            self._messages.append((self._last_id, message))
+            self._cond.notify_all()
+            callbacks = list(self._subscribers)
+        for callback in callbacks:
+            callback()
+
+    @property
+    def last_id(self):
+        with self._cond:
+            return self._last_id
+
+    def since(self, last_id):
+        """Messages after last_id as (id, message) pairs.
+
+        When last_id is older than the history kept, a single reset message
+        is returned instead.
+        """
+        with self._cond:
+            if last_id >= self._last_id:
+                return []
+            if not self._messages or self._messages[0][0] > last_id + 1:
+                return [(self._last_id, {'reset': True})]
+            return [(i, message) for i, message in self._messages if i > last_id]
+
+    def wait(self, last_id, timeout):
+        """Block until there is a message after last_id or timeout seconds passed"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._last_id > last_id, timeout)
+
+    def subscribe(self, callback):
+        with self._cond:
+            self._subscribers.add(callback)
+
+    def unsubscribe(self, callback):
+        with self._cond:
+            self._subscribers.discard(callback)
+
+    @staticmethod
+    def event(message_id, message):
+        """One SSE event; the id lets the browser resume with Last-Event-ID"""
+        return f"id: {message_id}\nevent: library\ndata: {json.dumps(message)}\n\n"
+
+
+class Inotify:
+    """Minimal inotify binding: add watches and read events with a timeout"""
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        return wd
+
+    def read(self, timeout):
+        """Events as (wd, mask, name) tuples, [] after timeout seconds without any"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class LibraryWatcher:
+    """Background thread feeding filesystem changes of the downloads folder into the index.
+
+    mode is 'inotify', 'poll' or 'auto' (inotify when available, else poll).
+    Events are collected for `debounce` seconds before the affected files are
+    indexed, so a file written in several steps (download, convert, tag) is
+    read once. While the watcher runs, the index is kept current and request
+    handlers can skip their own rescans.
+    """
+
+    def __init__(self, index, mode='auto', poll_interval=10, debounce=0.5):
+        self.index = index
+        self.path = index.download_path
+        self.mode = mode
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.active = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._inotify = None
+        self._dirs = {}
+
+    def start(self):
+        if self.mode in ('auto', 'inotify'):
+            try:
+                self._inotify = Inotify()
+                self._watch_tree('')
+                self.active = 'inotify'
+            except (OSError, AttributeError) as e:
+                # AttributeError: no inotify in this libc (macOS, Windows)
+                if self._inotify:
+                    self._inotify.close()
+                    self._inotify = None
+                self._dirs = {}
+                if self.mode == 'inotify':
+                    raise
+                logging.warning(f"inotify not available, polling the library every {self.poll_interval}s: {e}")
+        if not self.active:
+            self.active = 'poll'
+        self._thread = threading.Thread(target=self._run, name='library-watcher', daemon=True)
+        self._thread.start()
+        logging.info(f"Watching {self.path} for changes ({self.active})")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def _watch_tree(self, rel_dir):
+        """Watch a folder and every folder under it"""
+        for root, dirs, files in os.walk(os.path.join(self.path, rel_dir)):
+            rel = os.path.relpath(root, self.path).replace('\\', '/')
+            try:
+                wd = self._inotify.add_watch(root, WATCH_MASK)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    continue
+                # ENOSPC: fs.inotify.max_user_watches reached
+                raise
+            self._dirs[wd] = '' if rel == '.' else rel
+
+    def _run(self):
+        # Catch up with whatever changed while the app was not running
+        self._refresh()
+        if self.active == 'inotify':
+            self._run_inotify()
+        else:
+            while not self._stop.wait(self.poll_interval):
+                self._refresh()
+
+    def _refresh(self, folder=None):
+        try:
+            self.index.refresh(folder=folder)
+        except Exception as e:
+            logging.error(f"Library refresh failed: {e}", exc_info=True)
+
+    def _run_inotify(self):
+        try:
+            while not self._stop.is_set():
+                events = self._inotify.read(1)
+                if not events:
+                    continue
+                # Let the burst settle: conversions and tag writes close the file several times
+                deadline = time.monotonic() + self.debounce
+                while time.monotonic() < deadline:
+                    events.extend(self._inotify.read(max(0, deadline - time.monotonic())))
+                self._apply(events)
+        finally:
+            self._inotify.close()
+
+    def _apply(self, events):
+        files = set()
+        folders = set()
+        full = False
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                full = True
+                continue
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            parent = self._dirs.get(wd)
+            if parent is None:
+                continue
+            rel_path = f"{parent}/{name}" if parent else name
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # A folder moved or copied in may already contain files
+                    try:
+                        self._watch_tree(rel_path)
+                    except OSError as e:
+                        logging.warning(f"Cannot watch {rel_path}, changes inside it need a rescan: {e}")
+                if mask & (IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE):
+                    folders.add(rel_path)
+            elif mask & IN_DELETE_SELF:
+                continue
+            elif name.endswith(AUDIO_EXTENSIONS):
+                files.add(rel_path)
+
+        if full:
+            logging.warning('inotify queue overflowed, rescanning the library')
+            self._refresh()
+            return
+        for folder in folders:
+            self._refresh(folder)
+        files = [p for p in files if not any(p.startswith(folder + '/') for folder in folders)]
+        if files:
+            try:
+                self.index.index_paths(files)
+            except Exception as e:
+                logging.error(f"Indexing {len(files)} changed file(s) failed: {e}", exc_info=True)
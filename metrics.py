@@ -0,0 +1,213 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+import logging
+
+# Timing lines go to their own logger so they can be silenced or routed separately
+timing_log = logging.getLogger('timing')
+
+# Seconds; covers both a cover lookup and a long ffmpeg conversion
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format(value):
+    """Sample value without losing precision: byte counts and totals stay exact integers"""
+    value = float(value)
+    if value.is_integer():
+        return str(int(value))
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def samples(self):
+        """Yield (suffix, label values, extra labels, value)"""
+        with self._lock:
+            items = list(self._values.items())
+        if not items and not self.label_names:
+            items = [((), 0)]
+        for key, value in items:
+            yield '', key, (), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for suffix, key, extra, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_labels(self.label_names, key, extra)} {_format(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down, or is read from a callback at scrape time"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), callback=None):
+        super().__init__(name, help, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """Count something as in progress while the block runs"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self):
+        if self.callback:
+            try:
+                values = self.callback()
+            except Exception as e:
+                logging.warning(f"Could not read gauge {self.name}: {e}")
+                return
+            # A callback returns a number, or {label values: number} for labelled gauges
+            if not isinstance(values, dict):
+                values = {(): values}
+            for key, value in values.items():
+                yield '', key if isinstance(key, tuple) else (key,), (), value
+            return
+        yield from super().samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), count, total) for key, (counts, count, total) in self._values.items()]
+        for key, counts, count, total in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield '_bucket', key, (('le', f'{bound:g}'),), cumulative
+            yield '_bucket', key, (('le', '+Inf'),), count
+            yield '_count', key, (), count
+            yield '_sum', key, (), total
+
+    @contextmanager
+    def time(self, context=None, **labels):
+        """Observe the duration of the block and write it to the timing log (context only goes to the log)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(time.perf_counter() - start, context, **labels)
+
+    def record(self, seconds, context=None, **labels):
+        """observe() plus a structured line in the timing log"""
+        self.observe(seconds, **labels)
+        fields = ' '.join(f'{name}={value}' for name, value in labels.items())
+        if context:
+            fields += f' context="{_escape(context)}"'
+        timing_log.info(f"{self.name} {fields} seconds={seconds:.3f}")
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+# Download pipeline
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'download_stage_seconds', 'Time spent per track in each download stage', labels=('stage',)))
+ACTIVE_DOWNLOADS = REGISTRY.register(Gauge(
+    'active_downloads', 'Audio downloads in progress'))
+DOWNLOADED_BYTES = REGISTRY.register(Counter(
+    'downloaded_bytes_total', 'Bytes of audio downloaded from YouTube'))
+TRACKS_FINISHED = REGISTRY.register(Counter(
+    'tracks_finished_total', 'Tracks finished by the job runner', labels=('status',)))
+EVICTED_TRACKS = REGISTRY.register(Counter(
+    'storage_evicted_tracks_total', 'Tracks evicted to stay within the storage budget', labels=('action',)))
+
+# Spotify API
+SPOTIFY_SECONDS = REGISTRY.register(Histogram(
+    'spotify_request_seconds', 'Spotify Web API request latency, including retries', labels=('endpoint',)))
+SPOTIFY_RETRIES = REGISTRY.register(Counter(
+    'spotify_retries_total', 'Spotify Web API requests retried, by response status', labels=('status',)))
+
+# Rate limiting (see rate_limit.py)
+RATE_LIMIT_WAIT = REGISTRY.register(Counter(
+    'rate_limit_wait_seconds_total', 'Time workers spent waiting for the rate limiter', labels=('service',)))
+THROTTLED = REGISTRY.register(Counter(
+    'throttled_total', 'Requests throttled by the remote service and retried after a backoff', labels=('service',)))
+RATE_LIMIT = REGISTRY.register(Gauge(
+    'rate_limit_per_second', 'Current adaptive request rate', labels=('service',)))
+
+# HTTP
+HTTP_SECONDS = REGISTRY.register(Histogram(
+    'http_request_seconds', 'Time to produce a response, per route', labels=('endpoint',)))
@@ -0,0 +1,135 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import queue
+import threading
+
+import logging
+
+
+class DownloadPipeline:
+    """Runs tracks through the Downloader stages on separate pools.
+
+    resolve (YouTube search) and fetch (audio download) are network bound,
+    transcode (ffmpeg + tagging) is CPU bound; each stage has its own worker
+    limit, so downloads keep going while other tracks are being encoded.
+    Resolving only looks up video IDs, so it runs ahead of the downloads,
+    but at most read_ahead tracks of a run are taken from the collection
+    before earlier ones finish: a huge playlist does not pile up in the pool
+    queues.
+
+    The pools live as long as the pipeline, so their threads keep the
+    Downloader's per-thread YoutubeDL instances warm across jobs.
+    """
+
+    def __init__(self, downloader, resolve_workers=4, fetch_workers=4, transcode_workers=None, read_ahead=None):
+        self.downloader = downloader
+        self.resolve_workers = max(1, resolve_workers)
+        self.fetch_workers = max(1, fetch_workers)
+        self.transcode_workers = max(1, transcode_workers or os.cpu_count() or 1)
+        self.resolve_pool = ThreadPoolExecutor(self.resolve_workers, thread_name_prefix='resolve')
+        self.fetch_pool = ThreadPoolExecutor(self.fetch_workers, thread_name_prefix='fetch')
+        self.transcode_pool = ThreadPoolExecutor(self.transcode_workers, thread_name_prefix='transcode')
+        # Tracks of one run between being read and finishing: enough to keep every stage busy
+        self.read_ahead = read_ahead or 2 * (self.resolve_workers + self.fetch_workers + self.transcode_workers)
+
+    def run(self, tracks, folder_name=None):
+        """Yield ('started', index, track, None) and ('finished', index, track, result) events.
+
+        Same contract as download_pool.download_tracks. Closing the generator
+        stops tracks that have not reached a stage yet.
+        """
+        events = queue.Queue()
+        stop = threading.Event()
+        # Taken by feed() for every track it reads, given back when the track leaves the pipeline
+        slots = threading.BoundedSemaphore(self.read_ahead)
+
+        def finish(index, track, result):
+            events.put(('finished', index, track, result))
+            slots.release()
+
+        def fail(index, track, task, e):
+            query = task['query'] if task else f"{track['name']} {track['artist']}"
+            logging.error(f"Error downloading {query}: {e}")
+            finish(index, track, {'status': 'error', 'message': str(e), 'query': query})
+
+        def transcode(index, track, task):
+            try:
+                result = self.downloader.transcode(task)
+            except Exception as e:
+                fail(index, track, task, e)
+                return
+            finish(index, track, result)
+
+        def fetch(index, track, task):
+            if stop.is_set():
+                slots.release()
+                return
+            events.put(('started', index, track, None))
+            try:
+                task = self.downloader.fetch(task)
+            except Exception as e:
+                fail(index, track, task, e)
+                return
+            self.transcode_pool.submit(transcode, index, track, task)
+
+        def resolve(index, track):
+            if stop.is_set():
+                slots.release()
+                return
+            task = None
+            try:
+                task = self.downloader.plan(f"{track['name']} {track['artist']}", track, folder_name=folder_name)
+                if 'result' in task:
+                    events.put(('started', index, track, None))
+                    finish(index, track, task['result'])
+                    return
+                task = self.downloader.resolve(task)
+            except Exception as e:
+                events.put(('started', index, track, None))
+                fail(index, track, task, e)
+                return
+            self.fetch_pool.submit(fetch, index, track, task)
+
+        def feed():
+            # tracks may be a lazy iterable (a playlist still being paged in): submit
+            # each track as soon as it arrives, but only read the next one when there is room
+            count, error = 0, None
+            pending = iter(tracks)
+            try:
+                while True:
+                    slots.acquire()
+                    if stop.is_set():
+                        slots.release()
+                        break
+                    try:
+                        track = next(pending)
+                    except StopIteration:
+                        slots.release()
+                        break
+                    self.resolve_pool.submit(resolve, count, track)
+                    count += 1
+            except Exception as e:
+                slots.release()
+                error = e
+            events.put(('fed', count, None, error))
+
+        threading.Thread(target=feed, name='feed', daemon=True).start()
+        try:
+            total, finished, error = None, 0, None
+            while total is None or finished < total:
+                event = events.get()
+                if event[0] == 'fed':
+                    total, error = event[1], event[3]
+                    continue
+                if event[0] == 'finished':
+                    finished += 1
+                yield event
+            if error:
+                raise error
+        finally:
+            # Tracks of this run still queued in the shared pools return right away
+            stop.set()
+
+    def shutdown(self):
+        for pool in (self.resolve_pool, self.fetch_pool, self.transcode_pool):
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,72 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class PlaylistSyncStore:
+    """Remembers, per Spotify playlist, the last synced snapshot_id and which tracks are on disk"""
+
+    def __init__(self, db_path='data/sync.db'):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS playlists (
+                id TEXT PRIMARY KEY,
+                name TEXT,
+                folder TEXT,
+                snapshot_id TEXT,
+                synced REAL
+            );
+            CREATE TABLE IF NOT EXISTS playlist_tracks (
+                playlist_id TEXT NOT NULL,
+                url TEXT NOT NULL,
+                filename TEXT,
+                PRIMARY KEY (playlist_id, url)
+            );
+        ''')
+        self.conn.commit()
+
+    def get(self, playlist_id):
+        with self._lock:
+            return self.conn.execute('SELECT * FROM playlists WHERE id = ?', (playlist_id,)).fetchone()
+
+    def tracks(self, playlist_id):
+        """Return {track_url: filename} of the tracks last seen in the playlist"""
+        with self._lock:
+            rows = self.conn.execute('SELECT url, filename FROM playlist_tracks WHERE playlist_id = ?',
+                                     (playlist_id,)).fetchall()
+        return {row['url']: row['filename'] for row in rows}
+
+    def ensure(self, playlist_id, name, folder):
+        with self._lock:
+            self.conn.execute(
+                'INSERT INTO playlists (id, name, folder) VALUES (?, ?, ?) '
+                'ON CONFLICT(id) DO UPDATE SET name = excluded.name, folder = excluded.folder',
+                (playlist_id, name, folder))
+            self.conn.commit()
+
+    def add_track(self, playlist_id, url, filename):
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO playlist_tracks (playlist_id, url, filename) VALUES (?, ?, ?)',
+                              (playlist_id, url, filename))
+            self.conn.commit()
+
+    def remove_tracks(self, playlist_id, urls):
+        with self._lock:
+            self.conn.executemany('DELETE FROM playlist_tracks WHERE playlist_id = ? AND url = ?',
+                                  [(playlist_id, url) for url in urls])
+            self.conn.commit()
+
+    def set_snapshot(self, playlist_id, snapshot_id):
+        with self._lock:
+            self.conn.execute('UPDATE playlists SET snapshot_id = ?, synced = ? WHERE id = ?',
+                              (snapshot_id, time.time(), playlist_id))
+            self.conn.commit()
@@ -0,0 +1,92 @@
+import json
+import threading
+
+from job_queue import RUNNING, DONE, FAILED, FINISHED_STATES
+
+
+class ProgressBus:
+    """In-process notifications of job changes.
+
+    JobStore publishes the job id after every write; progress streams
+    subscribe a callback instead of polling the database. Callbacks run in
+    the publishing thread, so they must be quick (set an event, wake a loop).
+    Jobs run by another process are only published here when the store
+    relays them (RedisJobStore does), which is why streams still re-check
+    the database after a timeout.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}
+
+    def subscribe(self, job_id, callback):
+        with self._lock:
+            self._subscribers.setdefault(job_id, set()).add(callback)
+
+    def unsubscribe(self, job_id, callback):
+        with self._lock:
+            callbacks = self._subscribers.get(job_id)
+            if callbacks:
+                callbacks.discard(callback)
+                if not callbacks:
+                    del self._subscribers[job_id]
+
+    def publish(self, job_id):
+        with self._lock:
+            callbacks = list(self._subscribers.get(job_id, ()))
+        for callback in callbacks:
+            callback()
+
+
+class JobProgress:
+    """Turns the stored state of a job into NDJSON status lines, one per track state change"""
+
+    def __init__(self, store, job_id):
+        self.store = store
+        self.job_id = job_id
+        self.seen = {}
+        self.since = 0
+        self.total = None
+        self.finished = False
+
+    @staticmethod
+    def line(data):
+        return json.dumps(data) + '\n'
+
+    def first(self):
+        return self.line({'status': 'processing', 'message': 'Fetching Spotify info...'})
+
+    def poll(self):
+        """Return the lines for everything that changed since the last call"""
+        lines = []
+        job = self.store.get(self.job_id)
+        if self.total is None and job['kind']:
+            self.total = job['total'] if job['total'] is not None else len(self.store.tracks(self.job_id))
+            lines.append(self.line({'status': 'processing', 'total': self.total,
+                                    'message': f"Found {job['kind']} '{job['name']}' with {self.total} tracks"}))
+        elif self.total is not None and job['total'] is not None:
+            # A streamed playlist's final count can differ from the one Spotify announced
+            self.total = job['total']
+
+        # Re-read a small window so rows committed slightly out of order are not missed
+        for row in self.store.changed_tracks(self.job_id, self.since - 2):
+            self.since = max(self.since, row['updated'])
+            if self.seen.get(row['idx']) == row['status']:
+                continue
+            self.seen[row['idx']] = row['status']
+            data = {'index': row['idx'], 'total': self.total}
+            if row['status'] == RUNNING:
+                data.update(status='processing', message=f"Downloading {row['idx']+1}/{self.total}: {row['name']}")
+            elif row['status'] == DONE:
+                data.update(status='completed', message=f"Downloaded: {row['name']}")
+            elif row['status'] == FAILED:
+                data.update(status='error', message=f"Failed: {row['name']} - {row['message'] or 'Unknown error'}")
+            else:
+                continue
+            lines.append(self.line(data))
+
+        if job['status'] in FINISHED_STATES:
+            status = 'done' if job['status'] == DONE else 'error'
+            lines.append(self.line({'status': status, 'message': job['message'] or status}))
+            self.finished = True
+        return lines
@@ -0,0 +1,90 @@
+import random
+import threading
+import time
+
+import logging
+
+from metrics import RATE_LIMIT_WAIT, THROTTLED, RATE_LIMIT
+
+
+class RateLimiter:
+    """Token bucket shared by every worker talking to one service.
+
+    The rate adapts: it drops by 30% each time the service throttles us and
+    climbs back by a twentieth of the maximum per second of successful
+    calls, so it settles just below what the service accepts. A throttle
+    with a Retry-After also pauses all workers for that long, not just the
+    one that got it.
+    """
+
+    def __init__(self, name, rate, burst=None, min_rate=None):
+        self.name = name
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.min_rate = min_rate or self.max_rate / 20
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        # Tokens accrue from this time on; it is in the future while paused
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        RATE_LIMIT.set(self.rate, service=name)
+
+    def _refill(self, now):
+        if now > self._updated:
+            # After a slowdown the bucket shrinks with the rate, so a pause does not end in a full burst
+            capacity = self.burst * self.rate / self.max_rate
+            self._tokens = min(capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def acquire(self):
+        """Block until the next request may be sent"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens -= 1
+            wait = max(self._updated - now, 0) + max(-self._tokens, 0) / self.rate
+        if wait > 0:
+            RATE_LIMIT_WAIT.inc(wait, service=self.name)
+            time.sleep(wait)
+
+    def throttled(self, delay):
+        """The service pushed back: slow down and pause everyone for `delay` seconds"""
+        THROTTLED.inc(service=self.name)
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate * 0.7)
+            self._tokens = min(self._tokens, 0)
+            self._updated = max(self._updated, now + delay)
+        RATE_LIMIT.set(self.rate, service=self.name)
+
+    def succeeded(self):
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            # Divided by the rate: the increase is about max_rate / 20 per second, whatever the rate
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20 / self.rate)
+        RATE_LIMIT.set(self.rate, service=self.name)
+
+    def call(self, fn, throttle_delay, max_retries=5, base_delay=1.0, max_delay=60.0):
+        """Run fn() under the limiter, retrying with exponential backoff while it is throttled.
+
+        throttle_delay(exception) returns None when the error is not a
+        throttle, otherwise the server's Retry-After in seconds (0 if unknown).
+        """
+        for attempt in range(max_retries + 1):
+            self.acquire()
+            try:
+                result = fn()
+            except Exception as e:
+                retry_after = throttle_delay(e)
+                if retry_after is None or attempt == max_retries:
+                    raise
+                # Jitter keeps workers that were throttled together from retrying together
+                delay = retry_after or min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1)
+                logging.warning(f"{self.name} is throttling requests, retrying in {delay:.1f}s "
+                                f"(attempt {attempt + 1}/{max_retries})")
+                self.throttled(delay)
+                continue
+            self.succeeded()
+            return result
@@ -0,0 +1,295 @@
+"""Job queue in Redis, for download workers spread over several machines.
+
+RedisJobStore has the same methods as job_queue.JobStore, so JobRunner,
+the progress streams and the /jobs routes work with either. Jobs are
+claimed with a Lua script (atomic on the server) and leased like in SQLite:
+a running job whose heartbeat is older than LEASE_SECONDS is claimed again
+and its unfinished tracks start over. Every change is also published on a
+channel, so the web app wakes its progress streams for jobs that run in
+other processes instead of waiting for the next poll.
+
+Keys, all under `prefix`:
+    job:<id>            hash, the job row
+    job:<id>:tracks     hash, idx -> JSON of the track row
+    job:<id>:updated    sorted set, idx scored by the last update of the track
+    job:<id>:counts     hash, track state -> number of tracks
+    jobs                sorted set of every job id, scored by creation time
+    jobs:<state>        sorted set of the job ids in a state; running jobs are scored by heartbeat
+    library             library_id of the web app's library database
+"""
+import json
+import threading
+import time
+import uuid
+
+import redis
+
+import logging
+
+from job_queue import PENDING, RUNNING, DONE, FAILED, LEASE_SECONDS, job_summary
+
+JOB_STATES = (PENDING, RUNNING, DONE, FAILED)
+INT_FIELDS = ('sync', 'prune', 'total', 'listed')
+FLOAT_FIELDS = ('heartbeat', 'created', 'updated')
+JOB_FIELDS = ('id', 'url', 'kind', 'name', 'folder', 'status', 'message', 'sync', 'prune', 'snapshot_id',
+              'total', 'listed', 'owner', 'heartbeat', 'created', 'updated')
+
+# KEYS: pending set, running set. ARGV: now, lease seconds, owner, key prefix.
+# Abandoned jobs first (they were started before anything still queued), then the oldest queued one.
+CLAIM_SCRIPT = """
+local id = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', '(' .. (ARGV[1] - ARGV[2]), 'LIMIT', 0, 1)[1]
+if not id then
+    id = redis.call('ZPOPMIN', KEYS[1])[1]
+end
+if not id then
+    return false
+end
+redis.call('ZADD', KEYS[2], ARGV[1], id)
+redis.call('HSET', ARGV[4] .. 'job:' .. id, 'status', 'running', 'owner', ARGV[3],
+           'heartbeat', ARGV[1], 'updated', ARGV[1])
+return id
+"""
+
+# KEYS: job hash, pending set, running set. ARGV: job id, owner, now.
+RELEASE_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[2] or redis.call('HGET', KEYS[1], 'status') ~= 'running' then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'status', 'pending', 'updated', ARGV[3])
+redis.call('HDEL', KEYS[1], 'owner', 'heartbeat')
+redis.call('ZREM', KEYS[3], ARGV[1])
+redis.call('ZADD', KEYS[2], redis.call('HGET', KEYS[1], 'created'), ARGV[1])
+return 1
+"""
+
+
+class RedisJobStore:
+    """Redis-backed store for download jobs and their per-track state, see the module docstring"""
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='sopotify:', on_change=None):
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.channel = f"{prefix}changes"
+        # Called with the job id after every change of a job or its tracks, made here or in another process
+        self.on_change = on_change
+        self._claim = self.redis.register_script(CLAIM_SCRIPT)
+        self._release = self.redis.register_script(RELEASE_SCRIPT)
+        if on_change:
+            threading.Thread(target=self._listen, name='job-changes', daemon=True).start()
+
+    def _key(self, *parts):
+        return self.prefix + ':'.join(parts)
+
+    def set_library(self, library_id):
+        """Announce the library database of the web app, see worker.check_library"""
+        self.redis.set(self._key('library'), library_id)
+
+    def library(self):
+        value = self.redis.get(self._key('library'))
+        return value.decode() if value else None
+
+    def _changed(self, job_id):
+        try:
+            self.redis.publish(self.channel, job_id)
+        except redis.RedisError as e:
+            logging.warning(f"Could not publish job change: {e}")
+
+    def _listen(self):
+        """Relay the changes published by every process to on_change"""
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    try:
+                        self.on_change(message['data'].decode())
+                    except Exception as e:
+                        logging.warning(f"Job change listener failed: {e}")
+            except redis.RedisError as e:
+                logging.warning(f"Lost the job change channel, reconnecting: {e}")
+                time.sleep(1)
+
+    @staticmethod
+    def _job(data):
+        if not data:
+            return None
+        job = {key.decode(): value.decode() for key, value in data.items()}
+        for field in INT_FIELDS:
+            if field in job:
+                job[field] = int(job[field])
+        for field in FLOAT_FIELDS:
+            if field in job:
+                job[field] = float(job[field])
+        return {field: job.get(field) for field in JOB_FIELDS}
+
+    def create(self, url, sync=False, prune=False):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key('job', job_id), mapping={
+            'id': job_id, 'url': url, 'status': PENDING, 'sync': int(sync), 'prune': int(prune), 'listed': 1,
+            'created': now, 'updated': now})
+        pipe.zadd(self._key('jobs'), {job_id: now})
+        pipe.zadd(self._key('jobs', PENDING), {job_id: now})
+        pipe.execute()
+        return job_id
+
+    def claim(self, owner):
+        """Atomically take an abandoned or the oldest queued job. Returns the job or None"""
+        now = time.time()
+        job_id = self._claim(keys=[self._key('jobs', PENDING), self._key('jobs', RUNNING)],
+                             args=[now, LEASE_SECONDS, owner, self.prefix])
+        if not job_id:
+            return None
+        job_id = job_id.decode()
+        # Tracks left running by a dead owner start over
+        running = [track for track in self.tracks(job_id) if track['status'] == RUNNING]
+        if running:
+            self._save_tracks(job_id, running, PENDING, now)
+        return self.get(job_id)
+
+    def heartbeat(self, owner):
+        now = time.time()
+        job_ids = [job_id.decode() for job_id in self.redis.zrange(self._key('jobs', RUNNING), 0, -1)]
+        if not job_ids:
+            return
+        pipe = self.redis.pipeline()
+        for job_id in job_ids:
+            pipe.hget(self._key('job', job_id), 'owner')
+        owners = pipe.execute()
+        for job_id, job_owner in zip(job_ids, owners):
+            if job_owner and job_owner.decode() == owner:
+                pipe.hset(self._key('job', job_id), 'heartbeat', now)
+                pipe.zadd(self._key('jobs', RUNNING), {job_id: now}, xx=True)
+        pipe.execute()
+
+    def release(self, job_id, owner):
+        """Put a job back in the queue right away when its owner stops, instead of waiting for the lease"""
+        released = self._release(keys=[self._key('job', job_id), self._key('jobs', PENDING),
+                                       self._key('jobs', RUNNING)],
+                                 args=[job_id, owner, time.time()])
+        if released:
+            self._changed(job_id)
+
+    def set_collection(self, job_id, kind, name, folder, tracks, snapshot_id=None, total=None, listed=True):
+        now = time.time()
+        fields = {'kind': kind, 'name': name, 'folder': folder,
+                  'total': total if total is not None else len(tracks), 'listed': int(listed), 'updated': now}
+        if snapshot_id is not None:
+            fields['snapshot_id'] = snapshot_id
+        self.redis.hset(self._key('job', job_id), mapping=fields)
+        self._insert_tracks(job_id, 0, tracks, now)
+        self._changed(job_id)
+
+    def _insert_tracks(self, job_id, start, tracks, now):
+        """Add tracks at idx start, start+1, ... leaving the ones already stored as they are"""
+        pipe = self.redis.pipeline()
+        for i, t in enumerate(tracks):
+            row = {'job_id': job_id, 'idx': start + i, 'name': t['name'], 'artist': t['artist'],
+                   'album': t.get('album'), 'image': t.get('image'), 'url': t.get('url'), 'isrc': t.get('isrc'),
+                   'status': PENDING, 'message': None, 'filename': None, 'updated': now}
+            pipe.hsetnx(self._key('job', job_id, 'tracks'), start + i, json.dumps(row))
+        added = [start + i for i, new in enumerate(pipe.execute()) if new]
+        if added:
+            pipe.hincrby(self._key('job', job_id, 'counts'), PENDING, len(added))
+            pipe.zadd(self._key('job', job_id, 'updated'), {idx: now for idx in added})
+            pipe.execute()
+
+    def add_tracks(self, job_id, start, tracks):
+        """Append a page of a streamed collection (idx from start on) and return its tracks still pending"""
+        self._insert_tracks(job_id, start, tracks, time.time())
+        rows = self.redis.hmget(self._key('job', job_id, 'tracks'), list(range(start, start + len(tracks))))
+        return [track for track in map(self._track, rows) if track and track['status'] == PENDING]
+
+    def set_listed(self, job_id):
+        """Every track of a streamed collection is stored now"""
+        total = self.redis.hlen(self._key('job', job_id, 'tracks'))
+        self.redis.hset(self._key('job', job_id), mapping={'listed': 1, 'total': total, 'updated': time.time()})
+        self._changed(job_id)
+
+    def finish(self, job_id, status, message=None):
+        job_key = self._key('job', job_id)
+        pipe = self.redis.pipeline()
+        pipe.hset(job_key, mapping={'status': status, 'updated': time.time()})
+        if message is None:
+            pipe.hdel(job_key, 'message')
+        else:
+            pipe.hset(job_key, 'message', message)
+        for state in JOB_STATES:
+            if state != status:
+                pipe.zrem(self._key('jobs', state), job_id)
+        pipe.execute()
+        created = self.redis.hget(job_key, 'created')
+        if created:
+            self.redis.zadd(self._key('jobs', status), {job_id: float(created)})
+        self._changed(job_id)
+
+    @staticmethod
+    def _track(data):
+        return json.loads(data) if data else None
+
+    def _save_tracks(self, job_id, tracks, status, now, message=None, filename=None):
+        """Store a new state for tracks read before, keeping the per-state counts in step"""
+        pipe = self.redis.pipeline()
+        for track in tracks:
+            pipe.hincrby(self._key('job', job_id, 'counts'), track['status'], -1)
+            pipe.hincrby(self._key('job', job_id, 'counts'), status, 1)
+            track.update(status=status, message=message, updated=now)
+            if filename:
+                track['filename'] = filename
+            pipe.hset(self._key('job', job_id, 'tracks'), track['idx'], json.dumps(track))
+            pipe.zadd(self._key('job', job_id, 'updated'), {track['idx']: now})
+        pipe.execute()
+
+    def update_track(self, job_id, idx, status, message=None, filename=None):
+        # Only the worker holding the job's lease writes its tracks, so read-then-write is safe
+        track = self._track(self.redis.hget(self._key('job', job_id, 'tracks'), idx))
+        if not track:
+            return
+        self._save_tracks(job_id, [track], status, time.time(), message, filename)
+        self._changed(job_id)
+
+    def get(self, job_id):
+        return self._job(self.redis.hgetall(self._key('job', job_id)))
+
+    def tracks(self, job_id, statuses=None):
+        rows = [self._track(data) for data in self.redis.hvals(self._key('job', job_id, 'tracks'))]
+        if statuses:
+            rows = [row for row in rows if row['status'] in statuses]
+        return sorted(rows, key=lambda row: row['idx'])
+
+    def changed_tracks(self, job_id, since):
+        idxs = self.redis.zrangebyscore(self._key('job', job_id, 'updated'), f"({since}", '+inf')
+        if not idxs:
+            return []
+        rows = self.redis.hmget(self._key('job', job_id, 'tracks'), idxs)
+        return sorted((row for row in map(self._track, rows) if row), key=lambda row: row['updated'])
+
+    def summary(self, job_id):
+        """Job as a dict plus per-state track counts, or None"""
+        job = self.get(job_id)
+        if not job:
+            return None
+        counts = {key.decode(): int(value)
+                  for key, value in self.redis.hgetall(self._key('job', job_id, 'counts')).items()}
+        return job_summary(job, counts)
+
+    def counts(self):
+        """Number of jobs per state, e.g. the queue depth is counts()[PENDING]"""
+        pipe = self.redis.pipeline()
+        for state in JOB_STATES:
+            pipe.zcard(self._key('jobs', state))
+        return dict(zip(JOB_STATES, pipe.execute()))
+
+    def pending_tracks(self):
+        """Tracks still waiting in queued or running jobs"""
+        job_ids = [job_id.decode() for state in (PENDING, RUNNING)
+                   for job_id in self.redis.zrange(self._key('jobs', state), 0, -1)]
+        pipe = self.redis.pipeline()
+        for job_id in job_ids:
+            pipe.hget(self._key('job', job_id, 'counts'), PENDING)
+        return sum(int(count or 0) for count in pipe.execute())
+
+    def recent(self, limit=20):
+        job_ids = self.redis.zrevrange(self._key('jobs'), 0, limit - 1)
+        return [self.summary(job_id.decode()) for job_id in job_ids]
@@ -0,0 +1,114 @@
+"""Worker state shared through Redis, for download workers on several machines.
+
+With JOB_QUEUE=redis a job may run on any worker, so the state that decides
+what a job downloads cannot stay in each machine's SQLite files. These
+stores have the same methods as their SQLite counterparts:
+
+    RedisSyncStore      playlist_sync.PlaylistSyncStore (snapshots of synced playlists)
+    RedisDownloadIndex  download_index.DownloadIndex (tracks already downloaded, for dedup)
+    RedisResolveCache   resolve_cache.ResolveCache (YouTube search results)
+
+Keys, all under `prefix`:
+    playlist:<id>           hash, name / folder / snapshot_id / synced
+    playlist:<id>:tracks    hash, track URL -> filename ('' when unknown)
+    downloads               hash, track key -> relative path
+    downloads:<path>        set of the track keys pointing at a path
+    resolved                hash, normalized query -> JSON [video_id, title]
+"""
+import json
+import time
+
+import redis
+
+from resolve_cache import normalize_query
+
+
+class RedisState:
+    def __init__(self, url='redis://localhost:6379/0', prefix='sopotify:'):
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, *parts):
+        return self.prefix + ':'.join(parts)
+
+
+class RedisSyncStore(RedisState):
+    """Remembers, per Spotify playlist, the last synced snapshot_id and which tracks are on disk"""
+
+    def get(self, playlist_id):
+        data = self.redis.hgetall(self._key('playlist', playlist_id))
+        if not data:
+            return None
+        state = {key.decode(): value.decode() for key, value in data.items()}
+        state['id'] = playlist_id
+        state.setdefault('snapshot_id', None)
+        state['synced'] = float(state['synced']) if 'synced' in state else None
+        return state
+
+    def tracks(self, playlist_id):
+        """Return {track_url: filename} of the tracks last seen in the playlist"""
+        data = self.redis.hgetall(self._key('playlist', playlist_id, 'tracks'))
+        return {url.decode(): filename.decode() or None for url, filename in data.items()}
+
+    def ensure(self, playlist_id, name, folder):
+        self.redis.hset(self._key('playlist', playlist_id), mapping={'name': name, 'folder': folder})
+
+    def add_track(self, playlist_id, url, filename):
+        self.redis.hset(self._key('playlist', playlist_id, 'tracks'), url, filename or '')
+
+    def remove_tracks(self, playlist_id, urls):
+        if urls:
+            self.redis.hdel(self._key('playlist', playlist_id, 'tracks'), *urls)
+
+    def set_snapshot(self, playlist_id, snapshot_id):
+        key = self._key('playlist', playlist_id)
+        # Only for playlists ensure()d before, like the UPDATE of the SQLite store
+        if self.redis.exists(key):
+            self.redis.hset(key, mapping={'snapshot_id': snapshot_id, 'synced': time.time()})
+
+
+class RedisDownloadIndex(RedisState):
+    """Maps Spotify track identities to files already downloaded under downloads/"""
+
+    def lookup(self, keys):
+        """Return the first stored relative path for any of the keys, or None"""
+        if not keys:
+            return None
+        for path in self.redis.hmget(self._key('downloads'), keys):
+            if path is not None:
+                return path.decode()
+        return None
+
+    def add(self, keys, path):
+        if not keys:
+            return
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key('downloads'), mapping={key: path for key in keys})
+        pipe.sadd(self._key('downloads', path), *keys)
+        pipe.execute()
+
+    def forget(self, path):
+        keys = list(self.redis.smembers(self._key('downloads', path)))
+        # A key added again later points at another file by now
+        current = self.redis.hmget(self._key('downloads'), keys) if keys else []
+        keys = [key for key, value in zip(keys, current) if value is not None and value.decode() == path]
+        pipe = self.redis.pipeline()
+        if keys:
+            pipe.hdel(self._key('downloads'), *keys)
+        pipe.delete(self._key('downloads', path))
+        pipe.execute()
+
+
+class RedisResolveCache(RedisState):
+    """Shared cache of YouTube search results: search query -> video ID"""
+
+    def get(self, query):
+        """Return (video_id, title) or None"""
+        value = self.redis.hget(self._key('resolved'), normalize_query(query))
+        return tuple(json.loads(value)) if value else None
+
+    def set(self, query, video_id, title=None):
+        self.redis.hset(self._key('resolved'), normalize_query(query), json.dumps([video_id, title]))
+
+    def forget(self, query):
+        self.redis.hdel(self._key('resolved'), normalize_query(query))
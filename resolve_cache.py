@@ -0,0 +1,49 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+
+class ResolveCache:
+    """Persistent cache of YouTube search results: search query -> video ID"""
+
+    def __init__(self, db_path='data/resolve.db'):
+        self.db_path = db_path
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS resolved (
+                query TEXT PRIMARY KEY,
+                video_id TEXT NOT NULL,
+                title TEXT,
+                created REAL NOT NULL
+            )
+        ''')
+        self.conn.commit()
+
+    def get(self, query):
+        """Return (video_id, title) or None"""
+        with self._lock:
+            row = self.conn.execute('SELECT video_id, title FROM resolved WHERE query = ?',
+                                    (normalize_query(query),)).fetchone()
+        return tuple(row) if row else None
+
+    def set(self, query, video_id, title=None):
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO resolved (query, video_id, title, created) VALUES (?, ?, ?, ?)',
+                              (normalize_query(query), video_id, title, time.time()))
+            self.conn.commit()
+
+    def forget(self, query):
+        with self._lock:
+            self.conn.execute('DELETE FROM resolved WHERE query = ?', (normalize_query(query),))
+            self.conn.commit()
@@ -1,114 +1,325 @@
+import requests
 import spotipy
+from spotipy.exceptions import SpotifyException
 from spotipy.oauth2 import SpotifyClientCredentials
+from urllib3.util.retry import Retry
+from collections import OrderedDict
 import os
+import re
+import threading
+import time
 
 import logging
 
+from metrics import SPOTIFY_SECONDS, SPOTIFY_RETRIES
+from rate_limit import RateLimiter
+
+# Matches: .../track/ID, .../playlist/ID, .../album/ID
+SPOTIFY_URL_RE = re.compile(r'(track|playlist|album)/([a-zA-Z0-9]+)')
+# Remove invalid characters for Windows/Unix file systems
+INVALID_PATH_CHARS_RE = re.compile(r'[<>:"/\\|?*]')
+
+# Only ask Spotify for the fields we actually use
+TRACK_FIELDS = 'name,artists(name),album(name,images),external_urls,external_ids'
+PLAYLIST_ITEM_FIELDS = f'items(track({TRACK_FIELDS})),next'
+PLAYLIST_FIELDS = f'name,snapshot_id,tracks(total,next,items(track({TRACK_FIELDS})))'
+
+# Maximum number of IDs accepted by the batch tracks endpoint
+TRACKS_BATCH_SIZE = 50
+
+# Server errors retried by urllib3 inside a request. 429 is not in the list:
+# rate limiting is handled by the shared RateLimiter so every worker slows down.
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# IDs in API paths, replaced so request metrics are grouped per endpoint
+SPOTIFY_ID_RE = re.compile(r'(/(?:tracks|albums|artists|playlists|users)/)[^/]+')
+
+
+class CountingRetry(Retry):
+    """urllib3 Retry that counts every retry (5xx, connection errors)"""
+
+    def increment(self, method=None, url=None, response=None, error=None, *args, **kwargs):
+        SPOTIFY_RETRIES.inc(status=response.status if response is not None else 'error')
+        return super().increment(method, url, response, error, *args, **kwargs)
+
+
+def throttle_delay(error):
+    """Retry-After of a 429 response (0 when missing), None for any other error.
+
+    spotipy also raises a 429 when urllib3 gave up retrying (RetryError); no
+    response came back, so it has no headers (spotipy stores them as {}) and
+    is not a throttle.
+    """
+    if not isinstance(error, SpotifyException) or error.http_status != 429 or not error.headers:
+        return None
+    try:
+        return float(error.headers.get('Retry-After') or 0)
+    except ValueError:
+        return 0
+
+
+class InstrumentedSpotify(spotipy.Spotify):
+    """spotipy client that records request latency and retries, and goes through a shared RateLimiter"""
+
+    def __init__(self, *args, limiter=None, **kwargs):
+        kwargs.setdefault('status_forcelist', RETRY_STATUSES)
+        self.limiter = limiter
+        super().__init__(*args, **kwargs)
+
+    def _build_session(self):
+        # Same session as spotipy builds, with the counting Retry
+        self._session = requests.Session()
+        retry = CountingRetry(
+            total=self.retries,
+            connect=None,
+            read=False,
+            allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+            status=self.status_retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=self.status_forcelist)
+        adapter = requests.adapters.HTTPAdapter(max_retries=retry)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def _internal_call(self, method, url, payload, params):
+        path = url.split('?', 1)[0]
+        if path.startswith(self.prefix):
+            path = path[len(self.prefix):]
+        endpoint = SPOTIFY_ID_RE.sub(r'\1:id', '/' + path.strip('/'))
+        call = super()._internal_call
+        with SPOTIFY_SECONDS.time(endpoint=endpoint):
+            if not self.limiter:
+                return call(method, url, payload, params)
+            return self.limiter.call(lambda: call(method, url, payload, params), throttle_delay)
+
+
+class MetadataCache:
+    """Thread-safe LRU cache whose entries also expire after a TTL"""
+
+    def __init__(self, maxsize=512, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
 class SpotifyService:
-    def __init__(self):
+    def __init__(self, cache_size=512, cache_ttl=600, rate_limit=10):
         self.client_id = os.getenv('SPOTIPY_CLIENT_ID')
         self.client_secret = os.getenv('SPOTIPY_CLIENT_SECRET')
-        
+
         if not self.client_id or not self.client_secret:
             raise ValueError("Spotify credentials not found in environment variables")
-            
-        self.sp = spotipy.Spotify(auth_manager=SpotifyClientCredentials(
+
+        # Requests per second shared by all workers, lowered automatically on 429s
+        self.limiter = RateLimiter('spotify', rate_limit)
+        self.sp = InstrumentedSpotify(auth_manager=SpotifyClientCredentials(
             client_id=self.client_id,
             client_secret=self.client_secret
-        ))
+        ), limiter=self.limiter)
+        self.cache = MetadataCache(maxsize=cache_size, ttl=cache_ttl)
 
-    def _clean_url(self, url):
-        import re
-        # Extract ID and type using regex
-        # Matches: .../track/ID, .../playlist/ID, .../album/ID
-        match = re.search(r'(track|playlist|album)/([a-zA-Z0-9]+)', url)
+    def _parse_url(self, url):
+        """Return (type, id) for a Spotify URL, or (None, None)"""
+        match = SPOTIFY_URL_RE.search(url)
         if match:
-            type_ = match.group(1)
-            id_ = match.group(2)
+            return match.group(1), match.group(2)
+        return None, None
+
+    def _clean_url(self, url):
+        type_, id_ = self._parse_url(url)
+        if type_:
             return f"https://open.spotify.com/{type_}/{id_}"
-        
+
         # Fallback to simple cleaning if no match (though regex should cover valid cases)
         url = url.strip()
         if '?' in url:
             url = url.split('?')[0]
         return url
 
+    @staticmethod
+    def _sanitize(name):
+        return INVALID_PATH_CHARS_RE.sub('', name).strip()
+
+    @staticmethod
+    def _clean_track(track, album=None):
+        """Reduce a Spotify track object to the dict used by the downloader"""
+        album = album or track.get('album') or {}
+        images = album.get('images') or []
+        return {
+            'name': track['name'],
+            'artist': track['artists'][0]['name'],
+            'album': album.get('name', 'Unknown Album'),
+            'image': images[0]['url'] if images else None,
+            'url': track['external_urls']['spotify'],
+            'isrc': (track.get('external_ids') or {}).get('isrc')
+        }
+
+    def _fetch_tracks(self, track_ids):
+        """Fetch full track objects through the batch endpoint, using the cache where possible"""
+        found = {}
+        missing = []
+        for track_id in track_ids:
+            cached = self.cache.get(('track', track_id))
+            if cached:
+                found[track_id] = cached
+            else:
+                missing.append(track_id)
+
+        for start in range(0, len(missing), TRACKS_BATCH_SIZE):
+            batch = missing[start:start + TRACKS_BATCH_SIZE]
+            for track in self.sp.tracks(batch)['tracks']:
+                if track:
+                    cleaned = self._clean_track(track)
+                    self.cache.set(('track', track['id']), cleaned)
+                    found[track['id']] = cleaned
+        return found
+
     def get_track_info(self, url):
         try:
-            url = self._clean_url(url)
-            track = self.sp.track(url)
-            return {
-                'name': track['name'],
-                'artist': track['artists'][0]['name'],
-                'album': track['album']['name'],
-                'image': track['album']['images'][0]['url'] if track['album']['images'] else None,
-                'url': track['external_urls']['spotify']
-            }
+            type_, track_id = self._parse_url(url)
+            track_id = track_id or self._clean_url(url)
+            cached = self.cache.get(('track', track_id))
+            if cached:
+                return dict(cached)
+            track = self._clean_track(self.sp.track(track_id))
+            self.cache.set(('track', track_id), track)
+            return dict(track)
         except Exception as e:
             logging.error(f"Error fetching track for URL '{url}': {e}")
             return None
 
+    def playlist_id(self, url):
+        type_, playlist_id = self._parse_url(url)
+        return playlist_id or self._clean_url(url)
+
+    def get_playlist_snapshot(self, url):
+        """Current snapshot_id of a playlist: a single tiny request, never cached"""
+        return self.sp.playlist(self.playlist_id(url), fields='snapshot_id')['snapshot_id']
+
+    def stream_playlist(self, url):
+        """Fetch a playlist lazily: returns (info, pages).
+
+        info (name, snapshot_id, total) comes from the first request; pages
+        is a generator of cleaned track lists, one per API page, fetched only
+        as it is iterated. Nothing is kept in memory or cached, so a consumer
+        can start on the first tracks of a huge playlist right away.
+        """
+        playlist_id = self.playlist_id(url)
+        cached = self.cache.get(('playlist', playlist_id))
+        if cached:
+            info = {'name': cached['name'], 'snapshot_id': cached['snapshot_id'], 'total': len(cached['tracks'])}
+            return info, iter([list(cached['tracks'])])
+        return self._fetch_playlist(playlist_id)
+
+    def _fetch_playlist(self, playlist_id):
+        playlist = self.sp.playlist(playlist_id, fields=PLAYLIST_FIELDS)
+        info = {
+            'name': self._sanitize(playlist['name']),
+            'snapshot_id': playlist.get('snapshot_id'),
+            'total': playlist['tracks'].get('total'),
+        }
+        return info, self._playlist_pages(playlist_id, playlist['tracks'])
+
+    def _playlist_pages(self, playlist_id, page):
+        offset = 0
+        while True:
+            offset += len(page['items'])
+            yield [self._clean_track(item['track']) for item in page['items'] if item.get('track')]
+            if not page['next']:
+                return
+            page = self.sp.playlist_items(playlist_id, fields=PLAYLIST_ITEM_FIELDS,
+                                          limit=100, offset=offset)
+            if not page['items']:
+                return
+
+    def get_playlist(self, url, snapshot_id=None):
+        """Fetch a playlist's name, snapshot and cleaned tracks in one pass (cached).
+
+        When snapshot_id is given, a cached copy of another snapshot is refetched.
+        """
+        playlist_id = self.playlist_id(url)
+        cached = self.cache.get(('playlist', playlist_id))
+        if cached and (snapshot_id is None or cached['snapshot_id'] == snapshot_id):
+            return cached
+
+        info, pages = self._fetch_playlist(playlist_id)
+        result = {
+            'name': info['name'],
+            'snapshot_id': info['snapshot_id'],
+            'tracks': [track for page in pages for track in page]
+        }
+        self.cache.set(('playlist', playlist_id), result)
+        return result
+
+    def get_album(self, url):
+        """Fetch an album's name and fully populated tracks in one pass (cached)"""
+        type_, album_id = self._parse_url(url)
+        album_id = album_id or self._clean_url(url)
+        cached = self.cache.get(('album', album_id))
+        if cached:
+            return cached
+
+        album = self.sp.album(album_id)
+        results = album['tracks']
+        items = results['items']
+        while results['next']:
+            results = self.sp.next(results)
+            items.extend(results['items'])
+
+        # Album track items are simplified objects: no ISRC, no album info.
+        # Fill them in from the batch endpoint, falling back to the album object.
+        full = self._fetch_tracks([item['id'] for item in items if item and item.get('id')])
+        tracks = []
+        for item in items:
+            if not item:
+                continue
+            tracks.append(full.get(item.get('id')) or self._clean_track(item, album=album))
+
+        result = {
+            'name': self._sanitize(album['name']),
+            'tracks': tracks
+        }
+        self.cache.set(('album', album_id), result)
+        return result
+
     def get_playlist_tracks(self, url):
         try:
-            url = self._clean_url(url)
-            results = self.sp.playlist_tracks(url)
-            tracks = results['items']
-            while results['next']:
-                results = self.sp.next(results)
-                tracks.extend(results['items'])
-            
-            cleaned_tracks = []
-            for item in tracks:
-                track = item['track']
-                if track:
-                    cleaned_tracks.append({
-                        'name': track['name'],
-                        'artist': track['artists'][0]['name'],
-                        'album': track['album']['name'],
-                        'image': track['album']['images'][0]['url'] if track['album']['images'] else None,
-                        'url': track['external_urls']['spotify']
-                    })
-            return cleaned_tracks
+            return list(self.get_playlist(url)['tracks'])
         except Exception as e:
             logging.error(f"Error fetching playlist: {e}")
             return None
-    
+
     def get_playlist_name(self, url):
         """Get playlist name and return sanitized folder name"""
         try:
-            url = self._clean_url(url)
-            playlist = self.sp.playlist(url)
-            # Sanitize playlist name for folder
-            import re
-            name = playlist['name']
-            # Remove invalid characters for Windows/Unix file systems
-            sanitized = re.sub(r'[<>:"/\\|?*]', '', name)
-            return sanitized.strip()
+            return self.get_playlist(url)['name']
         except Exception as e:
             logging.error(f"Error getting playlist name: {e}")
             return "Unknown Playlist"
 
     def get_album_tracks(self, url):
         try:
-            url = self._clean_url(url)
-            results = self.sp.album_tracks(url)
-            tracks = results['items']
-            while results['next']:
-                results = self.sp.next(results)
-                tracks.extend(results['items'])
-            
-            cleaned_tracks = []
-            for track in tracks:
-                # Album tracks object is slightly different, doesn't have 'track' key wrapper
-                if track:
-                    cleaned_tracks.append({
-                        'name': track['name'],
-                        'artist': track['artists'][0]['name'],
-                        'album': "Unknown Album", # Album tracks don't always have album info in the list item
-                        'image': None, # Images are usually on the album object, not individual tracks here
-                        'url': track['external_urls']['spotify']
-                    })
-            return cleaned_tracks
+            return list(self.get_album(url)['tracks'])
         except Exception as e:
             logging.error(f"Error fetching album: {e}")
             return None
@@ -116,12 +327,7 @@ class SpotifyService:
     def get_album_name(self, url):
         """Get album name and return sanitized folder name"""
         try:
-            url = self._clean_url(url)
-            album = self.sp.album(url)
-            import re
-            name = album['name']
-            sanitized = re.sub(r'[<>:"/\\|?*]', '', name)
-            return sanitized.strip()
+            return self.get_album(url)['name']
         except Exception as e:
             logging.error(f"Error getting album name: {e}")
             return "Unknown Album"
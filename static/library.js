@@ -1,28 +1,65 @@
 // Library management variables
-let libraryData = null;
+let libraryStats = null;
 let currentView = 'playlists'; // 'playlists' or 'artists'
 
+// Pagination state of the track list currently shown
+const PAGE_SIZE = 200;
+let currentQuery = {};
+let nextCursor = null;
+let loadingPage = false;
+
+// Fetch one page of tracks from the server
+async function fetchTracksPage(query, cursor) {
+    const params = new URLSearchParams({ ...query, limit: PAGE_SIZE });
+    if (cursor) params.set('cursor', cursor);
+    const response = await fetch(`/library?${params}`);
+    return response.json();
+}
+
+// Show the first page of tracks matching a query ({folder}, {artist}, or {} for everything)
+async function showTracks(query) {
+    currentQuery = query;
+    nextCursor = null;
+    const data = await fetchTracksPage(query);
+    if (query !== currentQuery) return;
+
+    currentTrackList = data.tracks || [];
+    nextCursor = data.next_cursor;
+    populateTrackTable(currentTrackList);
+}
+
+// Append the next page of the current list (infinite scroll)
+async function loadMoreTracks() {
+    if (!nextCursor || loadingPage) return;
+    loadingPage = true;
+    const query = currentQuery;
+    try {
+        const data = await fetchTracksPage(query, nextCursor);
+        if (query !== currentQuery) return;
+
+        const start = currentTrackList.length;
+        currentTrackList.push(...data.tracks);
+        nextCursor = data.next_cursor;
+        appendTrackRows(data.tracks, start);
+    } catch (e) {
+        console.error('Error loading more tracks:', e);
+    } finally {
+        loadingPage = false;
+    }
+}
+
 // Load library data from server
 async function loadLibrary() {
     try {
-        const response = await fetch('/stats');
-        const data = await response.json();
-        libraryData = data;
+        const response = await fetch('/library/stats');
+        libraryStats = await response.json();
 
-        const trackListBody = document.getElementById('track-list-body');
+        // Update header count
         const headerCount = document.getElementById('header-count');
+        headerCount.innerText = `${libraryStats.count} songs`;
 
-        trackListBody.innerHTML = '';
-
-        if (data.tracks && data.tracks.length > 0) {
-            currentTrackList = data.tracks;
-
-            // Update header count
-            headerCount.innerText = `${data.tracks.length} songs`;
-
-            // Populate main track table with all tracks
-            populateTrackTable(data.tracks);
-        }
+        // Populate main track table with the newest tracks
+        await showTracks({});
 
         // Update sidebar based on current view
         updateSidebar();
@@ -33,54 +70,49 @@ async function loadLibrary() {
 
 // Update sidebar based on current view (playlists or artists)
 function updateSidebar() {
-    if (!libraryData) return;
+    if (!libraryStats) return;
 
     const list = document.getElementById('library-list');
     list.innerHTML = '';
 
     if (currentView === 'playlists') {
         // Show folders (playlists/albums/artists)
-        Object.keys(libraryData.library).sort().forEach(folderName => {
-            const tracks = libraryData.library[folderName];
-            if (tracks.length === 0) return;
+        const pinned = pinnedFolders();
+        libraryStats.folders.forEach(({ folder: folderName, count }) => {
+            if (count === 0) return;
 
             const li = document.createElement('li');
             li.className = 'library-item folder-item';
-            li.onclick = () => showFolderTracks(folderName, tracks);
+            li.onclick = () => showFolderTracks(folderName, count);
             li.innerHTML = `
                 <div class="lib-img">
                     <i class="fas fa-folder"></i>
                 </div>
                 <div class="lib-text">
                     <div class="lib-title">${folderName}</div>
-                    <div class="lib-desc">${tracks.length} song${tracks.length !== 1 ? 's' : ''}</div>
+                    <div class="lib-desc">${count} song${count !== 1 ? 's' : ''}</div>
                 </div>
+                <button class="download-track-btn${pinned.has(folderName) ? ' pinned' : ''}" onclick="togglePinFolder('${folderName.replace(/'/g, "\\'")}', event)" title="${pinned.has(folderName) ? 'Remove from offline' : 'Keep offline'}">
+                    <i class="fas fa-thumbtack"></i>
+                </button>
+                <button class="download-track-btn" onclick="downloadFolder('${folderName.replace(/'/g, "\\'")}', event)" title="Download as ZIP">
+                    <i class="fas fa-file-zipper"></i>
+                </button>
             `;
             list.appendChild(li);
         });
     } else if (currentView === 'artists') {
-        // Group by artist
-        const artistMap = {};
-        libraryData.tracks.forEach(track => {
-            const artist = track.artist || 'Unknown Artist';
-            if (!artistMap[artist]) {
-                artistMap[artist] = [];
-            }
-            artistMap[artist].push(track);
-        });
-
-        Object.keys(artistMap).sort().forEach(artist => {
-            const tracks = artistMap[artist];
+        libraryStats.artists.forEach(({ artist, count }) => {
             const li = document.createElement('li');
             li.className = 'library-item artist-item';
-            li.onclick = () => showArtistTracks(artist, tracks);
+            li.onclick = () => showArtistTracks(artist, count);
             li.innerHTML = `
                 <div class="lib-img">
                     <i class="fas fa-user-music"></i>
                 </div>
                 <div class="lib-text">
                     <div class="lib-title">${artist}</div>
-                    <div class="lib-desc">${tracks.length} song${tracks.length !== 1 ? 's' : ''}</div>
+                    <div class="lib-desc">${count} song${count !== 1 ? 's' : ''}</div>
                 </div>
             `;
             list.appendChild(li);
@@ -129,11 +161,17 @@ function cleanTitle(title) {
 function populateTrackTable(tracks) {
     const trackListBody = document.getElementById('track-list-body');
     trackListBody.innerHTML = '';
+    appendTrackRows(tracks, 0);
+}
+
+// Append rows for tracks, numbering them from offset
+function appendTrackRows(tracks, offset) {
+    const trackListBody = document.getElementById('track-list-body');
 
     tracks.forEach((track, index) => {
         const tr = document.createElement('tr');
         tr.innerHTML = `
-            <td class="col-index">${index + 1}</td>
+            <td class="col-index">${offset + index + 1}</td>
             <td class="col-title">
                 <div class="track-flex">
                     <div class="track-img">
@@ -165,29 +203,181 @@ function populateTrackTable(tracks) {
 }
 
 // Show tracks from a specific folder
-function showFolderTracks(folderName, tracks) {
+function showFolderTracks(folderName, count) {
     const headerTitle = document.getElementById('header-title');
     const headerDesc = document.getElementById('header-desc');
     const headerCount = document.getElementById('header-count');
 
     headerTitle.innerText = folderName;
     headerDesc.innerText = `Playlist`;
-    headerCount.innerText = `${tracks.length} songs`;
+    headerCount.innerText = `${count} songs`;
 
-    currentTrackList = tracks;
-    populateTrackTable(tracks);
+    showTracks({ folder: folderName });
 }
 
 // Show tracks from a specific artist
-function showArtistTracks(artist, tracks) {
+function showArtistTracks(artist, count) {
     const headerTitle = document.getElementById('header-title');
     const headerDesc = document.getElementById('header-desc');
     const headerCount = document.getElementById('header-count');
 
     headerTitle.innerText = artist;
     headerDesc.innerText = `Artist`;
-    headerCount.innerText = `${tracks.length} songs`;
+    headerCount.innerText = `${count} songs`;
+
+    showTracks({ artist: artist, sort: 'title' });
+}
+
+// Load the next page when the track list is scrolled near its end
+document.addEventListener('DOMContentLoaded', () => {
+    const scroller = document.querySelector('.content-scroll');
+    if (!scroller) return;
+    scroller.addEventListener('scroll', () => {
+        if (scroller.scrollTop + scroller.clientHeight >= scroller.scrollHeight - 600) {
+            loadMoreTracks();
+        }
+    });
+});
+
+// Typeahead library search from the top input (Spotify links are left to the download button)
+let searchTimer = null;
+
+async function searchLibrary(query) {
+    const response = await fetch(`/search?q=${encodeURIComponent(query)}`);
+    const data = await response.json();
+    if (document.getElementById('spotify-url').value.trim() !== query) return;
+
+    currentQuery = { search: query };
+    nextCursor = null;
+    document.getElementById('header-title').innerText = `Search: ${query}`;
+    document.getElementById('header-desc').innerText = 'Library search';
+    document.getElementById('header-count').innerText = `${data.tracks.length} songs`;
+    currentTrackList = data.tracks;
+    populateTrackTable(data.tracks);
+}
 
-    currentTrackList = tracks;
-    populateTrackTable(tracks);
+document.addEventListener('DOMContentLoaded', () => {
+    const input = document.getElementById('spotify-url');
+    if (!input) return;
+    input.addEventListener('input', () => {
+        clearTimeout(searchTimer);
+        const query = input.value.trim();
+        if (query.includes('spotify.com') || query.startsWith('http')) return;
+        searchTimer = setTimeout(() => {
+            if (query.length >= 2) {
+                searchLibrary(query).catch(e => console.error('Search error:', e));
+            } else if (currentQuery.search !== undefined) {
+                loadLibrary();
+            }
+        }, 150);
+    });
+});
+
+// Live library updates: the server pushes every track created, modified or deleted
+// (/library/events), so the current list is patched in place instead of refetched
+let libraryLive = false;
+let statsTimer = null;
+
+function folderOf(path) {
+    const slash = path.lastIndexOf('/');
+    return slash === -1 ? 'Uncategorized' : path.slice(0, slash);
+}
+
+// Whether a track belongs to the list currently shown (search results are left alone)
+function matchesCurrentQuery(track) {
+    if (currentQuery.search !== undefined) return false;
+    if (currentQuery.folder !== undefined) return folderOf(track.path) === currentQuery.folder;
+    if (currentQuery.artist !== undefined) return track.artist === currentQuery.artist;
+    return true;
+}
+
+// Put a new track where the server's sort order would: newest first, or by title in artist views
+function insertTrack(track) {
+    let position = 0;
+    if (currentQuery.sort === 'title') {
+        const title = (track.title || '').toLowerCase();
+        position = currentTrackList.findIndex(t => (t.title || '').toLowerCase() > title);
+        // Past the loaded pages: infinite scroll will bring it in
+        if (position === -1) return nextCursor ? false : currentTrackList.push(track) > 0;
+    }
+    currentTrackList.splice(position, 0, track);
+    return true;
 }
+
+function applyLibraryChanges(message) {
+    if (message.reset) {
+        loadLibrary();
+        return;
+    }
+    if (libraryStats) {
+        libraryStats.count = message.count;
+        libraryStats.size_bytes = message.size_bytes;
+    }
+    if (Object.keys(currentQuery).length === 0) {
+        document.getElementById('header-count').innerText = `${message.count} songs`;
+    }
+
+    let changed = false;
+    for (const { event, path, track } of message.changes || []) {
+        const index = currentTrackList.findIndex(t => t.path === path);
+        if (index !== -1) {
+            currentTrackList.splice(index, 1);
+            changed = true;
+        }
+        if (event !== 'deleted' && matchesCurrentQuery(track)) {
+            changed = insertTrack(track) || changed;
+        }
+    }
+    if (changed) populateTrackTable(currentTrackList);
+
+    // Folder and artist counts come from the (cheap) stats endpoint, at most once a second
+    clearTimeout(statsTimer);
+    statsTimer = setTimeout(async () => {
+        const response = await fetch('/library/stats');
+        libraryStats = await response.json();
+        updateSidebar();
+    }, 1000);
+}
+
+// Without events (sync server or old browser) the stats are checked this often instead
+const LIBRARY_POLL_MS = 15000;
+
+function pollLibrary() {
+    setInterval(async () => {
+        try {
+            const response = await fetch('/library/stats');
+            if (!response.ok) return;
+            const stats = await response.json();
+            if (!libraryStats || stats.count !== libraryStats.count || stats.size_bytes !== libraryStats.size_bytes) {
+                await loadLibrary();
+            }
+        } catch (err) {
+            console.error('Error checking library:', err);
+        }
+    }, LIBRARY_POLL_MS);
+}
+
+function watchLibrary() {
+    // serverStreams is set by the page: false when an open stream would block the server
+    if (!window.EventSource || (typeof serverStreams !== 'undefined' && !serverStreams)) {
+        pollLibrary();
+        return;
+    }
+    const source = new EventSource('/library/events');
+    source.onopen = () => { libraryLive = true; };
+    // The browser reconnects by itself and resumes from the last event id, also when the
+    // server ends the stream. It gives up on an error status (503: too many streams open)
+    source.onerror = () => {
+        libraryLive = false;
+        if (source.readyState === EventSource.CLOSED) pollLibrary();
+    };
+    source.addEventListener('library', (e) => {
+        try {
+            applyLibraryChanges(JSON.parse(e.data));
+        } catch (err) {
+            console.error('Error applying library update:', err);
+        }
+    });
+}
+
+document.addEventListener('DOMContentLoaded', watchLibrary);
@@ -0,0 +1,66 @@
+// Offline audio: the service worker keeps pinned folders and the next tracks of the
+// play queue in its audio cache, within a byte budget (see static/sw.js)
+const PREFETCH_COUNT = 3;
+const DEFAULT_BUDGET_MB = 1024;
+
+// Send a message to the service worker and resolve with its answer (null without a worker)
+function offlineRequest(message) {
+    const controller = navigator.serviceWorker && navigator.serviceWorker.controller;
+    if (!controller) return Promise.resolve(null);
+    return new Promise((resolve) => {
+        const channel = new MessageChannel();
+        channel.port1.onmessage = (e) => resolve(e.data);
+        controller.postMessage(message, [channel.port2]);
+    });
+}
+
+function offlineEntry(track) {
+    return { path: track.path, size: track.size, etag: track.etag };
+}
+
+// Cache the tracks after `index` so playback continues without waiting for (or having) the network
+function prefetchQueue(tracks, index) {
+    const next = tracks.slice(index + 1, index + 1 + PREFETCH_COUNT);
+    if (next.length) offlineRequest({ type: 'prefetch', tracks: next.map(offlineEntry) });
+}
+
+function pinnedFolders() {
+    return new Set(JSON.parse(localStorage.getItem('pinnedFolders') || '[]'));
+}
+
+// Pin a folder for offline use, or unpin it (its tracks stay cached until evicted)
+async function togglePinFolder(folderName, event) {
+    event.stopPropagation();
+    const pinned = pinnedFolders();
+    const response = await fetch(`/library/manifest?folder=${encodeURIComponent(folderName)}`);
+    const { tracks } = await response.json();
+
+    if (pinned.has(folderName)) {
+        pinned.delete(folderName);
+        localStorage.setItem('pinnedFolders', JSON.stringify([...pinned]));
+        updateSidebar();
+        await offlineRequest({ type: 'unpin', paths: tracks.map(t => t.path) });
+        return;
+    }
+
+    pinned.add(folderName);
+    localStorage.setItem('pinnedFolders', JSON.stringify([...pinned]));
+    updateSidebar();
+    const result = await offlineRequest({ type: 'pin', tracks });
+    if (result && result.skipped) {
+        alert(`${result.skipped} of ${tracks.length} songs did not fit in the offline storage budget`);
+    }
+}
+
+// Change the offline audio budget, e.g. setOfflineBudget(4096) for 4 GB
+function setOfflineBudget(megabytes) {
+    localStorage.setItem('offlineBudgetMB', megabytes);
+    return offlineRequest({ type: 'set-budget', bytes: megabytes * 1024 * 1024 });
+}
+
+if ('serviceWorker' in navigator) {
+    navigator.serviceWorker.ready.then(() => {
+        const megabytes = Number(localStorage.getItem('offlineBudgetMB')) || DEFAULT_BUDGET_MB;
+        offlineRequest({ type: 'set-budget', bytes: megabytes * 1024 * 1024 });
+    });
+}
@@ -1,5 +1,13 @@
-const CACHE_NAME = 'jarama-music-v2';
-const RUNTIME_CACHE = 'jarama-runtime-v2';
+const CACHE_NAME = 'jarama-music-v5';
+const RUNTIME_CACHE = 'jarama-runtime-v5';
+// Offline audio lives in its own cache, kept across app updates
+const AUDIO_CACHE = 'jarama-audio-v1';
+// Offline audio budget until the page sets one (setOfflineBudget)
+const DEFAULT_AUDIO_BUDGET = 1024 * 1024 * 1024;
+// Never plan to use more than this share of the storage the browser grants the origin
+const QUOTA_SHARE = 0.8;
+// lastPlayed is refreshed at most this often: the player makes many range requests per track
+const TOUCH_INTERVAL = 60 * 1000;
 
 // Assets to cache on install
 const PRECACHE_ASSETS = [
@@ -30,7 +38,7 @@ self.addEventListener('activate', (event) => {
         caches.keys().then((cacheNames) => {
             return Promise.all(
                 cacheNames.map((cacheName) => {
-                    if (cacheName !== CACHE_NAME && cacheName !== RUNTIME_CACHE) {
+                    if (![CACHE_NAME, RUNTIME_CACHE, AUDIO_CACHE].includes(cacheName)) {
                         console.log('[Service Worker] Deleting old cache:', cacheName);
                         return caches.delete(cacheName);
                     }
@@ -50,6 +58,11 @@ self.addEventListener('fetch', (event) => {
         return;
     }
 
+    // Live library updates are an endless stream and exports can be gigabytes: never cache or intercept them
+    if (url.pathname === '/library/events' || url.pathname.startsWith('/export/')) {
+        return;
+    }
+
     // Skip cross-origin requests
     if (url.origin !== location.origin) {
         // For external resources (fonts, icons), use cache first
@@ -69,11 +82,15 @@ self.addEventListener('fetch', (event) => {
         return;
     }
 
-    // For API calls and dynamic content, use network first
-    if (url.pathname.startsWith('/download') ||
-        url.pathname.startsWith('/stats') ||
-        url.pathname.startsWith('/play') ||
-        url.pathname.startsWith('/cover')) {
+    // Audio: pinned and prefetched tracks from the audio cache (ranges included), the rest from the network
+    if (url.pathname.startsWith('/play/')) {
+        event.respondWith(playAudio(request, decodeURIComponent(url.pathname.slice('/play/'.length))));
+        return;
+    }
+
+    // Only the app shell and static files go to the runtime cache: API calls and covers use the
+    // network first, so the runtime cache no longer grows with every response
+    if (url.pathname !== '/' && !url.pathname.startsWith('/static/')) {
         event.respondWith(
             fetch(request)
                 .catch(() => {
@@ -107,6 +124,212 @@ self.addEventListener('fetch', (event) => {
     );
 });
 
+// ============================================
+// Offline audio
+// ============================================
+// Tracks are cached whole under their /play/ URL; IndexedDB keeps one record
+// per cached track: { path, size, etag, pinned, lastPlayed }. Pinned tracks stay
+// until unpinned, prefetched ones are evicted least recently played first
+// when the byte budget is reached.
+
+function audioUrl(path) {
+    return `/play/${encodeURIComponent(path)}`;
+}
+
+let dbPromise = null;
+
+function openDb() {
+    if (!dbPromise) {
+        dbPromise = new Promise((resolve, reject) => {
+            const open = indexedDB.open('jarama-offline', 1);
+            open.onupgradeneeded = () => {
+                open.result.createObjectStore('tracks', { keyPath: 'path' });
+                open.result.createObjectStore('settings');
+            };
+            open.onsuccess = () => resolve(open.result);
+            open.onerror = () => reject(open.error);
+        });
+    }
+    return dbPromise;
+}
+
+async function withStore(name, mode, action) {
+    const db = await openDb();
+    return new Promise((resolve, reject) => {
+        const request = action(db.transaction(name, mode).objectStore(name));
+        request.onsuccess = () => resolve(request.result);
+        request.onerror = () => reject(request.error);
+    });
+}
+
+const getRecord = (path) => withStore('tracks', 'readonly', (store) => store.get(path));
+const putRecord = (record) => withStore('tracks', 'readwrite', (store) => store.put(record));
+const deleteRecord = (path) => withStore('tracks', 'readwrite', (store) => store.delete(path));
+const allRecords = () => withStore('tracks', 'readonly', (store) => store.getAll());
+const getSetting = (key) => withStore('settings', 'readonly', (store) => store.get(key));
+const putSetting = (key, value) => withStore('settings', 'readwrite', (store) => store.put(value, key));
+
+async function playAudio(request, path) {
+    const cached = await caches.match(audioUrl(path), { cacheName: AUDIO_CACHE });
+    if (!cached) {
+        try {
+            return await fetch(request);
+        } catch (e) {
+            return new Response('Not available offline', { status: 503 });
+        }
+    }
+    touch(path).catch(() => {});
+    return rangeResponse(cached, request.headers.get('Range'));
+}
+
+async function touch(path) {
+    const record = await getRecord(path);
+    if (record && Date.now() - record.lastPlayed > TOUCH_INTERVAL) {
+        record.lastPlayed = Date.now();
+        await putRecord(record);
+    }
+}
+
+// Answer a Range request from a cached full response (several ranges get the whole file)
+async function rangeResponse(cached, range) {
+    const match = range && /^bytes=(\d*)-(\d*)$/.exec(range.trim());
+    if (!match || (match[1] === '' && match[2] === '')) return cached;
+
+    const blob = await cached.blob();
+    const size = blob.size;
+    let start;
+    let end;
+    if (match[1] === '') {
+        start = Math.max(size - Number(match[2]), 0);
+        end = size - 1;
+    } else {
+        start = Number(match[1]);
+        end = match[2] === '' ? size - 1 : Math.min(Number(match[2]), size - 1);
+    }
+    if (start >= size || end < start) {
+        return new Response(null, { status: 416, headers: { 'Content-Range': `bytes */${size}` } });
+    }
+    return new Response(blob.slice(start, end + 1), {
+        status: 206,
+        headers: {
+            'Content-Type': cached.headers.get('Content-Type') || 'audio/mpeg',
+            'Content-Range': `bytes ${start}-${end}/${size}`,
+            'Content-Length': String(end - start + 1),
+            'Accept-Ranges': 'bytes',
+            'ETag': cached.headers.get('ETag') || '',
+        },
+    });
+}
+
+// Bytes the audio cache may use: the configured budget, capped by the storage quota left
+async function audioBudget(used) {
+    const configured = (await getSetting('budget')) || DEFAULT_AUDIO_BUDGET;
+    if (!navigator.storage || !navigator.storage.estimate) return configured;
+    const { quota, usage } = await navigator.storage.estimate();
+    return Math.min(configured, quota * QUOTA_SHARE - Math.max(usage - used, 0));
+}
+
+// Evict unpinned tracks, least recently played first, until `bytes` more fit. False if they cannot
+async function makeRoom(bytes) {
+    const records = await allRecords();
+    let used = records.reduce((sum, record) => sum + record.size, 0);
+    const budget = await audioBudget(used);
+    if (used + bytes <= budget) return true;
+
+    const evictable = records.filter((record) => !record.pinned).sort((a, b) => a.lastPlayed - b.lastPlayed);
+    // Do not throw away prefetched tracks for a new one that would not fit anyway
+    const freeable = evictable.reduce((sum, record) => sum + record.size, 0);
+    if (bytes > 0 && used - freeable + bytes > budget) return false;
+
+    const cache = await caches.open(AUDIO_CACHE);
+    for (const record of evictable) {
+        await cache.delete(audioUrl(record.path));
+        await deleteRecord(record.path);
+        used -= record.size;
+        if (used + bytes <= budget) return true;
+    }
+    return false;
+}
+
+// Download a track into the audio cache unless the cached copy has the same ETag
+async function cacheTrack(track, pin) {
+    const record = await getRecord(track.path);
+    const cache = await caches.open(AUDIO_CACHE);
+    if (record && record.etag === track.etag && await cache.match(audioUrl(track.path))) {
+        if (pin && !record.pinned) await putRecord({ ...record, pinned: true });
+        return true;
+    }
+    if (!await makeRoom(track.size - (record ? record.size : 0))) return false;
+
+    // Marked so the server counts it as an access for its storage quota, not as a play
+    const response = await fetch(audioUrl(track.path), { headers: { 'X-Offline-Copy': '1' } });
+    if (response.status !== 200) return false;
+    await cache.put(audioUrl(track.path), response.clone());
+    await putRecord({
+        path: track.path,
+        size: Number(response.headers.get('Content-Length')) || track.size,
+        etag: response.headers.get('ETag') || track.etag,
+        pinned: pin || Boolean(record && record.pinned),
+        lastPlayed: record ? record.lastPlayed : Date.now(),
+    });
+    return true;
+}
+
+async function audioStatus() {
+    const records = await allRecords();
+    const used = records.reduce((sum, record) => sum + record.size, 0);
+    return {
+        used,
+        budget: await audioBudget(used),
+        tracks: records.length,
+        pinned: records.filter((record) => record.pinned).map((record) => record.path),
+    };
+}
+
+// Downloads for the audio cache run one at a time, in the order they were asked for
+let audioQueue = Promise.resolve();
+
+function enqueueAudio(task) {
+    audioQueue = audioQueue.then(task).catch((e) => console.error('[Service Worker] Offline audio:', e));
+    return audioQueue;
+}
+
+// Messages from the page: pin / unpin / prefetch tracks, set the budget, ask for the status.
+// The answer goes to the MessagePort sent along with the message.
+self.addEventListener('message', (event) => {
+    const message = event.data || {};
+    const reply = (data) => event.ports[0] && event.ports[0].postMessage(data);
+
+    if (message.type === 'pin' || message.type === 'prefetch') {
+        event.waitUntil(enqueueAudio(async () => {
+            let cached = 0;
+            let skipped = 0;
+            for (const track of message.tracks || []) {
+                if (await cacheTrack(track, message.type === 'pin')) cached++;
+                else skipped++;
+            }
+            reply({ cached, skipped, ...(await audioStatus()) });
+        }));
+    } else if (message.type === 'unpin') {
+        event.waitUntil(enqueueAudio(async () => {
+            // Unpinned tracks stay cached but become evictable
+            for (const path of message.paths || []) {
+                const record = await getRecord(path);
+                if (record && record.pinned) await putRecord({ ...record, pinned: false });
+            }
+            reply(await audioStatus());
+        }));
+    } else if (message.type === 'set-budget') {
+        event.waitUntil(enqueueAudio(async () => {
+            await putSetting('budget', message.bytes);
+            await makeRoom(0);
+            reply(await audioStatus());
+        }));
+    } else if (message.type === 'status') {
+        event.waitUntil(audioStatus().then(reply));
+    }
+});
+
 // Background sync for offline downloads (if supported)
 self.addEventListener('sync', (event) => {
     if (event.tag === 'sync-downloads') {
@@ -0,0 +1,217 @@
+"""Storage budget for the downloads folder.
+
+Before each download starts, StorageQuota makes room for it: when the
+library plus the downloads in flight would go over the budget, the least
+recently used tracks are deleted (or moved to an offload folder, e.g. a
+bigger and slower disk) until the new one fits. Tracks in pinned folders are
+never touched. Usage comes from the library index, so checking the budget
+does not walk the tree.
+
+The index is not written here: the library watcher (or the next refresh)
+drops evicted files from it and tells the clients. Until then the quota
+subtracts them itself.
+
+Reservations of downloads in flight and evictions the index still lists are
+kept in the library database too, so every process that downloads into the
+folder (the web app and each worker.py) counts the others' downloads: a
+reservation is made in one write transaction, one process at a time.
+"""
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+import logging
+
+from metrics import EVICTED_TRACKS
+
+# Assumed size of a download while the library is empty (~4 minutes of 256 kbps audio)
+DEFAULT_TRACK_BYTES = 8 * 1024 * 1024
+# A reservation not released by then belongs to a download that was abandoned
+RESERVATION_SECONDS = 3600
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(value):
+    """Bytes from a size such as '500M', '20G' or '1048576'"""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)B?\s*', value, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size '{value}', use e.g. 500M or 20G")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+class StorageFull(Exception):
+    """A download does not fit in the budget even after evicting every track that may be evicted"""
+
+
+class StorageQuota:
+    """Keeps the downloads folder under `budget` bytes by evicting least recently used tracks"""
+
+    def __init__(self, index, budget, offload_path=None):
+        self.index = index
+        self.budget = budget
+        # Evicted files are moved here (same relative path) instead of deleted
+        self.offload_path = offload_path
+        # Reservation keys given by the downloader are only unique within this process
+        self._owner = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        # Own connection in autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(index.db_path, check_same_thread=False, timeout=30, isolation_level=None)
+        self.conn.executescript('''
+            -- One row per download between reserve() and release(); path is set once the file
+            -- is written and the row stays until the index lists that path
+            CREATE TABLE IF NOT EXISTS quota_reservations (
+                key TEXT PRIMARY KEY,
+                path TEXT,
+                bytes INTEGER NOT NULL,
+                since REAL NOT NULL
+            );
+            -- Evicted files the index still lists
+            CREATE TABLE IF NOT EXISTS quota_evictions (
+                path TEXT PRIMARY KEY,
+                bytes INTEGER NOT NULL
+            );
+        ''')
+
+    def _key(self, key):
+        return f'{self._owner}:{key}'
+
+    def _pending_evictions(self):
+        evicted = dict(self.conn.execute('SELECT path, bytes FROM quota_evictions').fetchall())
+        if not evicted:
+            return 0
+        indexed = self.index.sizes(list(evicted))
+        self.conn.executemany('DELETE FROM quota_evictions WHERE path = ?',
+                              [(path,) for path in evicted if path not in indexed])
+        return sum(size for path, size in evicted.items() if path in indexed)
+
+    def _usage(self):
+        """(tracks, bytes used, bytes reserved, expected size of the next download), inside a transaction"""
+        # Hard links of one download take its size once
+        count, size = self.index.disk_usage()
+        used = size - self._pending_evictions()
+        self.conn.execute('DELETE FROM quota_reservations WHERE since < ?', (time.time() - RESERVATION_SECONDS,))
+        written = [path for path, in self.conn.execute(
+            'SELECT path FROM quota_reservations WHERE path IS NOT NULL').fetchall()]
+        if written:
+            indexed = self.index.sizes(written)
+            self.conn.executemany('DELETE FROM quota_reservations WHERE path = ?',
+                                  [(path,) for path in written if path in indexed])
+        reserved = self.conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM quota_reservations').fetchone()[0]
+        return count, used, reserved, size // count if count else DEFAULT_TRACK_BYTES
+
+    def _transaction(self, work):
+        """Run work() holding the database write lock, so other processes wait for the reservation"""
+        with self._lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = work()
+            except StorageFull:
+                # Keep whatever was evicted on the way
+                self.conn.execute('COMMIT')
+                raise
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+            return result
+
+    def usage(self):
+        """Budget, bytes used and reserved by downloads in progress, and the pinned folders"""
+        count, used, reserved, _ = self._transaction(self._usage)
+        return {
+            'budget_bytes': self.budget,
+            'used_bytes': used,
+            'reserved_bytes': reserved,
+            'free_bytes': max(0, self.budget - used - reserved),
+            'tracks': count,
+            'pinned': self.index.pinned_folders(),
+        }
+
+    def reserve(self, key):
+        """Make room for one download before it starts, evicting if needed. Raises StorageFull"""
+        def work():
+            _, used, reserved, needed = self._usage()
+            excess = used + reserved + needed - self.budget
+            if excess > 0 and self._evict(excess) < excess:
+                raise StorageFull(f"Storage budget full: {used / 1024 ** 2:.0f} of "
+                                  f"{self.budget / 1024 ** 2:.0f} MB used and not enough unpinned tracks to evict")
+            self.conn.execute('INSERT OR REPLACE INTO quota_reservations (key, bytes, since) VALUES (?, ?, ?)',
+                              (self._key(key), needed, time.time()))
+        self._transaction(work)
+
+    def release(self, key, rel_path=None):
+        """The download failed, or wrote rel_path: then its room stays taken until the index lists the file"""
+        with self._lock:
+            if rel_path:
+                self.conn.execute('UPDATE quota_reservations SET path = ? WHERE key = ?', (rel_path, self._key(key)))
+            else:
+                self.conn.execute('DELETE FROM quota_reservations WHERE key = ?', (self._key(key),))
+
+    def _evict(self, amount):
+        """Evict least recently used tracks until amount bytes are freed. Returns the bytes freed.
+
+        Nothing is evicted when the unpinned tracks cannot free that much.
+        Hard links of a download (dedup copies) are evicted together, and
+        their bytes only count once the last one is gone.
+        """
+        victims = []
+        freeable = 0
+        evicted = {path for path, in self.conn.execute('SELECT path FROM quota_evictions').fetchall()}
+        for paths, size in self.index.eviction_candidates():
+            if freeable >= amount:
+                break
+            paths = [path for path in paths if path not in evicted]
+            if not paths:
+                continue
+            # Links the index does not list (not indexed yet, outside the folder) keep the data on disk
+            links = self._links(paths[0])
+            if links is not None and links > len(paths):
+                continue
+            victims.append((paths, size))
+            freeable += size
+        if freeable < amount:
+            return 0
+
+        freed = 0
+        for paths, size in victims:
+            removed = 0
+            for path in paths:
+                try:
+                    self._remove(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logging.warning(f"Could not evict {path}: {e}")
+                    continue
+                removed += 1
+                # The space is freed with the last link, when st_nlink drops to 0
+                last = removed == len(paths)
+                self.conn.execute('INSERT OR REPLACE INTO quota_evictions (path, bytes) VALUES (?, ?)',
+                                  (path, size if last else 0))
+                EVICTED_TRACKS.inc(action='offloaded' if self.offload_path else 'deleted')
+                logging.info(f"Evicted {path} ({size / 1024 ** 2:.1f} MB"
+                             f"{'' if last else ', still linked elsewhere'}) to stay within the storage budget")
+            if removed == len(paths):
+                freed += size
+        return freed
+
+    def _links(self, rel_path):
+        """Hard links of the file at rel_path, None when it is gone"""
+        try:
+            return os.stat(os.path.join(self.index.download_path, rel_path)).st_nlink
+        except OSError:
+            return None
+
+    def _remove(self, rel_path):
+        path = os.path.join(self.index.download_path, rel_path)
+        if not self.offload_path:
+            os.remove(path)
+            return
+        destination = os.path.join(self.offload_path, rel_path)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.move(path, destination)
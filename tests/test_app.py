@@ -0,0 +1,40 @@
+import importlib
+import os
+
+import pytest
+
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    # app.py creates its databases and folders in the working directory when imported
+    workdir = tmp_path_factory.mktemp('app')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    env = {'LIBRARY_WATCH': 'off', 'EMBEDDED_WORKER': '0', 'JOB_QUEUE': 'sqlite',
+           'SPOTIPY_CLIENT_ID': 'test', 'SPOTIPY_CLIENT_SECRET': 'test'}
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    try:
+        app = importlib.import_module('app')
+        yield app.app.test_client()
+    finally:
+        os.chdir(cwd)
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+@pytest.mark.parametrize('body', [None, '[]', '"https://open.spotify.com/track/x"', '3', '{"url": 3}', '{}', 'not json'])
+def test_download_rejects_bodies_without_a_url(client, body):
+    response = client.post('/download', data=body, content_type='application/json')
+    assert response.status_code == 400
+    assert response.get_json() == {'status': 'error', 'message': 'Invalid Spotify URL'}
+
+
+def test_download_queues_a_job(client):
+    response = client.post('/download', json={'url': ' https://open.spotify.com/track/abc '})
+    assert response.status_code == 202
+    job = client.get(f"/jobs/{response.get_json()['job_id']}").get_json()
+    assert job['url'] == 'https://open.spotify.com/track/abc'
@@ -0,0 +1,107 @@
+import os
+
+import pytest
+from flask import Flask
+
+from audio_stream import send_audio
+
+SIZE = 100000
+
+
+@pytest.fixture
+def audio(tmp_path):
+    (tmp_path / 'Album').mkdir()
+    data = os.urandom(SIZE)
+    (tmp_path / 'Album' / 'song.mp3').write_bytes(data)
+    (tmp_path / 'secret.txt').write_text('not audio')
+
+    # Same call as the /play route, over a folder of its own
+    app = Flask(__name__)
+
+    @app.route('/play/<path:filename>')
+    def play(filename):
+        return send_audio(str(tmp_path / 'Album'), filename, max_age=31536000)
+
+    return app.test_client(), data
+
+
+def get(client, headers=None, method='GET'):
+    return client.open('/play/song.mp3', method=method, headers=headers or {})
+
+
+def test_full_file(audio):
+    client, data = audio
+    response = get(client)
+    assert response.status_code == 200
+    assert response.data == data
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert response.headers['Content-Length'] == str(SIZE)
+    assert response.headers['ETag'] and response.headers['Last-Modified']
+
+
+@pytest.mark.parametrize('spec, start, end', [
+    ('bytes=100-199', 100, 199),
+    ('bytes=-500', SIZE - 500, SIZE - 1),
+    ('bytes=99000-', 99000, SIZE - 1),
+])
+def test_single_range(audio, spec, start, end):
+    client, data = audio
+    response = get(client, {'Range': spec})
+    assert response.status_code == 206
+    assert response.data == data[start:end + 1]
+    assert response.headers['Content-Range'] == f'bytes {start}-{end}/{SIZE}'
+    assert response.headers['Content-Length'] == str(end - start + 1)
+
+
+def test_multiple_ranges(audio):
+    client, data = audio
+    response = get(client, {'Range': 'bytes=0-9,50-59'})
+    assert response.status_code == 206
+    assert response.mimetype == 'multipart/byteranges'
+    boundary = response.mimetype_params['boundary']
+    parts = response.data.split(f'--{boundary}'.encode())
+    assert f'Content-Range: bytes 0-9/{SIZE}'.encode() in parts[1] and parts[1].endswith(data[0:10] + b'\r\n')
+    assert f'Content-Range: bytes 50-59/{SIZE}'.encode() in parts[2] and parts[2].endswith(data[50:60] + b'\r\n')
+    assert parts[-1].startswith(b'--')
+    assert response.headers['Content-Length'] == str(len(response.data))
+
+
+def test_unsatisfiable_range(audio):
+    client, _ = audio
+    response = get(client, {'Range': f'bytes={SIZE}-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{SIZE}'
+
+
+def test_if_range(audio):
+    client, data = audio
+    etag = get(client).headers['ETag']
+    matching = get(client, {'Range': 'bytes=0-9', 'If-Range': etag})
+    assert matching.status_code == 206 and matching.data == data[:10]
+    # The file changed since the client cached part of it: send all of it
+    stale = get(client, {'Range': 'bytes=0-9', 'If-Range': '"stale"'})
+    assert stale.status_code == 200 and stale.data == data
+
+
+def test_conditional_get(audio):
+    client, _ = audio
+    first = get(client)
+    response = get(client, {'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert get(client, {'If-Modified-Since': first.headers['Last-Modified']}).status_code == 304
+    assert get(client, {'If-None-Match': '"other"'}).status_code == 200
+
+
+def test_head(audio):
+    client, _ = audio
+    response = get(client, method='HEAD')
+    assert response.status_code == 200
+    assert response.headers['Content-Length'] == str(SIZE)
+    assert response.data == b''
+
+
+@pytest.mark.parametrize('path', ['/play/../secret.txt', '/play/%2E%2E/secret.txt', '/play/missing.mp3'])
+def test_paths_outside_the_folder_are_not_served(audio, path):
+    client, _ = audio
+    assert client.get(path).status_code == 404
@@ -0,0 +1,21 @@
+from flask import Flask, send_file
+
+from cover_cache import CoverCache
+
+
+def test_relative_cache_dir_is_served_from_another_working_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cache = CoverCache('data/covers')
+    digest = cache.store(b'\x89PNG not really', mime='image/png')
+
+    # The app package (root_path) is not the working directory, like gunicorn started elsewhere
+    app = Flask(__name__, root_path=str(tmp_path / 'elsewhere'))
+
+    @app.route('/cover')
+    def cover():
+        path, mime = cache.get(digest)
+        return send_file(path, mimetype=mime)
+
+    response = app.test_client().get('/cover')
+    assert response.status_code == 200
+    assert response.data == b'\x89PNG not really'
@@ -0,0 +1,79 @@
+import threading
+
+from pipeline import DownloadPipeline
+
+
+class FakeDownloader:
+    """Stages that return at once, except fetch which waits for `release`"""
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def plan(self, query, track, folder_name=None):
+        return {'query': query, 'track': track}
+
+    def resolve(self, task):
+        return task
+
+    def fetch(self, task):
+        self.release.wait(5)
+        if task['track']['name'] == 'bad':
+            raise RuntimeError('no audio')
+        return task
+
+    def transcode(self, task):
+        return {'status': 'success', 'query': task['query']}
+
+
+def playlist(count, read, bad=()):
+    for index in range(count):
+        read.append(index)
+        yield {'name': 'bad' if index in bad else f'track {index}', 'artist': 'artist'}
+
+
+def test_reads_at_most_read_ahead_tracks_before_they_finish():
+    downloader = FakeDownloader()
+    pipeline = DownloadPipeline(downloader, resolve_workers=2, fetch_workers=2, transcode_workers=1, read_ahead=6)
+    read = []
+    try:
+        events = pipeline.run(playlist(100, read))
+        assert next(events)[0] == 'started'
+        # Every fetch is blocked: the feeder stops at the read-ahead limit
+        threading.Event().wait(0.3)
+        assert len(read) == 6
+
+        downloader.release.set()
+        finished = [event for event in events if event[0] == 'finished']
+        assert len(read) == 100
+        assert sorted(index for _, index, _, _ in finished) == list(range(100))
+    finally:
+        pipeline.shutdown()
+
+
+def test_failed_tracks_give_their_slot_back():
+    downloader = FakeDownloader()
+    downloader.release.set()
+    pipeline = DownloadPipeline(downloader, resolve_workers=1, fetch_workers=1, transcode_workers=1, read_ahead=2)
+    read = []
+    try:
+        results = [event[3] for event in pipeline.run(playlist(10, read, bad=range(0, 10, 2)))
+                   if event[0] == 'finished']
+        assert [result['status'] for result in results].count('error') == 5
+        assert len(results) == 10
+    finally:
+        pipeline.shutdown()
+
+
+def test_closing_the_run_stops_reading_tracks():
+    downloader = FakeDownloader()
+    pipeline = DownloadPipeline(downloader, resolve_workers=1, fetch_workers=1, transcode_workers=1, read_ahead=3)
+    read = []
+    try:
+        events = pipeline.run(playlist(100, read))
+        next(events)
+        events.close()
+        downloader.release.set()
+        threading.Event().wait(0.3)
+        assert len(read) == 3
+    finally:
+        pipeline.shutdown()
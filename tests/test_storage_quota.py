@@ -0,0 +1,122 @@
+import os
+
+import pytest
+
+from library_index import LibraryIndex
+from storage_quota import StorageFull, StorageQuota
+
+
+@pytest.fixture
+def library(tmp_path):
+    """Index of 5 tracks of 1000 bytes in a pinned folder, so nothing can be evicted"""
+    download_path = tmp_path / 'downloads'
+    (download_path / 'Pinned').mkdir(parents=True)
+    for number in range(5):
+        (download_path / 'Pinned' / f'{number}.mp3').write_bytes(os.urandom(1000))
+    index = LibraryIndex(str(download_path), str(tmp_path / 'library.db'))
+    index.refresh()
+    index.pin_folder('Pinned')
+    return index
+
+
+def test_reservations_are_shared_between_processes(library):
+    # Two quotas with their own connection, like the web app and a worker.py
+    web = StorageQuota(library, budget=7500)
+    worker = StorageQuota(LibraryIndex(library.download_path, library.db_path), budget=7500)
+
+    web.reserve(1)
+    worker.reserve(1)
+    assert worker.usage()['reserved_bytes'] == 2000
+    with pytest.raises(StorageFull):
+        web.reserve(2)
+
+    worker.release(1)
+    web.reserve(2)
+    assert web.usage()['reserved_bytes'] == 2000
+
+
+def test_written_downloads_keep_their_room_until_indexed(library):
+    quota = StorageQuota(library, budget=10000)
+    quota.reserve('a')
+    path = os.path.join(library.download_path, 'Pinned', 'new.mp3')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(1000))
+    quota.release('a', 'Pinned/new.mp3')
+    assert quota.usage()['reserved_bytes'] == 1000
+
+    library.refresh()
+    usage = quota.usage()
+    assert (usage['used_bytes'], usage['reserved_bytes']) == (6000, 0)
+
+
+def write_track(index, rel_path, size=1000):
+    path = os.path.join(index.download_path, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+
+def link_track(index, source, rel_path):
+    path = os.path.join(index.download_path, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.link(os.path.join(index.download_path, source), path)
+
+
+def test_hard_links_count_once(library):
+    link_track(library, 'Pinned/0.mp3', 'Other/0.mp3')
+    library.refresh()
+    assert library.totals() == (6, 6000)
+    assert StorageQuota(library, budget=10000).usage()['used_bytes'] == 5000
+
+
+def test_links_are_evicted_together(library):
+    write_track(library, 'Free/old.mp3')
+    write_track(library, 'Free/shared.mp3')
+    link_track(library, 'Free/shared.mp3', 'Copies/shared.mp3')
+    library.refresh()
+    library.record_access('Free/old.mp3', play=False)
+    library.record_access('Free/shared.mp3', play=False)
+    quota = StorageQuota(library, budget=7000)
+
+    # 7000 used: the least recently used track makes room for the first download
+    quota.reserve('a')
+    assert not os.path.exists(os.path.join(library.download_path, 'Free/old.mp3'))
+    assert os.path.exists(os.path.join(library.download_path, 'Free/shared.mp3'))
+
+    # Then both links of 'shared' have to go, one alone would free nothing
+    quota.reserve('b')
+    for rel_path in ('Free/shared.mp3', 'Copies/shared.mp3'):
+        assert not os.path.exists(os.path.join(library.download_path, rel_path))
+    assert quota.usage()['used_bytes'] == 5000
+
+
+def test_a_pinned_link_keeps_the_file(library):
+    link_track(library, 'Pinned/0.mp3', 'Free/0.mp3')
+    library.refresh()
+    quota = StorageQuota(library, budget=5500)
+    with pytest.raises(StorageFull):
+        quota.reserve('a')
+    assert os.path.exists(os.path.join(library.download_path, 'Free/0.mp3'))
+
+
+def test_reused_download_counts_as_accessed(library, tmp_path):
+    from downloader import Downloader
+
+    downloader = Downloader(library.download_path, index_path=str(tmp_path / 'downloads.db'),
+                            resolve_path=str(tmp_path / 'resolve.db'), library_index=library)
+    write_track(library, 'Free/old.mp3')
+    write_track(library, 'Free/song.mp3')
+    library.refresh()
+    library.record_access('Free/old.mp3', play=False)
+    downloader.index.add(['url:song'], 'Free/song.mp3')
+
+    target = os.path.join(library.download_path, 'Playlist')
+    os.makedirs(target)
+    downloader._reuse_existing(['url:song'], target)
+    library.refresh()
+
+    # song.mp3 was written before old.mp3 was last played, but has just been requested again
+    candidates = library.eviction_candidates()
+    assert candidates[0] == (['Free/old.mp3'], 1000)
+    assert candidates[1] == (['Free/song.mp3', 'Playlist/song.mp3'], 1000)
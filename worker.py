@@ -0,0 +1,188 @@
+"""Download worker: runs queued jobs in a process of its own.
+
+    python worker.py
+
+Any number of workers, on this machine or others, take jobs from the same
+queue as the web app: the SQLite database in JOBS_DB (processes sharing a
+disk) or Redis with JOB_QUEUE=redis (any number of machines). A job is
+leased to one worker at a time and kept alive by heartbeats; when a worker
+dies its job goes back to the queue after LEASE_SECONDS and the tracks it
+had in flight are downloaded again by whoever claims it next. Start the web
+app with EMBEDDED_WORKER=0 so it only queues jobs and relays their progress.
+
+Workers write to DOWNLOAD_PATH but do not index what they download: the web
+app's library watcher picks the files up, so every worker on every machine
+needs the same downloads folder (a shared volume). What decides what a job
+downloads lives next to the queue: with the SQLite queue in SYNC_DB,
+DOWNLOADS_DB and RESOLVE_DB (on the same disk as JOBS_DB), with Redis in
+Redis, so a playlist sync or a dedup hit does not depend on which worker
+runs the job.
+
+With STORAGE_BUDGET a worker reserves room for its downloads in the library
+database (LIBRARY_DB) together with the web app and every other worker, so
+it must open the web app's database, not a copy: with Redis the worker
+checks that at startup and refuses to run otherwise. Set STORAGE_BUDGET only
+on workers on the machine that holds the index.
+"""
+import os
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dotenv import load_dotenv
+
+from download_index import DownloadIndex
+from downloader import Downloader
+from job_queue import JobStore, JobRunner
+from library_index import LibraryIndex
+from metrics import REGISTRY
+from pipeline import DownloadPipeline
+from playlist_sync import PlaylistSyncStore
+from resolve_cache import ResolveCache
+from spotify_service import SpotifyService
+from storage_quota import StorageQuota, parse_size
+
+import logging
+
+load_dotenv()
+
+DOWNLOAD_PATH = 'downloads'
+LIBRARY_DB = os.getenv('LIBRARY_DB', 'data/library.db')
+# Maximum size of DOWNLOAD_PATH (e.g. 20G); least recently played tracks outside pinned folders
+# are evicted to make room for new downloads. Empty = no limit
+STORAGE_BUDGET = os.getenv('STORAGE_BUDGET', '')
+# Evicted tracks are moved here instead of deleted
+STORAGE_OFFLOAD_PATH = os.getenv('STORAGE_OFFLOAD_PATH') or None
+# Per-stage concurrency of the download pipeline: YouTube searches, audio downloads, ffmpeg transcodes
+RESOLVE_WORKERS = int(os.getenv('RESOLVE_WORKERS', '4'))
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '4'))
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', str(os.cpu_count() or 1)))
+# mp3 re-encodes every download; m4a/opus keep YouTube's audio stream and only remux it
+AUDIO_FORMAT = os.getenv('AUDIO_FORMAT', 'mp3')
+SYNC_DB = os.getenv('SYNC_DB', 'data/sync.db')
+DOWNLOADS_DB = os.getenv('DOWNLOADS_DB', 'data/downloads.db')
+RESOLVE_DB = os.getenv('RESOLVE_DB', 'data/resolve.db')
+SPOTIFY_CACHE_TTL = int(os.getenv('SPOTIFY_CACHE_TTL', '600'))
+# Requests per second to each service, shared by all workers of a process and lowered automatically on 429s
+SPOTIFY_RATE_LIMIT = float(os.getenv('SPOTIFY_RATE_LIMIT', '10'))
+YOUTUBE_RATE_LIMIT = float(os.getenv('YOUTUBE_RATE_LIMIT', '5'))
+# Where jobs are queued: sqlite (JOBS_DB, processes on one machine) or redis (REDIS_URL, several machines)
+JOB_QUEUE = os.getenv('JOB_QUEUE', 'sqlite')
+JOBS_DB = os.getenv('JOBS_DB', 'data/jobs.db')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+# Pipeline metrics of this worker in the Prometheus format on http://<host>:<port>/metrics (0 = off)
+WORKER_METRICS_PORT = int(os.getenv('WORKER_METRICS_PORT', '0'))
+
+
+def create_job_store(on_change=None):
+    """The job queue selected by JOB_QUEUE; on_change is called with the id of every job that changes"""
+    if JOB_QUEUE == 'redis':
+        from redis_jobs import RedisJobStore
+        return RedisJobStore(REDIS_URL, on_change=on_change)
+    if JOB_QUEUE != 'sqlite':
+        raise ValueError(f"Unknown JOB_QUEUE '{JOB_QUEUE}', use sqlite or redis")
+    return JobStore(JOBS_DB, on_change=on_change)
+
+
+def create_shared_state():
+    """(playlist sync store, dedup index, resolve cache) shared by every worker of the JOB_QUEUE"""
+    if JOB_QUEUE == 'redis':
+        from redis_state import RedisSyncStore, RedisDownloadIndex, RedisResolveCache
+        return RedisSyncStore(REDIS_URL), RedisDownloadIndex(REDIS_URL), RedisResolveCache(REDIS_URL)
+    return PlaylistSyncStore(SYNC_DB), DownloadIndex(DOWNLOADS_DB), ResolveCache(RESOLVE_DB)
+
+
+def announce_library(store, index):
+    """Called by the web app: workers with a storage budget must use this library database"""
+    if JOB_QUEUE == 'redis':
+        store.set_library(index.library_id)
+
+
+def check_library(store, index):
+    """Refuse to keep a storage budget on a library database other than the web app's"""
+    if JOB_QUEUE != 'redis':
+        return
+    expected = store.library()
+    if expected is None:
+        raise SystemExit("STORAGE_BUDGET needs the web app's library database: start the web app first")
+    if expected != index.library_id:
+        raise SystemExit(f"{LIBRARY_DB} is not the library database of the web app. With STORAGE_BUDGET "
+                         f"a worker must open the same file (run it on that machine) or leave the budget unset")
+
+
+def create_quota(index):
+    """The StorageQuota configured by STORAGE_BUDGET over a library index, or None without a budget"""
+    if not STORAGE_BUDGET:
+        return None
+    return StorageQuota(index, parse_size(STORAGE_BUDGET), offload_path=STORAGE_OFFLOAD_PATH)
+
+
+def create_runner(store, library_index=None, quota=None):
+    """A JobRunner with its Spotify client, downloader and pipeline, not started yet.
+
+    library_index, when given, indexes every file as soon as it is written
+    (the web app's own runner); standalone workers leave it to the watcher.
+    """
+    spotify = SpotifyService(cache_ttl=SPOTIFY_CACHE_TTL, rate_limit=SPOTIFY_RATE_LIMIT)
+    sync_store, download_index, resolve_cache = create_shared_state()
+    downloader = Downloader(DOWNLOAD_PATH, library_index=library_index, audio_format=AUDIO_FORMAT,
+                            rate_limit=YOUTUBE_RATE_LIMIT, quota=quota, index=download_index,
+                            resolve_cache=resolve_cache)
+    pipeline = DownloadPipeline(downloader, resolve_workers=RESOLVE_WORKERS,
+                                fetch_workers=DOWNLOAD_WORKERS, transcode_workers=TRANSCODE_WORKERS)
+    return JobRunner(store, spotify, downloader, workers=DOWNLOAD_WORKERS,
+                     sync_store=sync_store, pipeline=pipeline)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(name)s : %(message)s')
+    if os.getenv('TIMING_LOG', '1') == '0':
+        logging.getLogger('timing').setLevel(logging.WARNING)
+    if not os.getenv("SPOTIPY_CLIENT_ID") or not os.getenv("SPOTIPY_CLIENT_SECRET"):
+        raise SystemExit("Faltan credenciales de Spotify en variables de entorno (SPOTIPY_CLIENT_ID/SECRET)")
+
+    store = create_job_store()
+    quota = None
+    if STORAGE_BUDGET:
+        # Only for the storage budget: the files are indexed by the web app's watcher
+        index = LibraryIndex(DOWNLOAD_PATH, LIBRARY_DB)
+        check_library(store, index)
+        quota = create_quota(index)
+    runner = create_runner(store, quota=quota)
+    if WORKER_METRICS_PORT:
+        server = ThreadingHTTPServer(('', WORKER_METRICS_PORT), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='worker-metrics', daemon=True).start()
+
+    stopping = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stopping.set())
+
+    runner.start()
+    logging.info(f"Worker {runner.owner} waiting for jobs ({JOB_QUEUE} queue)")
+    while not stopping.wait(1):
+        pass
+    # The job in progress goes back to the queue for another worker; tracks already running finish first
+    logging.info(f"Worker {runner.owner} stopping")
+    runner.stop()
+    runner.join()
+
+
+if __name__ == '__main__':
+    main()
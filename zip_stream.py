@@ -0,0 +1,246 @@
+"""ZIP archives of library folders, generated while they are sent.
+
+Entries are stored, not deflated: MP3/M4A/Opus audio does not compress
+any further, and without compression every header, offset and the total
+size are known from os.stat alone. That gives a Content-Length up front and
+lets any byte range be produced on its own, so interrupted downloads resume
+with a Range request. Nothing is written to disk and memory use does not
+depend on the size of the files.
+"""
+import hashlib
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from flask import Response, request
+
+from audio_stream import CHUNK_SIZE, attachment, prepare_ranges
+from audio_tags import AUDIO_EXTENSIONS
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_RECORD = struct.Struct('<IHHHHIIH')
+ZIP64_END_RECORD = struct.Struct('<IQHHIIQQQQ')
+ZIP64_LOCATOR = struct.Struct('<IIQI')
+
+UTF8_NAMES = 0x0800
+# 2.0 for plain entries, 4.5 when ZIP64 fields are needed
+VERSION = 20
+VERSION_ZIP64 = 45
+# Unix, so the external attributes below are file permissions
+MADE_BY_UNIX = 3 << 8
+FILE_ATTRIBUTES = 0o100644 << 16
+LIMIT_32 = 0xFFFFFFFF
+LIMIT_16 = 0xFFFF
+
+
+def _dos_time(mtime):
+    t = time.localtime(max(mtime, 315532800))  # ZIP dates start in 1980
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+class CrcCache:
+    """CRC-32 of files keyed by path, size and mtime, so resumed downloads do not reread everything"""
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def crc(self, path, size, mtime_ns):
+        key = (path, size, mtime_ns)
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                return self._data[key]
+        crc = 0
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+        with self._lock:
+            self._data[key] = crc
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return crc
+
+
+CRC_CACHE = CrcCache()
+
+
+class ZipEntry:
+    def __init__(self, name, path, st):
+        self.name = name.encode('utf-8')
+        self.path = path
+        self.size = st.st_size
+        self.mtime_ns = st.st_mtime_ns
+        self.time, self.date = _dos_time(st.st_mtime)
+        self.offset = 0
+        self.zip64 = self.size >= LIMIT_32
+
+    @property
+    def header_size(self):
+        return LOCAL_HEADER.size + len(self.name) + (20 if self.zip64 else 0)
+
+    def crc(self):
+        return CRC_CACHE.crc(self.path, self.size, self.mtime_ns)
+
+    def local_header(self):
+        size = LIMIT_32 if self.zip64 else self.size
+        extra = struct.pack('<HHQQ', 1, 16, self.size, self.size) if self.zip64 else b''
+        return LOCAL_HEADER.pack(0x04034b50, VERSION_ZIP64 if self.zip64 else VERSION, UTF8_NAMES, 0,
+                                 self.time, self.date, self.crc(), size, size, len(self.name),
+                                 len(extra)) + self.name + extra
+
+    def central_header(self):
+        values = []
+        size = self.size
+        if self.zip64:
+            values += [self.size, self.size]
+            size = LIMIT_32
+        offset = self.offset
+        if offset >= LIMIT_32:
+            values.append(offset)
+            offset = LIMIT_32
+        extra = struct.pack(f'<HH{len(values)}Q', 1, 8 * len(values), *values) if values else b''
+        version = VERSION_ZIP64 if values else VERSION
+        return CENTRAL_HEADER.pack(0x02014b50, MADE_BY_UNIX | version, version, UTF8_NAMES, 0,
+                                   self.time, self.date, self.crc(), size, size, len(self.name),
+                                   len(extra), 0, 0, 0, FILE_ATTRIBUTES, offset) + self.name + extra
+
+
+class ZipStream:
+    """A store-only ZIP archive of files, laid out from their stat() results.
+
+    files is a list of (name in the archive, path on disk). read(start,
+    length) yields any part of the archive; CRCs are computed only for the
+    entries whose headers fall in that part (the central directory needs
+    all of them).
+    """
+
+    def __init__(self, files):
+        self.entries = []
+        offset = 0
+        for name, path in files:
+            entry = ZipEntry(name, path, os.stat(path))
+            entry.offset = offset
+            offset += entry.header_size + entry.size
+            self.entries.append(entry)
+        self.directory_offset = offset
+        self.directory_size = sum(CENTRAL_HEADER.size + len(entry.name) + self._central_extra(entry)
+                                  for entry in self.entries)
+        self.zip64 = (len(self.entries) >= LIMIT_16 or self.directory_offset >= LIMIT_32
+                      or self.directory_size >= LIMIT_32)
+        end_size = END_RECORD.size + (ZIP64_END_RECORD.size + ZIP64_LOCATOR.size if self.zip64 else 0)
+        self.size = self.directory_offset + self.directory_size + end_size
+        self.mtime = max((entry.mtime_ns for entry in self.entries), default=0) / 1e9
+
+        digest = hashlib.sha1()
+        for entry in self.entries:
+            digest.update(b'%s\0%d\0%d\0' % (entry.name, entry.size, entry.mtime_ns))
+        self.etag = f'"zip-{digest.hexdigest()[:24]}"'
+
+    @staticmethod
+    def _central_extra(entry):
+        fields = (2 if entry.zip64 else 0) + (1 if entry.offset >= LIMIT_32 else 0)
+        return 4 + 8 * fields if fields else 0
+
+    def _end(self):
+        count = len(self.entries)
+        records = b''
+        if self.zip64:
+            zip64_offset = self.directory_offset + self.directory_size
+            records += ZIP64_END_RECORD.pack(0x06064b50, ZIP64_END_RECORD.size - 12, MADE_BY_UNIX | VERSION_ZIP64,
+                                             VERSION_ZIP64, 0, 0, count, count, self.directory_size,
+                                             self.directory_offset)
+            records += ZIP64_LOCATOR.pack(0x07064b50, 0, zip64_offset, 1)
+        return records + END_RECORD.pack(0x06054b50, 0, 0, min(count, LIMIT_16), min(count, LIMIT_16),
+                                          min(self.directory_size, LIMIT_32),
+                                          min(self.directory_offset, LIMIT_32), 0)
+
+    def _segments(self):
+        """(offset, length, kind, value) for every piece of the archive, in order"""
+        for entry in self.entries:
+            yield entry.offset, entry.header_size, 'header', entry
+            yield entry.offset + entry.header_size, entry.size, 'file', entry
+        end_offset = self.directory_offset + self.directory_size
+        yield self.directory_offset, self.directory_size, 'directory', None
+        yield end_offset, self.size - end_offset, 'end', None
+
+    def read(self, start=0, length=None):
+        """Yield the bytes of the archive from start, length bytes (to the end by default)"""
+        end = self.size if length is None else min(self.size, start + length)
+        for offset, size, kind, entry in self._segments():
+            if offset + size <= start or size == 0:
+                continue
+            if offset >= end:
+                return
+            skip = max(0, start - offset)
+            take = min(size, end - offset) - skip
+            if kind == 'file':
+                yield from self._read_file(entry, skip, take)
+                continue
+            if kind == 'header':
+                data = entry.local_header()
+            elif kind == 'directory':
+                data = b''.join(entry.central_header() for entry in self.entries)
+            else:
+                data = self._end()
+            yield data[skip:skip + take]
+
+    @staticmethod
+    def _read_file(entry, start, length):
+        with open(entry.path, 'rb') as f:
+            f.seek(start)
+            while length > 0:
+                chunk = f.read(min(CHUNK_SIZE, length))
+                if not chunk:
+                    raise OSError(f"{entry.path} changed while it was being archived")
+                length -= len(chunk)
+                yield chunk
+
+
+def folder_files(download_path, folder):
+    """[(name in the archive, path)] for the audio files of a library folder, None if there are none.
+
+    folder is a folder as listed by the library index, so 'Uncategorized'
+    stands for the files at the top of download_path. Files are stored
+    under a folder of the same name, sorted, so the archive is the same on
+    every request while the folder does not change.
+    """
+    directory = os.path.join(download_path, folder)
+    if folder == 'Uncategorized' and not os.path.isdir(directory):
+        directory = download_path
+    try:
+        names = sorted(entry.name for entry in os.scandir(directory)
+                       if entry.is_file() and entry.name.endswith(AUDIO_EXTENSIONS))
+    except OSError:
+        return None
+    prefix = folder.rstrip('/').rsplit('/', 1)[-1]
+    return [(f"{prefix}/{name}", os.path.join(directory, name)) for name in names] or None
+
+
+def prepare_zip(archive, method, request_headers, download_name):
+    """(status, headers, body) for an archive, as audio_stream.prepare_audio returns for a file"""
+    headers = {'Content-Disposition': attachment(download_name)}
+    return prepare_ranges(archive.size, archive.etag, archive.mtime, 'application/zip', method,
+                          request_headers, headers)
+
+
+def send_zip(archive, download_name):
+    """Flask response streaming an archive, with Range/If-Range support for resuming"""
+    status, headers, body = prepare_zip(archive, request.method, request.headers, download_name)
+
+    def generate():
+        for part in body or ():
+            if isinstance(part, bytes):
+                yield part
+            else:
+                yield from archive.read(*part)
+    return Response(generate(), status=status, headers=headers, direct_passthrough=True)